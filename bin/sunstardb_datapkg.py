@@ -8,15 +8,45 @@ import os.path
 from sunstardb.database import SunStarDB
 from sunstardb import datapkg
 from sunstardb import utils
+from sunstardb import resolver
+from sunstardb import ingest
 
 more_args = [ dict(name='datapkg'),
               dict(flag='--test', action='store_true', 
                    help="For testing, prints datapackage contents without inserting to DB."),
               dict(flag='--nocommit', action='store_true',
-                   help="For testing, skip committing at the end.") ]
+                   help="For testing, skip committing at the end."),
+              dict(flag='--bulk', action='store_true',
+                   help="Buffer data and insert with multi-row statements."),
+              dict(flag='--batch-size', dest='batch_size', type=int, default=5000,
+                   help="Number of data points per batch in --bulk mode. Default 5000."),
+              dict(flag='--pipeline', action='store_true',
+                   help="Parse on a separate thread while writing batches (implies --bulk)."),
+              dict(flag='--queue-size', dest='queue_size', type=int, default=4,
+                   help="Number of parsed batches waiting to be written in --pipeline mode. Default 4."),
+              dict(flag='--resume', action='store_true',
+                   help="Commit in batches with a checkpoint, and on rerun load only new data."),
+              dict(flag='--columnar', action='store_true',
+                   help="Parse text data files by blocks of columns with NumPy."),
+              dict(flag='--prepared', type=int, default=None,
+                   help="Use up to this many server-side prepared statements for per-row SQL."),
+              dict(flag='--simbad-cache', dest='simbad_cache', nargs='?', const='', default=None,
+                   help="Keep SIMBAD results in an on-disk cache (optional path)."),
+              dict(flag='--simbad-local', dest='simbad_local',
+                   help="Resolve star names from a local JSON file instead of SIMBAD.") ]
 (args, db) = SunStarDB.cli_connect(more_args)
 dataname = args.datapkg
-dataobj = datapkg.load_class(dataname)
+dataobj = datapkg.load_class(dataname, columnar=args.columnar)
+
+if args.resume and args.nocommit:
+    print("ERROR: --resume commits in batches, it can not be used with --nocommit")
+    exit(-1)
+if args.prepared is not None:
+    db.enable_prepared(args.prepared)
+if args.simbad_local is not None:
+    db.resolver = resolver.LocalResolver(args.simbad_local)
+if args.simbad_cache is not None:
+    db.resolver = resolver.CachedResolver(db.resolver, path=args.simbad_cache or None)
 
 def fatal_if(bool, message):
     if bool:
@@ -49,9 +79,22 @@ if db_origin is None:
     print("Inserting origin '%s'" % dataobj.origin['name'])
     db_origin = db.insert_origin(dataobj.origin)
 
-# TODO: currently source is a one-time use.  What about appending to a long time series?
-print("Inserting source '%s'" % dataobj.source['name'])
-db_source = db.insert_source(origin_id=db_origin['id'], **dataobj.source)
+# Without --resume a source is loaded once; with --resume new data is appended
+db_source = None
+checkpoint = ingest.Checkpoint()
+if args.resume:
+    db_source = db.fetch_source(dataobj.source)
+    if db_source is not None:
+        db_checkpoint = db.fetch_ingest_checkpoint(db_source)
+        fatal_if(db_checkpoint is None, "source '%s' was not loaded with --resume" % db_source['name'])
+        checkpoint = ingest.Checkpoint.from_db(db_checkpoint)
+        print("Resuming source '%s' after %i data points" % (db_source['name'], checkpoint.offset))
+if db_source is None:
+    print("Inserting source '%s'" % dataobj.source['name'])
+    db_source = db.insert_source(origin_id=db_origin['id'], **dataobj.source)
+    if args.resume:
+        db.save_ingest_checkpoint(db_source, checkpoint.offset, checkpoint.content_hash)
+        db.commit()
 
 global_instr = None
 instrument_cache = None
@@ -72,32 +115,27 @@ if dataobj.instrument is not None:
 
 print("Inserting data...")
 utils.time_reset()
-star_cache = {}
-type_cache = {}
+db.enable_cache()
+seen_stars = set()
 n_data = 0
 newstars = 0
-for datum in dataobj.data():
+def lookup(datum):
+    """Fetch the datatype, star and instrument of a datum, inserting a new star"""
+    global newstars
     # Fetch datatype from DB or cache
     datatype = datum['type']
-    if datatype not in type_cache:
-        db_type = db.fetch_datatype(name=datatype)
-        fatal_if(db_type is None, "datatype '%s' not found in the database." % datatype)
-        type_cache[datatype] = db_type
-    else:
-        db_type = type_cache[datatype]
+    db_type = db.fetch_datatype(name=datatype)
+    fatal_if(db_type is None, "datatype '%s' not found in the database." % datatype)
 
     # Fetch star from DB or cache, or insert new star
     star = datum['star']
-    if star not in star_cache:
-        db_star = db.fetch_star(name=star)
-        if db_star is None:
-            print("Inserting new star '%s'..." % star, end=' ')
-            db_star = db.insert_star(name=star)
-            print("resolved as '%s'" % db_star['name'])
-            newstars += 1
-        star_cache[star] = db_star
-    else:
-        db_star = star_cache[star]
+    db_star = db.fetch_star(name=star)
+    if db_star is None:
+        print("Inserting new star '%s'..." % star, end=' ')
+        db_star = db.insert_star(name=star)
+        print("resolved as '%s'" % db_star['name'])
+        newstars += 1
+    seen_stars.add(db_star['id'])
 
     # Handle instrument selection for multiple instruments
     if 'instrument' in datum:
@@ -106,18 +144,82 @@ for datum in dataobj.data():
         db_instr = instrument_cache[datum['instrument']]
     else:
         db_instr = global_instr
+    return db_type, db_star, db_instr
+
+def save_checkpoint(n):
+    """Record that the next n data points are loaded, and commit (--resume)"""
+    if args.resume:
+        db.save_ingest_checkpoint(db_source, *checkpoint.advance(n))
+        db.commit()
+
+def write_batch(batch):
+    """Prepare and insert a batch of data with prepared times (--pipeline)"""
+    prepared = []
+    for datum in batch:
+        db_type, db_star, db_instr = lookup(datum)
+        if args.debug:
+            print('DATUM:', datum)
+        prepared.append(db.prepare_datum(datum, db_star, db_type, db_source, db_ref, db_instr, defer_time=True))
+    db.insert_data_bulk(prepared)
+    save_checkpoint(len(batch))
+    print("Inserted batch of %i data points in %0.3f seconds" % (len(batch), utils.time_lap()))
+    return len(batch)
+
+batch = []
+if args.pipeline:
+    timers = {}
+    counts = []
+    ingest.run_pipeline(ingest.parse_batches(checkpoint.data(dataobj.data()), db, args.batch_size),
+                        lambda batch: counts.append(write_batch(batch)),
+                        queue_size=args.queue_size, timers=timers)
+    n_data = sum(counts)
+    for stage in ingest.STAGES:
+        print("Pipeline stage", timers[stage])
+else:
+    for datum in checkpoint.data(dataobj.data()):
+        db_type, db_star, db_instr = lookup(datum)
+        if args.debug:
+            print('DATUM:', datum)
+        if args.bulk:
+            batch.append(db.prepare_datum(datum, db_star, db_type, db_source, db_ref, db_instr, defer_time=True))
+            if len(batch) >= args.batch_size:
+                db.prepare_time_batch(batch)
+                db.insert_data_bulk(batch)
+                save_checkpoint(len(batch))
+                print("Inserted batch of %i data points in %0.3f seconds" % (len(batch), utils.time_lap()))
+                batch = []
+        else:
+            print("Inserting datatype '%s' for star '%s' ('%s' in source)" % (datum['type'], db_star['name'], datum['star']))
+            db.insert_datum(datum, db_star, db_type, db_source, db_ref, db_instr)
+            if (n_data + 1) % args.batch_size == 0:
+                save_checkpoint(args.batch_size)
+        n_data += 1
 
-    print("Inserting datatype '%s' for star '%s' ('%s' in source)" % (datatype, db_star['name'], star))
-    if args.debug:
-        print('DATUM:', datum)
-    db.insert_datum(datum, db_star, db_type, db_source, db_ref, db_instr)
-    n_data += 1
+if batch:
+    db.prepare_time_batch(batch)
+    db.insert_data_bulk(batch)
+    save_checkpoint(len(batch))
+    print("Inserted batch of %i data points in %0.3f seconds" % (len(batch), utils.time_lap()))
+elif not args.bulk and not args.pipeline:
+    save_checkpoint(n_data % args.batch_size)
 
-n_stars = len(star_cache)
+n_stars = len(seen_stars)
+elapsed = utils.time_total()
 print("Inserted %i data points for %i stars (%i new)" % (n_data, n_stars, newstars), end=' ')
-print("in %0.3f seconds" % utils.time_total())
-
-print("Creating dataset for source '%s'" % db_source['name'])
+print("in %0.3f seconds" % elapsed, end=' ')
+print("(%0.1f rows/second)" % (n_data / elapsed if elapsed > 0 else 0.0))
+for table, stats in sorted(db.cache_stats().items()):
+    print("Lookup cache '%s': %i hits, %i misses" % (table, stats['hits'], stats['misses']))
+if db.prepared_size is not None:
+    stats = db.prepared_stats()
+    print("Prepared statements: %i prepares, %i executions, %i evictions" % \
+          (stats['prepares'], stats['executions'], stats['evictions']))
+
+if args.resume and db.fetch_scalar("SELECT id FROM dataset WHERE name = %(name)s", db_source) is not None:
+    print("Replacing dataset for source '%s'" % db_source['name'])
+    db.delete_dataset(db_source)
+else:
+    print("Creating dataset for source '%s'" % db_source['name'])
 db.create_dataset_from_source(db_source)
 
 if dataobj.sanity_check is not None:
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import os.path
+
+from sqlhappy import db_argparser, db_kwargs
+from sunstardb.database import SunStarDB
+from sunstardb import ingest
+from sunstardb import utils
+from sunstardb import resolver
+
+more_args = [ dict(name='datapkg', nargs='+'),
+              dict(flag='--processes', type=int, default=None,
+                   help="Number of parser processes. Default the number of CPUs."),
+              dict(flag='--writers', type=int, default=2,
+                   help="Number of writer connections. Default 2."),
+              dict(flag='--batch-size', dest='batch_size', type=int, default=5000,
+                   help="Number of data points per insert batch. Default 5000."),
+              dict(flag='--columnar', action='store_true',
+                   help="Parse text data files by blocks of columns with NumPy."),
+              dict(flag='--nocommit', action='store_true',
+                   help="For testing, roll back each package instead of committing."),
+              dict(flag='--simbad-cache', dest='simbad_cache', nargs='?', const='', default=None,
+                   help="Keep SIMBAD results in an on-disk cache (optional path)."),
+              dict(flag='--simbad-local', dest='simbad_local',
+                   help="Resolve star names from a local JSON file instead of SIMBAD.") ]
+parser = db_argparser(arguments=more_args)
+args = parser.parse_args()
+db_params = db_kwargs(args)
+
+star_resolver = resolver.SimbadResolver()
+if args.simbad_local is not None:
+    star_resolver = resolver.LocalResolver(args.simbad_local)
+if args.simbad_cache is not None:
+    star_resolver = resolver.CachedResolver(star_resolver, path=args.simbad_cache or None)
+
+def connect():
+    return SunStarDB(resolver=star_resolver, **db_params)
+
+print("Ingesting %i data packages" % len(args.datapkg))
+utils.time_reset()
+results = ingest.ingest_packages(args.datapkg, connect,
+                                 processes=args.processes,
+                                 writers=args.writers,
+                                 batch_size=args.batch_size,
+                                 columnar=args.columnar,
+                                 commit=not args.nocommit)
+
+failed = [ name for name in args.datapkg if results.get(name) is not None ]
+print("Loaded %i of %i data packages in %0.3f seconds" % \
+    (len(args.datapkg) - len(failed), len(args.datapkg), utils.time_total()))
+for name in failed:
+    print("FAILED '%s': %s" % (name, results[name]))
+if args.nocommit:
+    print("NOT COMMITING because of --nocommit option.")
+if failed:
+    exit(-1)
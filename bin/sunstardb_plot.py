@@ -4,12 +4,14 @@ import json
 import sys
 import os
 import os.path
-import numpy
 import argparse
 
 from sunstardb.database import SunStarDB
 from sunstardb import utils
-import plothappy
+
+# matplotlib is only needed for plots, not to print
+numpy = utils.LazyModule('numpy')
+plothappy = utils.LazyModule('plothappy')
 
 (args, db) = SunStarDB.cli_connect([dict(name='command', 
                                          choices=['print', 'scatter', 'hist', 'timeseries']
@@ -54,12 +56,28 @@ elif args.command == 'hist':
         no_data_exit()
     plothappy.show_hist(data[x], x)
 elif args.command == 'timeseries':
-    type, star = args.args[0], args.args[1]
-    source = args.args[2] if len(args.args) > 2 else None
-    result = db.fetch_timeseries(type, star, source)
+    parser = argparse.ArgumentParser(prog='timeseries')
+    parser.add_argument('type')
+    parser.add_argument('star')
+    parser.add_argument('source', nargs='?')
+    parser.add_argument('--start', help="Plot points from this time (inclusive).")
+    parser.add_argument('--end', help="Plot points until this time (exclusive).")
+    parser.add_argument('--points', type=int, default=2000,
+                        help="Downsample to at most this many points, 0 for all. Default 2000.")
+    parser.add_argument('--mode', choices=['lttb', 'bin'], default='lttb',
+                        help="Downsampling mode: 'lttb' keeps actual points, 'bin' plots the "
+                             "mean and range of equal time intervals. Default 'lttb'.")
+    ts = parser.parse_args(args.args)
+    type, star, source = ts.type, ts.star, ts.source
+    result = db.fetch_timeseries(type, star, source, start=ts.start, end=ts.end,
+                                 points=ts.points or None, mode=ts.mode)
     if result is None:
         no_data_exit(source=source)
+    if ts.points and ts.mode == 'bin':
+        yerr = [result[type] - result['min_' + type], result['max_' + type] - result[type]]
+    else:
+        yerr = [result['errlo'], result['errhi']]
     plothappy.show_plot(result['obs_time'], result[type],
                         "%s %s" % (star, type), xlabel='Time', ylabel=type,
-                        yerr=[result['errlo'], result['errhi']]
+                        yerr=yerr
                         )
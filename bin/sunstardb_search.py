@@ -4,29 +4,52 @@ import sys
 import os
 import os.path
 import argparse
-import numpy
 
 from sunstardb.database import SunStarDB
 from sunstardb import utils
 
+astropy = utils.LazyModule('astropy')
+
 (args, db) = SunStarDB.cli_connect([dict(name='command',
-                                         choices=['boxmatch']),
+                                         choices=['boxmatch', 'conematch']),
                                     dict(name='args',
                                          nargs=argparse.REMAINDER)])
 
+def read_targets(inputfile):
+    """Read tab-separated ra, dec lines of inputfile into a SkyCoord array"""
+    ra = []
+    dec = []
+    for line in open(inputfile):
+        line = line.strip()
+        skycoord = utils.parse_skycoord(*line.split('\t'))
+        ra.append(skycoord.ra.degree)
+        dec.append(skycoord.dec.degree)
+    return astropy.coordinates.SkyCoord(ra, dec, frame='icrs', unit=astropy.units.degree)
+
+def print_matches(targets, chunks):
+    """Print matches as tab-separated lines as they arrive"""
+    target_ra = targets.ra.degree
+    target_dec = targets.dec.degree
+    print("\t".join(['idx', 'target_ra', 'target_dec', 'name', 'ra', 'dec', 'sep']))
+    for chunk in chunks:
+        for row in chunk:
+            i = row['idx']
+            print("%i\t%0.6f\t%0.6f\t%s\t%0.6f\t%0.6f\t%0.6f" % \
+                (i, target_ra[i], target_dec[i],
+                 row['name'], row['ra'], row['dec'], row['sep']))
+
 if args.command == 'boxmatch':
     side = float(args.args[0])
     dataset = args.args[1]
     inputfile = args.args[2]
-    for line in open(inputfile):
-        line = line.strip()
-        ra, dec = line.split('\t')
-        skycoord = utils.parse_skycoord(ra, dec)
-        result = db.fetch_boxmatch(dataset, skycoord, side, orient='center')
-        print("%0.1f deg box search centered on ra=%0.3f deg, dec=%0.3f deg:" % \
-            (side, skycoord.ra.degree, skycoord.dec.degree))
-        print(result)
-        print()
+    targets = read_targets(inputfile)
+    print_matches(targets, db.iter_boxmatch_bulk(dataset, targets, side, orient='center'))
+elif args.command == 'conematch':
+    radius = float(args.args[0])
+    dataset = args.args[1]
+    inputfile = args.args[2]
+    targets = read_targets(inputfile)
+    print_matches(targets, db.iter_conematch(dataset, targets, radius))
 else:
     print("Invalid command:", command)
     exit(-1)
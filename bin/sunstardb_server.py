@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import signal
+
+from sqlhappy import db_argparser, db_kwargs
+from sunstardb.database import SunStarDB
+from sunstardb import server
+
+more_args = [ dict(flag='--socket', default=os.environ.get(server.SOCKET_ENV),
+                   help="Path of the Unix socket. Default $%s." % server.SOCKET_ENV),
+              dict(flag='--lookup-cache', dest='lookup_cache', action='store_true',
+                   help="Keep the lookup cache between requests. Writes by other clients are not seen."),
+              dict(flag='--result-cache', dest='result_cache', type=int, default=256,
+                   help="Size in MB of the result cache, 0 to disable. Default 256."),
+              dict(flag='--star-index', dest='star_index', action='store_true',
+                   help="Keep an in-process spatial index of the stars.") ]
+parser = db_argparser(arguments=more_args)
+args = parser.parse_args()
+if not args.socket:
+    print("ERROR: no socket path, use --socket or set %s" % server.SOCKET_ENV)
+    exit(-1)
+
+print("Connecting to database...", end=' ')
+db = SunStarDB(**db_kwargs(args))
+print("Done.")
+if args.lookup_cache:
+    db.enable_cache()
+if args.result_cache > 0:
+    db.enable_result_cache(maxbytes=args.result_cache * 2**20)
+if args.star_index:
+    db.enable_star_index()
+    db.commit()
+
+srv = server.Server(db, args.socket)
+srv.open()
+print("Listening on '%s'; scripts run here when %s=%s" % (args.socket, server.SOCKET_ENV, args.socket))
+# Stop cleanly, removing the socket, on kill as on Ctrl-C
+signal.signal(signal.SIGTERM, signal.default_int_handler)
+try:
+    srv.serve_forever()
+except KeyboardInterrupt:
+    pass
+print("Stopped after %i requests" % srv.requests)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Benchmark the startup of the bin/ scripts
+
+For each script, a fresh python process runs the imports of the script,
+connects to the database and runs a first query, and reports the time
+of each step.  The best of --repeat runs is kept.  With --save the
+timings are written to a JSON file; with --baseline they are compared
+to a saved file, and the exit status is non-zero if any script got
+slower than the baseline by more than --tolerance.
+"""
+
+import ast
+import json
+import os
+import os.path
+import subprocess
+import sys
+
+from sqlhappy import db_argparser, db_kwargs
+
+STEPS = ('import', 'connect', 'query')
+
+# Run in the child process, after the imports of the script
+CHILD = """
+t_import = time.perf_counter()
+import json, os
+timings = {'import' : t_import - t_start}
+connect_kwargs = json.loads(os.environ['SUNSTARDB_STARTUP_CONNECT'])
+if connect_kwargs is not None:
+    from sunstardb.database import SunStarDB
+    db = SunStarDB(**connect_kwargs)
+    t_connect = time.perf_counter()
+    db.fetch_scalar("SELECT 1")
+    t_query = time.perf_counter()
+    timings['connect'] = t_connect - t_import
+    timings['query'] = t_query - t_connect
+    db.close()
+print(json.dumps(timings))
+"""
+
+more_args = [ dict(name='scripts', nargs='*',
+                   help="Scripts to benchmark. Default all scripts in bin/."),
+              dict(flag='--repeat', type=int, default=3,
+                   help="Number of runs of each script, the best is kept. Default 3."),
+              dict(flag='--noconnect', action='store_true',
+                   help="Only time the imports, without connecting to the database."),
+              dict(flag='--save',
+                   help="Save the timings to this JSON file."),
+              dict(flag='--baseline',
+                   help="Compare the timings to this JSON file saved with --save."),
+              dict(flag='--tolerance', type=float, default=0.25,
+                   help="Allowed fraction of slowdown from the baseline. Default 0.25.") ]
+parser = db_argparser(arguments=more_args)
+args = parser.parse_args()
+connect_kwargs = None
+if not args.noconnect:
+    connect_kwargs = db_kwargs(args)
+
+bindir = os.path.dirname(os.path.abspath(__file__))
+scripts = args.scripts
+if not scripts:
+    scripts = sorted(os.path.join(bindir, f) for f in os.listdir(bindir)
+                     if f.endswith('.py') and f != os.path.basename(__file__))
+
+def script_imports(path):
+    """Return the source of the top-level import statements of a script"""
+    source = open(path).read()
+    tree = ast.parse(source)
+    imports = [ ast.get_source_segment(source, node) for node in tree.body
+                if isinstance(node, (ast.Import, ast.ImportFrom)) ]
+    return "\n".join(imports)
+
+def run_startup(path):
+    """Time the startup steps of a script in a new process, return a dict step -> seconds"""
+    program = "\n".join(["import time",
+                         "t_start = time.perf_counter()",
+                         script_imports(path),
+                         CHILD])
+    # Like running the script: its directory is first in sys.path
+    env = dict(os.environ)
+    env['SUNSTARDB_STARTUP_CONNECT'] = json.dumps(connect_kwargs)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (os.path.dirname(path), env.get('PYTHONPATH')) if p)
+    result = subprocess.run([sys.executable, '-c', program], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception("startup of '%s' failed:\n%s" % (path, result.stderr))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+results = {}
+print("%-28s %10s %10s %10s %10s" % (('script',) + STEPS + ('total',)))
+for path in scripts:
+    name = os.path.basename(path)
+    runs = [ run_startup(path) for i in range(args.repeat) ]
+    best = min(runs, key=lambda r: sum(r.values()))
+    best['total'] = sum(best.values())
+    results[name] = best
+    print("%-28s" % name, end=' ')
+    print(" ".join("%10s" % ("%0.3f" % best[s] if s in best else '-') for s in STEPS + ('total',)))
+
+if args.save is not None:
+    with open(args.save, 'w') as fp:
+        json.dump(results, fp, indent=2, sort_keys=True)
+    print("Saved timings to", args.save)
+
+if args.baseline is not None:
+    baseline = json.load(open(args.baseline))
+    regressions = 0
+    for name, timings in sorted(results.items()):
+        if name not in baseline:
+            continue
+        # Only compare the steps timed in both runs, e.g. imports only with --noconnect
+        steps = [ s for s in STEPS if s in timings and s in baseline[name] ]
+        total = sum(timings[s] for s in steps)
+        baseline_total = sum(baseline[name][s] for s in steps)
+        if total > baseline_total * (1.0 + args.tolerance):
+            print("REGRESSION %s: %0.3f seconds, baseline %0.3f seconds" % \
+                (name, total, baseline_total))
+            regressions += 1
+    if regressions:
+        exit(-1)
+    print("No startup regression from", args.baseline)
@@ -6,7 +6,9 @@ import os
 
 from sunstardb.database import SunStarDB
 
-(args, db) = SunStarDB.cli_connect([dict(name='file')])
+(args, db) = SunStarDB.cli_connect([dict(name='file'),
+                                    dict(flag='--partitioned', action='store_true',
+                                         help="Partition the data tables of new TIMESERIES datatypes by decade.")])
 
 print("Loading %s," % (args.file), end=' ') 
 fp = open(args.file)
@@ -15,12 +17,17 @@ types = js['datatypes']
 print(len(types), "datatypes in file.")
 
 print("Inserting datatypes into database.")
+existing = set(db.fetch_column("SELECT name FROM datatype") or [])
+newtypes = []
 for t in types:
-    if db.fetch_datatype(t) is None:
+    if t['name'] not in existing:
         print("Inserting datatype:", t['name'])
-        db.insert_datatype(t)
+        if args.partitioned and t['struct'] == 'TIMESERIES':
+            t.setdefault('partitioned', True)
+        newtypes.append(t)
     else:
         print(t['name'], "already exists... skipping")
+db.insert_datatypes(newtypes)
 
 db.commit()
 db.close()
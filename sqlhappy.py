@@ -2,12 +2,19 @@
 Base class for DB-interacting classes and scripts
 """
 
-import psycopg2, psycopg2.extras
+import psycopg2, psycopg2.extras, psycopg2.pool
 from datetime import datetime, timedelta
+from contextlib import contextmanager
+import collections
+import itertools
+import re
+import threading
+import time
 import sys
+import weakref
 import os
 import math
-import numpy
+import numbers
 from argparse import ArgumentParser
 import configparser
 import getpass
@@ -30,11 +37,21 @@ class Database():
     that the application can operate with a uniform environment.
     """
 
+    # Counter used to give unique names to server-side cursors
+    _cursor_ids = itertools.count(1)
+
+    # Counter used to give unique names to prepared statements
+    _statement_ids = itertools.count(1)
+
+    # pyformat bind placeholder, e.g. %(var_name)s
+    _placeholder = re.compile(r'%\((\w+)\)s')
+
     def __init__(self,
                  drivername = "postgres",
                  host = "localhost", port = None, database = None,
                  username = None, password = None,
-                 debug = False
+                 debug = False, pool = None, prepared = None,
+                 pool_timeout = 30.0
                  ):
         """Connect to a database
 
@@ -53,25 +70,30 @@ class Database():
          - username <str> : database user name
          - password <str> : password for username
          - debug <bool> : enable debug mode
+         - pool <int|tuple> : number of connections, or (min, max)
+                              connections, to keep in a thread-safe
+                              pool.  See open().
+         - pool_timeout <float> : seconds to wait for a free pool
+                                  connection before raising an
+                                  Exception, None to wait forever
+         - prepared <int> : keep up to this many server-side prepared
+                            statements per connection, see
+                            execute_prepared()
         """
         self.debug = debug
-
-        # If the user provided a database or user build a dburl
-        if (database is not None or username is not None):
-            conn_params = { 'host':host, 'database':database, 'username':username, 'password':password }
-        # If we have no connect info, look in the configuration
-        elif os.environ.get('DBCONFIG'):
-            config = configparser.ConfigParser()
-            configfile = os.environ.get('DBCONFIG')
-            config.readfp(open(configfile))
-            conn_params = dict(config.items('connection'))            
-        else:
-            raise Exception("Connection info not provided.")
-
-        conn_str = "host='%(host)s' dbname='%(database)s' user='%(username)s' password='%(password)s'" % \
-            conn_params
-
-
+        self.prepared_size = prepared
+        # { connection : LRU of its prepared statements }, forgotten with the connection
+        self._statements = weakref.WeakKeyDictionary()
+        self._prepared_lock = threading.Lock()
+        self._prepared_stats = { 'prepares' : 0, 'executions' : 0, 'evictions' : 0 }
+        if isinstance(pool, int):
+            # psycopg2 closes connections returned above minconn
+            pool = (pool, pool)
+        self.pool_size = pool
+        self.pool_timeout = pool_timeout
+        self.pool = None
+
+        conn_params, conn_str = connection_string(host, database, username, password, port)
         self.conn_params = conn_params
         self.conn_str = conn_str
         self.open()
@@ -80,9 +102,124 @@ class Database():
     def __del__(self):
         """Destructor that insures database connection is closed
         """
-        if not self.connection.closed:
+        if getattr(self, 'pool', None) is not None:
+            if not self.pool.closed:
+                self.close()
+        elif getattr(self, '_connection', None) is not None and not self._connection.closed:
             self.close()
 
+    @property
+    def connection(self):
+        """The connection in use by the current thread
+
+        In pooled mode each thread checks out its own connection from
+        the pool on first use, and keeps it until the end of its
+        transaction (commit(), rollback() or release()).  Threads that
+        only read should do so within checked_out(), which returns the
+        connection at the end of the block.
+        """
+        if self.pool is None:
+            return self._connection
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = self.checkout()
+        return conn
+
+    @connection.setter
+    def connection(self, conn):
+        self._connection = conn
+
+    def checkout(self):
+        """Check out a pool connection for the current thread, waiting if none are free
+
+        Raises an Exception if no connection was returned to the pool
+        within pool_timeout seconds.
+        """
+        start = time.time()
+        if self.pool_timeout is None:
+            self._slots.acquire()
+        elif not self._slots.acquire(timeout=self.pool_timeout):
+            raise Exception("No free connection in the pool of %i after %0.1f seconds; "
+                            "do all threads commit(), rollback() or release() their connection?" % \
+                            (self.pool_size[1], self.pool_timeout))
+        wait = time.time() - start
+        try:
+            conn = self.pool.getconn()
+        except:
+            self._slots.release()
+            raise
+        with self._stats_lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_time_total'] += wait
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait)
+        self._local.connection = conn
+        return conn
+
+    def release(self):
+        """Return the current thread's pool connection, rolling back any open transaction"""
+        if self.pool is None:
+            return
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            return
+        self._local.connection = None
+        if not conn.closed:
+            conn.rollback()
+        self.pool.putconn(conn)
+        if conn.closed:
+            # closed by the pool, its prepared statements are gone with it
+            self._statements.pop(conn, None)
+        with self._stats_lock:
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    @contextmanager
+    def checked_out(self):
+        """Context manager holding a pool connection for the current thread
+
+        The connection is checked out on first use within the block and
+        released at its end, rolling back what was not committed.  If
+        the thread already held a connection when entering the block, it
+        is kept.  Without a pool this does nothing.
+        """
+        held = self.pool is not None and getattr(self._local, 'connection', None) is not None
+        try:
+            yield self
+        finally:
+            if not held:
+                self.release()
+
+    def pool_stats(self):
+        """Connection pool metrics, or None if not pooled
+
+        Returns a dict with keys 'minconn', 'maxconn', 'in_use',
+        'checkouts', 'wait_time_total' and 'wait_time_max' (seconds
+        spent waiting for a free connection).
+        """
+        if self.pool is None:
+            return None
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['minconn'], stats['maxconn'] = self.pool_size
+        return stats
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for one transaction
+
+        Commits on success and rolls back on exception.  In pooled mode
+        the thread's connection is checked out on first use within the
+        block and returned to the pool at its end.
+        """
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+
     def makebinds(self, data, names):
         """Build binds (list of maps) from a list of lists
 
@@ -102,10 +239,14 @@ class Database():
         """
         for key in binds:
             value = binds[key]
-            if isinstance(value, numpy.floating):
-                binds[key] = float(value)
-            elif isinstance(value, numpy.integer):
+            # numpy scalars, recognized without importing numpy: they
+            # have item() and are registered with the numbers ABCs
+            if not hasattr(value, 'item'):
+                continue
+            if isinstance(value, numbers.Integral):
                 binds[key] = int(value)
+            elif isinstance(value, numbers.Real):
+                binds[key] = float(value)
 
     def execute(self, sql, binds = None):
         """execute sql with optional bind parameters, which can be arrays
@@ -133,21 +274,222 @@ class Database():
 
         return cursor
 
+    def enable_prepared(self, size = 128):
+        """Keep up to 'size' prepared statements per connection, see execute_prepared()"""
+        self.prepared_size = size
+
+    def disable_prepared(self):
+        """Stop preparing statements and deallocate those of the current connection"""
+        self.prepared_size = None
+        self.deallocate()
+
+    def prepared_stats(self):
+        """Return counters of the prepared statement cache
+
+        Output:
+         - <dict> : counts of 'prepares', 'executions' and
+                    'evictions', and the current number of prepared
+                    statements ('size') over all connections
+        """
+        with self._prepared_lock:
+            stats = dict(self._prepared_stats)
+        stats['size'] = sum(len(c) for c in list(self._statements.values()))
+        return stats
+
+    def prepare_sql(self, sql):
+        """Convert pyformat placeholders to positional $n parameters
+
+        Output:
+         - sql <str>     : the statement suitable for PREPARE
+         - params <list> : bind names, in the order of the parameters
+        """
+        params = []
+        def param(match):
+            name = match.group(1)
+            if name not in params:
+                params.append(name)
+            return "$%d" % (params.index(name) + 1)
+        sql = self._placeholder.sub(param, sql)
+        return sql.replace('%%', '%'), params
+
+    def execute_prepared(self, sql, binds = None):
+        """execute sql as a server-side prepared statement
+
+        Same as execute(), but the first time a distinct 'sql' is
+        executed on a connection it is sent with PREPARE, and from then
+        on only EXECUTE with the bind values is sent, so that the server
+        parses and plans it only once.  The least recently used
+        statement is deallocated when more than 'prepared' statements
+        would be kept.
+
+        If prepared statements are not enabled, this is execute().
+        """
+        if self.prepared_size is None:
+            return self.execute(sql, binds)
+        conn = self.connection
+        statements = self._statements.get(conn)
+        if statements is None:
+            statements = self._statements[conn] = collections.OrderedDict()
+        cursor = conn.cursor()
+
+        entry = statements.get(sql)
+        if entry is None:
+            while len(statements) >= self.prepared_size:
+                old_sql, (old_name, old_params) = next(iter(statements.items()))
+                cursor.execute("DEALLOCATE %s" % old_name)
+                del statements[old_sql]
+                with self._prepared_lock:
+                    self._prepared_stats['evictions'] += 1
+            name = "sqlhappy_%d" % next(self._statement_ids)
+            prepare_sql, params = self.prepare_sql(sql)
+            prepare_sql = "PREPARE %s AS %s" % (name, prepare_sql)
+            if self.debug:
+                print("SQL:", prepare_sql)
+            cursor.execute(prepare_sql)
+            entry = statements[sql] = (name, params)
+            with self._prepared_lock:
+                self._prepared_stats['prepares'] += 1
+        else:
+            statements.move_to_end(sql)
+
+        name, params = entry
+        execute_sql = "EXECUTE %s" % name
+        if params:
+            execute_sql += " (%s)" % ", ".join("%%(%s)s" % p for p in params)
+        if self.debug:
+            print("SQL:", execute_sql)
+        if binds is None:
+            cursor.execute(execute_sql)
+        else:
+            self.clean_binds(binds)
+            cursor.execute(execute_sql, binds)
+        with self._prepared_lock:
+            self._prepared_stats['executions'] += 1
+        return cursor
+
+    def deallocate(self):
+        """Forget the prepared statements of the current connection"""
+        conn = self.connection
+        if self._statements.pop(conn, None):
+            cursor = conn.cursor()
+            cursor.execute("DEALLOCATE ALL")
+            cursor.close()
+
+    def execute_values(self, sql, binds, template=None, page_size=1000, fetch=False):
+        """execute a multi-row sql statement over a list of bind dicts
+
+        The given sql statement must contain a single '%s' placeholder
+        where the VALUES list is to be placed, e.g. 'INSERT INTO t (a,
+        b) VALUES %s'.  'template' gives the per-row bind format, e.g.
+        '(%(a)s, %(b)s)'.  Rows are sent 'page_size' at a time.
+
+        Input:
+         - sql <str>        : the SQL statement to execute
+         - binds <list>     : a list of dicts containing bind data
+         - template <str>   : per-row format of the VALUES list
+         - page_size <int>  : maximum number of rows per statement
+         - fetch <bool>     : return rows of a RETURNING clause
+
+        Output:
+         - <list> : rows returned by the statement when fetch is True
+        """
+        cursor = self.connection.cursor()
+
+        if self.debug:
+            print("SQL:", sql, "(%i rows)" % len(binds))
+
+        for b in binds:
+            self.clean_binds(b)
+        result = psycopg2.extras.execute_values(cursor, sql, binds, template=template,
+                                                page_size=page_size, fetch=fetch)
+        cursor.close()
+        return result
+
+    def copy_out(self, sql, file, binds = None, options = "FORMAT csv, HEADER true"):
+        """Write the results of an SQL query to a file object using COPY TO STDOUT
+
+        The query results are streamed by the server in bulk, without
+        being converted to python row objects.
+
+        Input:
+         - sql <str>     : SELECT statement to export
+         - file <object> : file-like object to write to
+         - binds <dict>  : optional bind parameters, interpolated client-side
+         - options <str> : COPY options, default CSV with a header line
+        """
+        cursor = self.connection.cursor()
+        if binds is not None:
+            self.clean_binds(binds)
+            sql = cursor.mogrify(sql, binds).decode()
+        sql = "COPY (%s) TO STDOUT WITH (%s)" % (sql, options)
+
+        if self.debug:
+            print("SQL:", sql)
+
+        cursor.copy_expert(sql, file)
+        cursor.close()
+
+    def copy_in(self, table, file, columns = None, options = "FORMAT csv"):
+        """Load rows into a table from a file object using COPY FROM STDIN
+
+        Input:
+         - table <str>    : name of the table to load
+         - file <object>  : file-like object to read from
+         - columns <list> : optional names of the columns in the file
+         - options <str>  : COPY options, default CSV without header
+        """
+        cursor = self.connection.cursor()
+        if columns is not None:
+            table = "%s (%s)" % (table, ", ".join(columns))
+        sql = "COPY %s FROM STDIN WITH (%s)" % (table, options)
+
+        if self.debug:
+            print("SQL:", sql)
+
+        cursor.copy_expert(sql, file)
+        cursor.close()
+
     def commit(self):
         """Commit the current transaction"""
         self.connection.commit()
+        self.release()
 
     def rollback(self):
-        """Rollback the current transaction"""
+        """Rollback the current transaction
+
+        Prepared statements are kept: PREPARE and DEALLOCATE are not
+        transactional, and a statement is only cached once its PREPARE
+        succeeded.
+        """
         self.connection.rollback()
+        self.release()
 
     def open(self):
-        """Open a new connection and cursor"""
+        """Open a new connection and cursor
+
+        If a pool size was given, a psycopg2 ThreadedConnectionPool is
+        opened instead, and each thread uses its own connection.
+        """
         # TODO: NamedTupleCursor is more powerful. Update?
-        self.connection = psycopg2.connect(self.conn_str, cursor_factory=psycopg2.extras.DictCursor)
+        if self.pool_size is None:
+            self.connection = psycopg2.connect(self.conn_str, cursor_factory=psycopg2.extras.DictCursor)
+        else:
+            minconn, maxconn = self.pool_size
+            self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, self.conn_str,
+                                                             cursor_factory=psycopg2.extras.DictCursor)
+            self._local = threading.local()
+            self._slots = threading.BoundedSemaphore(maxconn)
+            self._stats_lock = threading.Lock()
+            self._stats = { 'checkouts' : 0, 'in_use' : 0,
+                            'wait_time_total' : 0.0, 'wait_time_max' : 0.0 }
 
     def close(self):
-        """Close the current connection"""
+        """Close the current connection, or all connections of the pool"""
+        self._statements = weakref.WeakKeyDictionary()
+        if self.pool is not None:
+            self.release()
+            self.pool.closeall()
+            return
         self.connection.rollback()
         self.connection.close()
 
@@ -196,6 +538,46 @@ class Database():
         else:
             return all, colnames
 
+    def iterate(self, sql, binds = None, itersize = 10000):
+        """Generate the results of an SQL query in chunks, using a server-side cursor
+
+        Only 'itersize' rows are transferred from the server and held
+        in memory at a time.  The query runs within the current
+        transaction.
+
+        Input:
+         - sql <string>   : SELECT statement to execute
+         - binds <dict>   : optional bind parameters
+         - itersize <int> : number of rows per chunk
+
+        Output:
+         - <generator> : (rows, colnames) for each chunk; at least one
+                         chunk is generated, which may be empty
+        """
+        cursor = self.connection.cursor(name='sqlhappy_cursor_%i' % next(Database._cursor_ids))
+        cursor.itersize = itersize
+
+        if self.debug:
+            print("SQL (server-side):", sql)
+
+        if binds is None:
+            cursor.execute(sql)
+        else:
+            self.clean_binds(binds)
+            cursor.execute(sql, binds)
+        try:
+            first = True
+            while True:
+                rows = cursor.fetchmany(itersize)
+                if len(rows) == 0 and not first:
+                    break
+                yield rows, self.colnames(cursor)
+                first = False
+                if len(rows) < itersize:
+                    break
+        finally:
+            cursor.close()
+
     def fetchall_dict(self, sql, binds = None, key = 0, val = 1):
         """Return sql query as a dictionary of { col[0] : col[1] }
 
@@ -277,17 +659,21 @@ class Database():
         result.close()
         return row
 
-    def fetch_row(self, sql, binds = None):
+    def fetch_row(self, sql, binds = None, prepared = False):
         """Get a single row from the database
 
         Inputs:
-         - sql <str>    : an SQL query
-         - binds <dict> : a dictionary of bind parameters
+         - sql <str>       : an SQL query
+         - binds <dict>    : a dictionary of bind parameters
+         - prepared <bool> : use a prepared statement, see execute_prepared()
 
         Output:
          - <object> : RowProxy object, the first row of 'result'
         """
-        result = self.execute(sql, binds)
+        if prepared:
+            result = self.execute_prepared(sql, binds)
+        else:
+            result = self.execute(sql, binds)
         return self.row(result)
 
     def scalar(self, result, col = 0):
@@ -472,13 +858,44 @@ class Database():
 
 ### Package functions
 
-def db_argparser(parser = ArgumentParser(add_help=False), arguments=None):
+def connection_string(host = "localhost", database = None, username = None, password = None, port = None):
+    """Build the psycopg2 connection string used by Database()
+
+    Uses the given parameters if database or username are passed,
+    otherwise the [connection] section of the config file in the
+    DBCONFIG environment var.
+
+    Output:
+     - conn_params <dict> : connection parameters
+     - conn_str <str>     : psycopg2 connection string
+    """
+    # If the user provided a database or user build a dburl
+    if (database is not None or username is not None):
+        conn_params = { 'host':host, 'port':port, 'database':database, 'username':username, 'password':password }
+    # If we have no connect info, look in the configuration
+    elif os.environ.get('DBCONFIG'):
+        config = configparser.ConfigParser()
+        configfile = os.environ.get('DBCONFIG')
+        config.readfp(open(configfile))
+        conn_params = dict(config.items('connection'))            
+    else:
+        raise Exception("Connection info not provided.")
+
+    conn_str = "host='%(host)s' dbname='%(database)s' user='%(username)s' password='%(password)s'" % \
+        conn_params
+    if conn_params.get('port'):
+        conn_str += " port='%(port)s'" % conn_params
+    return conn_params, conn_str
+
+def db_argparser(parser = None, arguments=None):
     """Get a optparse.OptionParser object with DB connection options added
 
     The option syntax is similar to the 'psql' command.
 
     The following options are defined in the parser:
     """
+    if parser is None:
+        parser = ArgumentParser(add_help=False)
     parser.add_argument("-?", "--help", action="help")
     parser.add_argument("-h", "--host",
                       dest="host", default="localhost",
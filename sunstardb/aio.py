@@ -0,0 +1,268 @@
+"""asyncio interface to the solar-stellar database
+
+AsyncSunStarDB provides coroutine versions of the SunStarDB query
+methods.  It uses the same SQL builders (database.SunStarSQL), so the
+blocking and asyncio paths run exactly the same queries.
+
+Queries run on psycopg2 asynchronous connections which are polled from
+the event loop.  A small set of connections is kept open, so that
+independent queries can be pipelined concurrently, e.g.:
+
+    db = AsyncSunStarDB(pool=4)
+    await db.open()
+    stars = await asyncio.gather(*[ db.fetch_star(name=n) for n in names ])
+    await db.close()
+
+Asynchronous connections are always in autocommit mode, so this
+interface is meant for reading only.
+"""
+
+import asyncio
+
+import psycopg2, psycopg2.extensions, psycopg2.extras
+
+from sqlhappy import Database, connection_string
+
+from . import utils
+from .database import SunStarSQL
+
+astropy = utils.LazyModule('astropy')
+
+class AsyncSunStarDB(SunStarSQL):
+    """asyncio access to the solar-stellar database"""
+
+    def __init__(self,
+                 host = "localhost", port = None, database = None,
+                 username = None, password = None,
+                 debug = False, pool = 4):
+        """Prepare the connections, see sqlhappy.Database
+
+        Input:
+         - host, port, database, username, password : see sqlhappy.Database
+         - debug <bool> : enable debug mode
+         - pool <int>   : number of connections, which is the number of
+                          queries that may run concurrently
+
+        The connections are opened by open().
+        """
+        self.debug = debug
+        self.pool_size = pool
+        self.conn_params, self.conn_str = connection_string(host, database, username, password, port)
+        self.connections = []
+        self.idle = None
+        self.connecting = set()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _wait(self, conn):
+        """Poll an asynchronous connection until its operation is complete"""
+        loop = asyncio.get_event_loop()
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            elif state == psycopg2.extensions.POLL_READ:
+                add, remove = loop.add_reader, loop.remove_reader
+            elif state == psycopg2.extensions.POLL_WRITE:
+                add, remove = loop.add_writer, loop.remove_writer
+            else:
+                raise psycopg2.OperationalError("unexpected poll state %s" % state)
+            ready = loop.create_future()
+            fd = conn.fileno()
+            add(fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                remove(fd)
+
+    async def open(self):
+        """Open the connections
+
+        If any connection fails, or open() is cancelled, those already
+        opened are closed.
+        """
+        if self.idle is not None:
+            return
+        idle = asyncio.Queue()
+        try:
+            for i in range(self.pool_size):
+                conn = psycopg2.connect(self.conn_str, async_=1)
+                self.connections.append(conn)
+                await self._wait(conn)
+                idle.put_nowait(conn)
+        except BaseException:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            raise
+        self.idle = idle
+
+    def _replace(self, conn):
+        """Close a connection left in an unknown state, return a new one in its place
+
+        A query still running on it is cancelled first.  The new
+        connection is only waited for when it is next taken from idle,
+        see _checkout().  Returns None if it could not be created, and
+        the pool is one connection smaller.
+        """
+        index = self.connections.index(conn)
+        self.connecting.discard(conn)
+        if not conn.closed:
+            try:
+                if conn.isexecuting():
+                    conn.cancel()
+            except psycopg2.Error:
+                pass
+            conn.close()
+        try:
+            new = psycopg2.connect(self.conn_str, async_=1)
+        except psycopg2.Error:
+            del self.connections[index]
+            return None
+        self.connections[index] = new
+        self.connecting.add(new)
+        return new
+
+    async def _checkout(self):
+        """Take an idle connection, waiting if all are busy"""
+        if not self.connections:
+            raise psycopg2.OperationalError("No connection left in the pool, all failed to reconnect")
+        conn = await self.idle.get()
+        if conn in self.connecting:
+            try:
+                await self._wait(conn)
+            except BaseException:
+                self._checkin(conn, failed=True)
+                raise
+            self.connecting.discard(conn)
+        return conn
+
+    def _checkin(self, conn, failed=False):
+        """Return a connection to idle
+
+        After a failure, e.g. the calling task was cancelled while a
+        query ran, the connection is replaced unless it is known to be
+        ready for another query.
+        """
+        if failed and (conn.closed or conn in self.connecting or conn.isexecuting()):
+            conn = self._replace(conn)
+        if conn is not None:
+            self.idle.put_nowait(conn)
+
+    async def close(self):
+        """Close all connections, waiting for running queries to finish"""
+        if self.idle is None:
+            return
+        for i in range(len(self.connections)):
+            conn = await self.idle.get()
+            conn.close()
+        self.connections = []
+        self.connecting = set()
+        self.idle = None
+
+    async def execute(self, sql, binds = None, colnames = False):
+        """Execute sql on a free connection and return all result rows, or None
+
+        Waits for a connection if all are busy.  Rows are DictRow
+        objects as in the blocking interface.
+        """
+        if self.idle is None:
+            await self.open()
+        if binds is not None:
+            Database.clean_binds(self, binds)
+        if self.debug:
+            print("SQL:", sql)
+        conn = await self._checkout()
+        try:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            cursor.execute(sql, binds)
+            await self._wait(conn)
+            names = tuple(desc[0] for desc in cursor.description)
+            rows = cursor.fetchall()
+            cursor.close()
+        except BaseException:
+            self._checkin(conn, failed=True)
+            raise
+        self._checkin(conn)
+        if len(rows) == 0:
+            rows = None
+        if colnames:
+            return rows, names
+        return rows
+
+    async def fetchall(self, sql, binds = None, colnames = False):
+        """Return all results of an SQL query, or None"""
+        return await self.execute(sql, binds, colnames=colnames)
+
+    async def fetch_row(self, sql, binds = None):
+        """Return the first row of results of an SQL query, or None"""
+        rows = await self.execute(sql, binds)
+        if rows is None:
+            return None
+        return rows[0]
+
+    async def fetchall_astropy(self, sql, binds = None, dtype = None):
+        """Return all results of an SQL query as an astropy.table.Table"""
+        result, colnames = await self.execute(sql, binds, colnames=True)
+        return astropy.table.Table(rows=result, names=colnames, dtype=dtype)
+
+    async def gather(self, *queries):
+        """Run several query coroutines concurrently and return their results"""
+        return await asyncio.gather(*queries)
+
+    async def fetch_star(self, **kwargs):
+        """Fetch a star given (name), which may be any alias"""
+        sql, binds = self._fetch_star_sql(kwargs['name'])
+        return await self.fetch_row(sql, binds)
+
+    async def fetchall_star_aliases(self, **kwargs):
+        """Fetch all star aliases, using (name) which may be any alias"""
+        sql, binds = self._fetchall_star_aliases_sql(kwargs['name'])
+        return await self.fetchall(sql, binds)
+
+    async def fetchall_datatypes(self):
+        """Fetch all existing datatypes from the database"""
+        return await self.fetchall_astropy(self._fetchall_sql('datatype'))
+
+    async def fetchall_instruments(self):
+        """Fetch all existing instruments from the database"""
+        return await self.fetchall_astropy(self._fetchall_sql('instrument'))
+
+    async def fetchall_origins(self):
+        """Fetch all existing origins in the database"""
+        return await self.fetchall_astropy(self._fetchall_sql('origin'))
+
+    async def fetchall_sources(self):
+        """Fetch all existing sources in the database"""
+        return await self.fetchall_astropy(self._fetchall_sql('source'))
+
+    async def fetchall_datasets(self):
+        """Fetch all existing datasets from the database"""
+        return await self.fetchall_astropy(self._fetchall_sql('dataset'))
+
+    async def fetch_data(self, datatype):
+        """Fetch data and associated info for the given datatype, see SunStarDB.fetch_data()"""
+        return await self.fetchall_astropy(self._fetch_data_sql(datatype))
+
+    async def fetch_data_table(self, dataset, datatypes, meta=None, nulls=True, errors=False):
+        """Fetch a table of data for a dataset, see SunStarDB.fetch_data_table()"""
+        sql, binds = self._fetch_data_table_sql(dataset, datatypes, meta=meta, nulls=nulls, errors=errors)
+        return await self.fetchall_astropy(sql, binds)
+
+    async def fetch_timeseries(self, datatype, star, source=None, start=None, end=None,
+                               points=None, mode='bin'):
+        """Fetch a timeseries for a star, see SunStarDB.fetch_timeseries()"""
+        sql, binds, dtype = self._fetch_timeseries_sql(datatype, star, source, start=start, end=end,
+                                                       points=points, mode=mode)
+        result = await self.fetchall_astropy(sql, binds, dtype=dtype)
+        return self._downsample_timeseries(result, datatype, points, mode)
+
+    async def fetch_boxmatch(self, dataset, skycoord, ra_side, dec_side=None, orient='center'):
+        """Search dataset for stars falling in a box near to skycoord"""
+        sql, binds = self._fetch_boxmatch_sql(dataset, skycoord, ra_side, dec_side, orient)
+        return await self.fetchall(sql, binds)
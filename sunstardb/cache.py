@@ -0,0 +1,236 @@
+"""Caches of database results used by SunStarDB"""
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import os.path
+import threading
+
+from . import utils
+
+astropy = utils.LazyModule('astropy')
+numpy = utils.LazyModule('numpy')
+
+# Column kinds that numpy.save() writes without pickle: bool, integers, floats, text and datetime64
+DISK_KINDS = 'biufUM'
+
+# Prefix of the files written by ResultCache, the only ones clear() removes
+DISK_PREFIX = 'sunstardb-result-'
+
+def _datetime_column(column):
+    """Whether a column holds datetime.datetime objects, as obs_time from fetchall_astropy()
+
+    They are written as numpy.datetime64 and read back as datetime.datetime.
+    """
+    return column.dtype.kind == 'O' and all(isinstance(v, datetime.datetime) for v in column)
+
+class LookupCache(object):
+    """In-process identity cache of rows from small reference tables
+
+    Rows are kept per table and may be stored under several keys, for
+    example by name and by id, so that a row fetched one way is found
+    the other way as well.  Keys are tuples of (column, value) pairs.
+    Hit and miss counters are kept per table.  The cache may be shared
+    by threads, e.g. those of a pooled connection.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def get(self, table, key):
+        """Return the row of table stored under key, or None"""
+        with self.lock:
+            rows = self.tables.get(table)
+            if rows is not None and key in rows:
+                self.hits[table] = self.hits.get(table, 0) + 1
+                return rows[key]
+            self.misses[table] = self.misses.get(table, 0) + 1
+            return None
+
+    def put(self, table, keys, row):
+        """Store row of table under each of the given keys"""
+        with self.lock:
+            rows = self.tables.setdefault(table, {})
+            for key in keys:
+                rows[key] = row
+
+    def invalidate(self, table=None):
+        """Forget the rows of table, or of all tables if table is None"""
+        with self.lock:
+            if table is None:
+                self.tables = {}
+            else:
+                self.tables.pop(table, None)
+
+    def stats(self):
+        """Return a dict of { table : { 'hits', 'misses', 'size' } }"""
+        stats = {}
+        with self.lock:
+            for table in set(self.hits) | set(self.misses) | set(self.tables):
+                stats[table] = { 'hits'   : self.hits.get(table, 0),
+                                 'misses' : self.misses.get(table, 0),
+                                 'size'   : len(self.tables.get(table, {})) }
+        return stats
+
+class ResultCache(object):
+    """LRU cache of result tables, checked against a version stamp
+
+    Entries are stored under a key built from the query arguments,
+    together with a stamp: a cheap summary of the rows the result was
+    built from, e.g. their latest insert time.  An entry is only used
+    if the current stamp is equal to the stored one.
+
+    The in-memory cache is bounded by the total size of the column
+    data.  If 'path' is given, entries are also kept in that directory,
+    so that they survive the process, as .npz files of the column
+    arrays and masks, with the key, stamp and column names as JSON.
+    They are read back without pickle.  The directory is created only
+    accessible to the current user, and files owned by another user are
+    ignored.  Tables with columns of python objects other than
+    datetimes, or with metadata that is not JSON, are only kept in
+    memory.
+
+    The cache may be shared by threads.  Files are read and written
+    outside of its lock.
+
+    Input:
+     - maxbytes <int> : maximum size of the tables kept in memory
+     - path <str>     : optional directory for the on-disk cache
+    """
+
+    def __init__(self, maxbytes=256*2**20, path=None):
+        if path is not None:
+            if not os.path.isdir(path):
+                os.makedirs(path, mode=0o700)
+            if os.stat(path).st_uid != os.getuid():
+                raise Exception("Result cache directory '%s' is not owned by the current user" % path)
+        self.maxbytes = maxbytes
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _size(self, table):
+        return sum(table[name].nbytes for name in table.colnames)
+
+    def _file(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, DISK_PREFIX + digest + '.npz')
+
+    def _load(self, key, stamp):
+        """Return the table of the cache file of key if it has the given stamp, or None"""
+        filename = self._file(key)
+        try:
+            if os.stat(filename).st_uid != os.getuid():
+                return None
+        except FileNotFoundError:
+            return None
+        with numpy.load(filename, allow_pickle=False) as arrays:
+            info = json.loads(str(arrays['info']))
+            if info['key'] != repr(key) or info['stamp'] != repr(stamp):
+                return None
+            table = astropy.table.Table(meta=info['meta'])
+            for i, column in enumerate(info['columns']):
+                values = arrays['c%i' % i]
+                if column['datetime']:
+                    values = values.astype(object)
+                if column['masked']:
+                    table[column['name']] = astropy.table.MaskedColumn(values, mask=arrays['m%i' % i])
+                else:
+                    table[column['name']] = values
+        return table
+
+    def _save(self, key, stamp, table):
+        """Write table to the cache file of key, if it can be written without pickle"""
+        arrays = {}
+        columns = []
+        for i, name in enumerate(table.colnames):
+            column = table[name]
+            values = numpy.ma.getdata(column)
+            datetimes = _datetime_column(column)
+            if datetimes:
+                values = numpy.array(values, dtype='datetime64[us]')
+            elif values.dtype.kind not in DISK_KINDS:
+                return
+            masked = getattr(column, 'mask', None) is not None
+            arrays['c%i' % i] = values
+            if masked:
+                arrays['m%i' % i] = numpy.asarray(column.mask)
+            columns.append({'name' : name, 'datetime' : datetimes, 'masked' : masked})
+        try:
+            info = json.dumps({'key' : repr(key), 'stamp' : repr(stamp),
+                               'columns' : columns, 'meta' : dict(table.meta)})
+        except TypeError:
+            return
+        arrays['info'] = numpy.array(info)
+        filename = self._file(key)
+        tmpfile = "%s.%i.%i.tmp" % (filename, os.getpid(), threading.get_ident())
+        with open(tmpfile, 'wb') as fp:
+            numpy.savez(fp, **arrays)
+        os.replace(tmpfile, filename)
+
+    def get(self, key, stamp):
+        """Return the table stored under key with the given stamp, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        if self.path is not None:
+            table = self._load(key, stamp)
+            if table is not None:
+                with self.lock:
+                    self._store(key, stamp, table)
+                    self.disk_hits += 1
+                return table
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, stamp, table):
+        """Store table under key with the given stamp"""
+        with self.lock:
+            self._store(key, stamp, table)
+        if self.path is not None:
+            self._save(key, stamp, table)
+
+    def _store(self, key, stamp, table):
+        """Keep table in memory, evicting the least recently used; called with the lock held"""
+        if key in self.entries:
+            self.nbytes -= self._size(self.entries.pop(key)[1])
+        size = self._size(table)
+        if size > self.maxbytes:
+            return
+        while self.entries and self.nbytes + size > self.maxbytes:
+            old_key, (old_stamp, old_table) = self.entries.popitem(last=False)
+            self.nbytes -= self._size(old_table)
+        self.entries[key] = (stamp, table)
+        self.nbytes += size
+
+    def clear(self):
+        """Forget all entries, including those on disk"""
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.nbytes = 0
+        if self.path is not None:
+            for name in os.listdir(self.path):
+                if name.startswith(DISK_PREFIX) and name.endswith('.npz'):
+                    os.remove(os.path.join(self.path, name))
+
+    def stats(self):
+        """Return a dict of 'hits', 'disk_hits', 'misses', 'size' and 'nbytes'"""
+        with self.lock:
+            return { 'hits'      : self.hits,
+                     'disk_hits' : self.disk_hits,
+                     'misses'    : self.misses,
+                     'size'      : len(self.entries),
+                     'nbytes'    : self.nbytes }
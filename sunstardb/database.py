@@ -1,17 +1,26 @@
 from functools import wraps
+import inspect
+import io
+import math
 import os
 import os.path
 import re
+import warnings
 
 import psycopg2, psycopg2.extras
-import astroquery.simbad
-import astropy.units
-import astropy.coordinates
-import astropy.time
 from sqlhappy import *
 
 from . import utils
 from . import schema
+from . import server
+from .cache import LookupCache, ResultCache
+from .resolver import split_simbad_id, strip_simbad_id, format_simbad_coord, \
+                      lookup_simbad_ids, lookup_simbad_info, SimbadResolver
+
+# Heavy dependencies are imported at first use, so that scripts connect quickly
+numpy = utils.LazyModule('numpy')
+astropy = utils.LazyModule('astropy')
+spatial = utils.LazyModule('sunstardb.spatial')
 
 # Consider all dicts as Json type
 psycopg2.extensions.register_adapter(dict, psycopg2.extras.Json)
@@ -23,132 +32,6 @@ if not os.environ.get('DBCONFIG'):
         os.environ['DBCONFIG'] = config_file
 
 
-# useful globals
-TABLE_TEMPLATES = {}
-
-def _set_templates():
-    """Find the database schema and extract table templates within"""
-    schemafile = schema.file('create.sql')
-    file = open(schemafile)
-    template = None
-    for line in file:
-        line = line.rstrip()
-        if len(line) > 3 and line[0] == '<' and line[-1] == '>' and line[1] != '/': # tag like <NAME>
-            template = line[1:-1] # gets NAME
-            TABLE_TEMPLATES[template] = "" # initialize string
-            continue
-        elif template is not None:
-            if len(line) > 3 and line[0:2] == '</' and line[-1] == '>': # end tag </NAME>
-                template = None
-                continue
-            else:
-                # Add line to saved templates
-                TABLE_TEMPLATES[template] += line + "\n"
-    file.close()
-    if template is not None:
-        raise Exception("Template parsing finished without closing tag '%s'" % template)
-
-def split_simbad_id(simbad_id):
-    """Split a SIMBAD id (e.g. 'HD 1234', 'BD-01 68') into (idtype, id) pair"""
-    idtype, id = re.split(r'[ +-]', simbad_id, 1)
-    idtype = idtype.strip()
-    id = id.strip()
-    return idtype, id
-
-def strip_simbad_id(simbad_id):
-    """Remove superflous prefix from certain SIMBAD ids (NAME, *, **)"""
-    idtype, id = split_simbad_id(simbad_id)
-    if idtype in ['NAME', '*', '**']:
-        return id
-    else:
-        return simbad_id
-
-def lookup_simbad_ids(object_name):
-    """Lookup the given object in Simbad and return a dict of arrays
-    
-    Identifiers returned from SIMBAD have their spaces compressed.
-    For example, 'HD   1845' will be returned as 'HD 1845'.  This is in
-    order to ensure uniform name-matching.
-    """
-
-    table = astroquery.simbad.Simbad.query_objectids(object_name)
-    if table is None:
-        return None
-    names = {}
-    for o in table:
-        simbad_id = utils.compress_space(o[0])
-        idtype, id = split_simbad_id(simbad_id)
-        if idtype not in names:
-            names[idtype] = []
-        names[idtype].append(simbad_id)
-    return names
-
-def lookup_simbad_info(object_name):
-    """Information from Simbad.query_object as a dictionary
-    
-    Input:
-     - object_name <str> : name to lookup in SIMBAD database
-     
-     Output:
-      - info <dict> : information dictionary
-      
-    The info dict contains the following keys:
-     - (everything included by default in astroquery.simbad.Simbad.query_object())
-     - coord : the string ICRS coordinates of the object
-     - skycoord : astropy.coordinates.SkyCoord object
-     - ra : right ascention in decimal degrees
-     - dec : declination in decimal degrees
-
-    The 'main_id' identifier returned from SIMBAD have its spaces
-    compressed.  For example, 'HD 1845' will be returned as 'HD 1845'.
-    This is in order to ensure uniform name-matching.
-    """
-    simbad_info = astroquery.simbad.Simbad.query_object(object_name)
-    if simbad_info is None:
-        return None
-    info_dict = {}
-    for k in list(simbad_info.keys()):
-        # Result is in first (only) row
-        # lowercase keys in result
-        info_dict[k.lower()] = simbad_info[0][k]
-    
-    # Get rid of multiple spaces in Simbad identifier
-    info_dict['main_id'] = utils.compress_space(info_dict['main_id'])
-
-    # Change astroquery numpy string representation of coordinates to something more useful
-    coord = format_simbad_coord(info_dict['ra'], info_dict['dec'])
-    skycoord = astropy.coordinates.SkyCoord(coord, 'icrs',
-                                            unit=(astropy.units.hourangle,
-                                                  astropy.units.degree))
-    info_dict['coord'] = coord
-    info_dict['skycoord'] = skycoord
-    info_dict['ra'] = skycoord.ra.value
-    info_dict['dec'] = skycoord.dec.value
-
-    return info_dict
-
-def format_simbad_coord(ra, dec):
-    """Usually SIMBAD formats ra 'hh mm ss.ss' dec '+dd mm ss.ss'.  This fixes exceptions to that rule..."""
-    result = dict(ra=ra, dec=dec)
-    for k, v in list(result.items()):
-        a = v.split(' ')
-        if len(a) == 3:
-            # this is expected
-            continue
-        elif len(a) == 2: # format was 'dd mm.mm' instead of 'dd mm ss.ss'
-            deg = float(a[0])
-            min = float(a[1])
-            rem = min % 1
-            min = math.floor(min)
-            sec = rem * 60 # * 60 sec / 1 min
-            fix = "%+02i %02i %02.6f" % (deg, min, sec) # TODO: carry over precision?
-            if k == 'ra':
-                fix = fix[1:] # chop off leading sign for ra
-            result[k] = fix
-        else:
-            raise Exception("unexpected format from SIMBAD: ra='%(ra)s' dec='%(dec)s'" % result)
-    return result['ra'] + ' ' + result['dec']
-
 # Some objects; the utility here is for documentation purposes.
 class RowObject:
     def __init__(self, rowdict, exceptions=[]):
@@ -218,13 +101,584 @@ def db_bind_keys(*bind_reqkeys, **bind_kwargs):
         return wrapped_f
     return wrap
 
-class SunStarDB(Database):
+def cached_lookup(table, keymap, index=(('id',),), normalize=None):
+    """
+    Decorator for fetch functions whose results may be kept in the lookup cache.
+
+    'keymap' maps the bind keys used for the lookup to their column
+    names, e.g. {'type_id' : 'id'}; only the bind keys actually given
+    form the cache key.  Found rows are also stored under each column
+    tuple in 'index', so that e.g. a row fetched by name is later found
+    by id.  'normalize' optionally maps bind keys to functions applied
+    to their values before building the key.  Rows not found are not
+    cached.
+
+    Apply below @db_bind_keys(), and only has effect when the
+    SunStarDB lookup cache is enabled.
+    """
+    def key_of(pairs):
+        return tuple(sorted(pairs))
+
+    def wrap(f):
+        @wraps(f)
+        def wrapped_f(self, **kwargs):
+            cache = self.lookup_cache
+            if cache is None:
+                return f(self, **kwargs)
+            pairs = []
+            for bind, col in list(keymap.items()):
+                if bind in kwargs:
+                    value = kwargs[bind]
+                    if normalize and bind in normalize:
+                        value = normalize[bind](value)
+                    pairs.append((col, value))
+            key = key_of(pairs)
+            row = cache.get(table, key)
+            if row is None:
+                row = f(self, **kwargs)
+                if row is not None:
+                    keys = [key] + [ key_of((col, row[col]) for col in cols) for cols in index ]
+                    cache.put(table, keys, row)
+            return row
+        return wrapped_f
+    return wrap
+
+def invalidates(*tables):
+    """
+    Decorator for functions which change the given tables, clearing
+    their rows from the lookup cache.
+    """
+    def wrap(f):
+        @wraps(f)
+        def wrapped_f(self, *args, **kwargs):
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                if self.lookup_cache is not None:
+                    for table in tables:
+                        self.lookup_cache.invalidate(table)
+        return wrapped_f
+    return wrap
+
+def cached_result(stamp):
+    """
+    Decorator for fetch functions returning tables which may be kept in
+    the result cache.
+
+    'stamp' names the SunStarSQL builder of the version stamp query,
+    which is called with the arguments of the fetch function and must
+    return a single row that changes whenever the result would.  The
+    row must include a 'txid' column, txid_current_if_assigned(): the
+    cache is bypassed while the current transaction has written
+    anything, as timestamps of uncommitted rows do not change between
+    statements.  Cached tables are returned as copies.
+
+    Only has effect when the SunStarDB result cache is enabled.
+    """
+    def wrap(f):
+        signature = inspect.signature(f)
+        @wraps(f)
+        def wrapped_f(self, *args, **kwargs):
+            cache = self.result_cache
+            if cache is None:
+                return f(self, *args, **kwargs)
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(list(bound.arguments.items())[1:]) # all but self
+            sql, binds = getattr(self, stamp)(**arguments)
+            row = self.fetch_row(sql, binds)
+            if row['txid'] is not None:
+                return f(self, *args, **kwargs)
+            key = (f.__name__, repr(sorted(arguments.items())))
+            version = tuple(row)
+            table = cache.get(key, version)
+            if table is None:
+                table = f(self, *args, **kwargs)
+                cache.put(key, version, table)
+            return table.copy()
+        return wrapped_f
+    return wrap
+
+class SunStarSQL(object):
+    """SQL builders shared by the SunStarDB query methods
+
+    Each builder returns the SQL and bind parameters for one query, so
+    that the blocking SunStarDB methods and the asyncio methods of
+    aio.AsyncSunStarDB run exactly the same queries.
+    """
+
+    FETCHALL_TABLES = ('datatype', 'instrument', 'origin', 'source', 'dataset')
+
+    def _fetchall_sql(self, table):
+        """SQL fetching all rows of one of the small reference tables"""
+        if table not in self.FETCHALL_TABLES:
+            raise Exception("unexpected table '%s'" % table)
+        return "SELECT * FROM %s" % table
+
+    def _fetch_data_sql(self, datatype):
+        """SQL for fetch_data() and iter_data()"""
+        sql = """SELECT s.name star, r.name reference, o.name origin, o.kind origin_kind, i.name instrument,
+                        d.%(datatype)s "%(datatype)s", d.errhi, d.errlo
+                   FROM dat_%(datatype)s d
+                   JOIN property p ON p.id = d.property
+                   JOIN star s ON s.id = p.star
+                   JOIN reference r ON r.id = p.reference
+                   JOIN source src ON src.id = p.source
+                   JOIN origin o ON o.id = src.origin
+                   LEFT JOIN instrument i ON i.id = p.instrument"""
+        return sql % {'datatype' : schema.check_datatype_name(datatype)}
+
+    def _fetch_star_sql(self, name):
+        sql = """SELECT s.*
+                   FROM star s
+                   JOIN star_alias sa ON sa.star = s.id
+                  WHERE sa.lookup = %(lookup)s"""
+        return sql, {'lookup' : utils.normalize_star_name(name)}
+
+    def _fetchall_star_aliases_sql(self, name):
+        sql = """SELECT sa.type, sa.name
+                   FROM star_alias sa
+                   JOIN star_alias q ON q.star = sa.star
+                  WHERE q.lookup = %(lookup)s"""
+        return sql, {'lookup' : utils.normalize_star_name(name)}
+
+    def _fetch_data_table_sql(self, dataset, datatypes, meta=None, nulls=True, errors=False):
+        # XXX TODO: protect against using timeseries data types here,
+        #           or, provide subqueries which turn timeseries into scalars
+        ixs = list(range(len(datatypes)))
+
+        # Define source sub-tables
+        sql = "WITH "
+        for i in ixs:
+            dtype = datatypes[i]
+            dcols = 'd.*'
+            if meta and dtype in meta:
+                # listify a simple string value
+                if isinstance(meta[dtype], str):
+                    meta[dtype] = [ meta[dtype] ]
+                for metacol in meta[dtype]:
+                    dcols += ", d.meta->>'%s' \"%s\"" % (metacol, metacol)
+            sql += """d%02i AS (
+                        SELECT %s FROM dat_%s d
+                          JOIN dataset_map dm ON dm.property = d.property
+                          JOIN dataset ds ON ds.id = dm.dataset
+                         WHERE ds.name = %%(dataset)s ),
+            """ % (i, dcols, datatypes[i])
+        sql += "uq_stars AS ( "
+        sql += " UNION ".join( "SELECT star FROM d%02i" % i for i in ixs)
+
+        # Output columns
+        # TODO: "errors" assumes all columns are MEASURE types... check datatype table instead
+        sql += ") SELECT s.name star, "
+        col_pattern = "d%(index)02i.%(name)s \"%(name)s\"" # preserve case in output columns
+        if errors:
+            col_pattern += ", d%(index)02i.errlo \"errlo_%(name)s\", d%(index)02i.errhi \"errhi_%(name)s\""
+        sql += ", ".join( col_pattern % dict(index=i, name=datatypes[i]) for i in ixs )
+        if meta:
+            for dtype in meta:
+                i = datatypes.index(dtype)
+                for metacol in meta[dtype]:
+                    sql += ", d%(index)02i.\"%(name)s\" \"%(name)s\"" % dict(index=i, name=metacol)
+
+        # Source sub-tables
+        sql += " FROM uq_stars us JOIN star s ON s.id = us.star"
+        if nulls is True:
+            jointype = "LEFT JOIN"
+        else:
+            jointype = "JOIN"
+            
+        for i in ixs:
+            sql += " %s d%02i ON d%02i.star = s.id" % (jointype, i, i)
+
+        return sql, { 'dataset' : dataset }
+
+    def _dataset_cache_sql(self, datatypes):
+        """SQL selecting the wide table of a dataset, see SunStarDB.create_dataset_cache()
+
+        'datatypes' are datatype rows (name, struct) of MEASURE or LABEL
+        type.  The dataset id is bound as %(dataset)s.
+        """
+        ixs = list(range(len(datatypes)))
+        sql = "WITH "
+        for i in ixs:
+            sql += """d%02i AS (
+                        SELECT d.* FROM dat_%s d
+                          JOIN dataset_map dm ON dm.property = d.property
+                         WHERE dm.dataset = %%(dataset)s ),
+            """ % (i, datatypes[i]['name'])
+        sql += "uq_stars AS ( "
+        sql += " UNION ".join( "SELECT star FROM d%02i" % i for i in ixs)
+        sql += ") SELECT s.id star_id, s.name star"
+        for i in ixs:
+            cols = dict(index=i, name=datatypes[i]['name'])
+            sql += ", d%(index)02i.%(name)s \"%(name)s\"" % cols
+            if datatypes[i]['struct'] == 'MEASURE':
+                sql += ", d%(index)02i.errlo \"errlo_%(name)s\", d%(index)02i.errhi \"errhi_%(name)s\"" % cols
+            sql += ", d%(index)02i.meta \"meta_%(name)s\"" % cols
+        sql += " FROM uq_stars us JOIN star s ON s.id = us.star"
+        for i in ixs:
+            sql += " LEFT JOIN d%02i ON d%02i.star = s.id" % (i, i)
+        return sql
+
+    def _fetch_data_table_cache_sql(self, view, datatypes, meta=None, nulls=True, errors=False):
+        """Same query as _fetch_data_table_sql(), from the materialized cache 'view'"""
+        col_pattern = "\"%(name)s\""
+        if errors:
+            col_pattern += ", \"errlo_%(name)s\", \"errhi_%(name)s\""
+        sql = "SELECT star, "
+        sql += ", ".join( col_pattern % dict(name=dtype) for dtype in datatypes )
+        if meta:
+            for dtype in meta:
+                # listify a simple string value
+                if isinstance(meta[dtype], str):
+                    meta[dtype] = [ meta[dtype] ]
+                for metacol in meta[dtype]:
+                    sql += ", \"meta_%s\"->>'%s' \"%s\"" % (dtype, metacol, metacol)
+        sql += " FROM %s" % view
+        # stars having any (nulls) or all (not nulls) of the datatypes; values are never null
+        op = " OR " if nulls is True else " AND "
+        sql += " WHERE " + op.join( "\"%s\" IS NOT NULL" % dtype for dtype in datatypes )
+        return sql, {}
+
+    def _fetch_data_table_stamp_sql(self, dataset, **kwargs):
+        """Version stamp of fetch_data_table(), see cached_result()"""
+        sql = """SELECT max(ds.id) dataset, max(ds.insert_time) insert_time,
+                        count(p.id) properties, max(p.insert_time) property_time,
+                        txid_current_if_assigned() txid
+                   FROM dataset ds
+                   LEFT JOIN dataset_map dm ON dm.dataset = ds.id
+                   LEFT JOIN property p ON p.id = dm.property
+                  WHERE ds.name = %(dataset)s"""
+        return sql, { 'dataset' : dataset }
+
+    def _fetch_timeseries_stamp_sql(self, datatype, star, source=None, **kwargs):
+        """Version stamp of fetch_timeseries(), see cached_result()"""
+        sql = """SELECT array_agg(ts.id ORDER BY ts.id) timeseries, max(ts.append_time) append_time,
+                        txid_current_if_assigned() txid
+                   FROM timeseries ts
+                   JOIN datatype dt ON dt.id = ts.type
+                   JOIN star_alias sa ON sa.star = ts.star\n"""
+        if source is not None:
+            sql += "JOIN source src ON src.id = ts.source"
+        sql += " WHERE dt.name = %(datatype)s AND sa.lookup = %(lookup)s"
+        binds = {'datatype' : datatype, 'lookup' : utils.normalize_star_name(star)}
+        if source is not None:
+            sql += " AND src.name = %(source)s"
+            binds['source'] = source
+        return sql, binds
+
+    def _conematch_sql(self, dataset, radius):
+        """SQL matching the uploaded targets to stars of dataset within radius (degrees)"""
+        sql = """SELECT t.idx, s.name, s.ra, s.dec, q3c_dist(t.ra, t.dec, s.ra, s.dec) sep
+                   FROM crossmatch_target t
+                   JOIN star s ON q3c_join(t.ra, t.dec, s.ra, s.dec, %(radius)s)
+                  WHERE EXISTS (SELECT 1
+                                  FROM dataset_map dm
+                                  JOIN dataset ds ON ds.id = dm.dataset
+                                 WHERE ds.name = %(dataset)s
+                                   AND dm.star = s.id)
+                  ORDER BY t.idx, sep"""
+        return sql, { 'dataset' : dataset, 'radius' : radius }
+
+    def _boxmatch_bulk_sql(self, dataset, ra_side, dec_side=None, orient='center'):
+        """SQL matching the uploaded targets to stars of dataset in boxes, see fetch_boxmatch()
+
+        Candidates are found with q3c_join() within the circle enclosing
+        the box, then tested with the same q3c_poly_query() box as
+        fetch_boxmatch().
+        """
+        if dec_side is None:
+            dec_side = ra_side
+        if orient != 'center':
+            raise Exception("invalid orientation '%s'" % orient)
+        sql = """SELECT t.idx, s.name, s.ra, s.dec, q3c_dist(t.ra, t.dec, s.ra, s.dec) sep
+                   FROM crossmatch_target t
+                   JOIN star s ON q3c_join(t.ra, t.dec, s.ra, s.dec, %(radius)s)
+                  WHERE q3c_poly_query(s.ra, s.dec,
+                                       ARRAY[t.ra + %(ra_half)s, t.dec + %(dec_half)s,
+                                             t.ra + %(ra_half)s, t.dec - %(dec_half)s,
+                                             t.ra - %(ra_half)s, t.dec - %(dec_half)s,
+                                             t.ra - %(ra_half)s, t.dec + %(dec_half)s])
+                    AND EXISTS (SELECT 1
+                                  FROM dataset_map dm
+                                  JOIN dataset ds ON ds.id = dm.dataset
+                                 WHERE ds.name = %(dataset)s
+                                   AND dm.star = s.id)
+                  ORDER BY t.idx, sep"""
+        binds = { 'dataset'  : dataset,
+                  'ra_half'  : ra_side/2.0,
+                  'dec_half' : dec_side/2.0,
+                  'radius'   : math.hypot(ra_side/2.0, dec_side/2.0) }
+        return sql, binds
+
+    # Downsampling modes of fetch_timeseries()
+    TIMESERIES_MODES = ('bin', 'lttb')
+
+    def _fetch_timeseries_sql(self, datatype, star, source=None, start=None, end=None,
+                              points=None, mode='bin'):
+        """SQL of fetch_timeseries(), returns (sql, binds, dtype)
+
+        Without 'points' all points of the window are selected.  In
+        'bin' mode the window is split into 'points' intervals of equal
+        width, aggregated to (obs_time, mean, min, max, n).  In 'lttb'
+        mode the first, last, lowest and highest point of each of
+        'points' intervals are selected, for _downsample_timeseries().
+        """
+        if points is not None and mode not in self.TIMESERIES_MODES:
+            raise Exception("invalid timeseries mode '%s'" % mode)
+        name = schema.check_datatype_name(datatype)
+        sql = """SELECT obs_time, %(name)s \"%(name)s\", errlo, errhi
+                 FROM dat_%(name)s d
+                 JOIN star_alias sa ON sa.star = d.star\n""" % dict(name=name)
+        if source is not None:
+            sql += "JOIN source src ON src.id = d.source"
+        where = "sa.lookup = %(lookup)s"
+        binds = {'lookup':utils.normalize_star_name(star)}
+        if source is not None:
+            where += " AND src.name = %(source)s"
+            binds['source'] = source
+        # Compared to obs_time itself, so that only the partitions of the window are read
+        if start is not None:
+            where += " AND d.obs_time >= %(start)s"
+            binds['start'] = self._timeseries_time(start)
+        if end is not None:
+            where += " AND d.obs_time < %(end)s"
+            binds['end'] = self._timeseries_time(end)
+        sql += " WHERE " + where
+        if points is None:
+            return sql + " ORDER BY obs_time", binds, ('object', 'f', 'f', 'f')
+
+        # Interval of each point: 1 to 'points' between the window limits, or the series limits
+        binds['points'] = int(points)
+        binds.setdefault('start', None)
+        binds.setdefault('end', None)
+        sql = """WITH d AS (%s),
+                      r AS (SELECT extract(epoch FROM coalesce(%%(start)s::timestamp, min(obs_time))) lo,
+                                   extract(epoch FROM coalesce(%%(end)s::timestamp, max(obs_time))) hi
+                              FROM d),
+                      b AS (SELECT d.*,
+                                   CASE WHEN r.hi > r.lo
+                                        THEN least(width_bucket(extract(epoch FROM d.obs_time), r.lo, r.hi,
+                                                                %%(points)s), %%(points)s)
+                                        ELSE 1 END bucket
+                              FROM d, r)\n""" % sql
+        if mode == 'bin':
+            sql += """SELECT to_timestamp(avg(extract(epoch FROM obs_time))) AT TIME ZONE 'UTC' obs_time,
+                             avg(\"%(name)s\") \"%(name)s\", min(\"%(name)s\") \"min_%(name)s\",
+                             max(\"%(name)s\") \"max_%(name)s\", count(*) n
+                        FROM b
+                       GROUP BY bucket
+                       ORDER BY obs_time""" % dict(name=name)
+            return sql, binds, ('object', 'f', 'f', 'f', 'i8')
+        sql += """SELECT obs_time, \"%(name)s\", errlo, errhi
+                    FROM (SELECT b.*,
+                                 row_number() OVER (PARTITION BY bucket ORDER BY obs_time) r_first,
+                                 row_number() OVER (PARTITION BY bucket ORDER BY obs_time DESC) r_last,
+                                 row_number() OVER (PARTITION BY bucket ORDER BY \"%(name)s\", obs_time) r_min,
+                                 row_number() OVER (PARTITION BY bucket ORDER BY \"%(name)s\" DESC, obs_time) r_max
+                            FROM b) e
+                   WHERE 1 IN (r_first, r_last, r_min, r_max)
+                   ORDER BY obs_time""" % dict(name=name)
+        return sql, binds, ('object', 'f', 'f', 'f')
+
+    def _timeseries_time(self, t):
+        """Bind value of a time window limit; astropy Time is converted to TCB like obs_time"""
+        if hasattr(t, 'tcb'):
+            return t.tcb.datetime
+        return t
+
+    def _downsample_timeseries(self, table, datatype, points=None, mode='bin'):
+        """Reduce the rows selected in 'lttb' mode to at most 'points', see utils.lttb()"""
+        if table is None or points is None or mode != 'lttb':
+            return table
+        x = numpy.array(table['obs_time'], dtype='datetime64[us]').astype('f8')
+        return table[utils.lttb(x, table[datatype], int(points))]
+
+    def _fetch_boxmatch_sql(self, dataset, skycoord, ra_side, dec_side=None, orient='center'):
+        if dec_side is None:
+            dec_side = ra_side
+
+        if orient == 'center':
+            box = { 'ra_min' : skycoord.ra.degree - ra_side/2.0,
+                    'ra_max' : skycoord.ra.degree + ra_side/2.0,
+                    'dec_min' : skycoord.dec.degree - dec_side/2.0,
+                    'dec_max' : skycoord.dec.degree + dec_side/2.0 }
+        else:
+            raise Exception("invalid orientation '%s'" % orient)
+        
+        sql = """SELECT DISTINCT s.name, s.ra, s.dec
+                   FROM dataset ds
+                   JOIN dataset_map dm ON dm.dataset = ds.id
+                   JOIN star s ON s.id = dm.star
+                  WHERE ds.name = %(dataset)s
+                    AND q3c_poly_query(s.ra, s.dec,
+                                      '{%(ra_max)s, %(dec_max)s,
+                                       %(ra_max)s, %(dec_min)s,
+                                       %(ra_min)s, %(dec_min)s,
+                                       %(ra_min)s, %(dec_max)s}')"""
+        return sql, dict(list({'dataset':dataset}.items()) + list(box.items()))
+
+class SunStarDB(SunStarSQL, Database):
     """Class providing access to the solar-stellar database"""
+    def __init__(self, *args, **kwargs):
+        """Connect to the database, see sqlhappy.Database
+
+        Additional input:
+         - cache <bool>          : enable the lookup cache, see enable_cache()
+         - resolver <Resolver>   : star name resolver used by insert_star(),
+                                   default resolver.SimbadResolver
+         - dataset_cache <bool>  : use and maintain the materialized
+                                   dataset caches, see create_dataset_cache()
+        """
+        cache = kwargs.pop('cache', False)
+        self.result_cache = None
+        self.star_index = None
+        self.dataset_cache = kwargs.pop('dataset_cache', False)
+        self._has_dataset_caches = None
+        self.lookup_cache = None
+        self.persistent = False
+        self._timeseries_partitions = {}
+        self.resolver = kwargs.pop('resolver', None) or SimbadResolver()
+        Database.__init__(self, *args, **kwargs)
+        if cache:
+            self.enable_cache()
+
+    def enable_cache(self):
+        """Enable the in-process lookup cache
+
+        Datatypes, instruments, stars, references, origins, and sources
+        fetched by name or id are kept in memory and are not fetched
+        from the database again until they are invalidated by an
+        insert_*, drop_datatype, or delete_source call, or a rollback().
+        Stars are only invalidated by rollback(), since inserting a star
+        does not change existing aliases.
+        """
+        if self.lookup_cache is None:
+            self.lookup_cache = LookupCache()
+        return self.lookup_cache
+
+    def disable_cache(self):
+        """Disable the lookup cache and forget its contents"""
+        self.lookup_cache = None
+
+    def cache_stats(self):
+        """Lookup cache hit/miss counters; see cache.LookupCache.stats()"""
+        if self.lookup_cache is None:
+            return {}
+        return self.lookup_cache.stats()
+
+    def enable_result_cache(self, maxbytes=256*2**20, path=None):
+        """Enable the cache of fetch_data_table() and fetch_timeseries() results
+
+        Result tables are kept in memory, up to 'maxbytes' of column
+        data, and also in the directory 'path' if given.  Before using
+        an entry a cheap version stamp of the dataset or timeseries is
+        fetched (latest insert/append time and row ids), so entries
+        made stale by new data are detected; see cache.ResultCache.
+        """
+        if self.result_cache is None:
+            self.result_cache = ResultCache(maxbytes=maxbytes, path=path)
+        return self.result_cache
+
+    def disable_result_cache(self):
+        """Disable the result cache and forget its in-memory contents"""
+        self.result_cache = None
+
+    def result_cache_stats(self):
+        """Result cache counters; see cache.ResultCache.stats()"""
+        if self.result_cache is None:
+            return {}
+        return self.result_cache.stats()
+
+    def enable_star_index(self, dataset=None):
+        """Load an in-process spatial index of the stars, see spatial.StarIndex
+
+        The index holds all stars, or only those of dataset.  Stars
+        inserted by insert_star() are added to the index of all stars.
+        rollback() marks the index stale, and it is reloaded by the next
+        search using it.  While enabled, fetch_boxmatch() and
+        fetch_conematch() search the index instead of the database, when
+        it holds all stars or those of the searched dataset.
+        """
+        self.star_index = spatial.StarIndex.from_db(self, dataset=dataset)
+        return self.star_index
+
+    def _searchable_star_index(self, dataset):
+        """Return the star index if it can search dataset, reloading it if stale, or None"""
+        index = self.star_index
+        if index is None or index.dataset not in (None, dataset):
+            return None
+        if index.stale:
+            index.refresh(self)
+        return index
+
+    def _star_index_matches(self, index, dataset, matches):
+        """Restrict the matches of the star index to dataset, as the columns of the SQL searches"""
+        if index.dataset is None:
+            sql = """SELECT dm.star
+                       FROM dataset_map dm
+                       JOIN dataset ds ON ds.id = dm.dataset
+                      WHERE ds.name = %(dataset)s"""
+            members = self.fetchall(sql, {'dataset':dataset}) or []
+            stars = numpy.array([ row[0] for row in members ], dtype='i8')
+            matches = matches[numpy.isin(matches['id'], stars)]
+        matches.remove_column('id')
+        return matches
+
+    def disable_star_index(self):
+        """Forget the spatial index of the stars"""
+        self.star_index = None
+
+    def commit(self):
+        """Commit the current transaction, forgetting its timeseries partitions
+
+        The partitions are forgotten even if the commit fails, as the
+        ones created by the transaction are then rolled back.
+        """
+        self._timeseries_partitions = {}
+        Database.commit(self)
+
+    def rollback(self):
+        """Rollback the current transaction, clearing the lookup cache"""
+        Database.rollback(self)
+        self._timeseries_partitions = {}
+        if self.lookup_cache is not None:
+            self.lookup_cache.invalidate()
+        if self.star_index is not None:
+            self.star_index.stale = True
+
+    def close(self):
+        """Close the connection, unless it is the persistent connection of a server
+
+        Scripts run by a server (see server.py) end with close(), which
+        then does nothing; the server ends the transaction itself.
+        """
+        if self.persistent:
+            return
+        Database.close(self)
+
     @staticmethod
     def cli_connect(arguments=None):
-        """For scripts, connect using command line arguments"""
+        """For scripts, connect using command line arguments
+
+        If the SUNSTARDB_SOCKET environment variable names the socket
+        of a running server (bin/sunstardb_server.py), the script is
+        run by the server with its persistent connection and caches,
+        and this process exits with the status of the script.
+        """
+        db = server.serving_db()
+        socket_path = os.environ.get(server.SOCKET_ENV)
+        if db is None and socket_path:
+            try:
+                sock = server.connect(socket_path)
+            except OSError:
+                sock = None # no server, connect directly
+            if sock is not None:
+                sys.exit(server.run_remote(sock, sys.argv[0], sys.argv[1:]))
         parser = db_argparser(arguments=arguments)
         args = parser.parse_args()
+        if db is not None:
+            return args, db
         db_params = db_kwargs(args)
         print("Connecting to database...", end=' ')
         db = SunStarDB(**db_params)
@@ -232,6 +686,7 @@ class SunStarDB(Database):
         return args, db
 
     @db_bind_keys('name')
+    @cached_lookup('datatype', {'name' : 'name'}, index=(('id',), ('name',)))
     def fetch_datatype(self, **kwargs):
         """Fetch a datatype given its (name)"""
         sql = "SELECT * FROM datatype WHERE name=%(name)s"
@@ -240,34 +695,86 @@ class SunStarDB(Database):
 
     def fetchall_datatypes(self, **kwargs):
         """Fetch all existing datatypes from the database"""
-        sql = "SELECT * FROM datatype"
-        return self.fetchall_astropy(sql)
+        return self.fetchall_astropy(self._fetchall_sql('datatype'))
 
     @db_bind_keys('type_id')
+    @cached_lookup('datatype', {'type_id' : 'id'}, index=(('id',), ('name',)))
     def fetch_datatype_by_id(self, **kwargs):
         """Fetch a datatype given its ID (type_id)"""
         sql = "SELECT * FROM datatype WHERE id=%(type_id)s"
         db_datatype = self.fetch_row(sql, kwargs)
         return db_datatype
 
-    @db_bind_keys('name', 'struct', 'units', 'description')
+    @db_bind_keys('name', 'struct', 'units', 'description', optional=['partitioned'])
+    @invalidates('datatype')
     def insert_datatype(self, **kwargs):
-        """Insert a datatype given (name, type, units, description)"""
-        # Prepare the DDL schema templates if it has not already been done
-        if not TABLE_TEMPLATES:
-            _set_templates()
+        """Insert a datatype given (name, type, units, description)
+
+        With 'partitioned' true, the dat_<name> table of a TIMESERIES is
+        partitioned by decade of obs_time, see ensure_timeseries_partitions().
+        """
+        self._check_new_datatype(kwargs)
         sql = """INSERT INTO datatype (name, struct, units, description)
                       VALUES (%(name)s, %(struct)s, %(units)s, %(description)s)"""
         self.execute(sql, kwargs)
         datatype = self.fetch_datatype(kwargs)
-        template = TABLE_TEMPLATES[datatype['struct']]
-        create_ddl = template % datatype # Set %(name) and %(id) in table creation DDL
-        self.execute(create_ddl)
+        # Set %(name) and %(id) in table creation DDL
+        self.execute(schema.datatype_ddl(datatype, partitioned=kwargs['partitioned']))
         return datatype
-        
+
+    def _check_new_datatype(self, datatype):
+        """Raise an Exception if the dat_ table of a new datatype can not be created"""
+        schema.check_datatype_name(datatype['name'])
+        if datatype.get('partitioned') and datatype['struct'] != 'TIMESERIES':
+            raise Exception("datatype '%(name)s': only TIMESERIES datatypes can be partitioned" % datatype)
+
+    @invalidates('datatype')
+    def insert_datatypes(self, datatypes):
+        """Insert many datatypes, given as dicts of (name, struct, units, description)
+
+        Output:
+         - <list> : the inserted datatype rows, in the given order
+
+        All names are checked before anything is inserted.  The datatype
+        rows are inserted by one multi-row statement, and all dat_
+        tables are created by a second one.
+        """
+        missing = [ k for k in ('name', 'struct', 'units', 'description')
+                    if any(k not in t for t in datatypes) ]
+        if missing:
+            raise DatabaseKeyError(missing, sorted(set(k for t in datatypes for k in t)))
+        for t in datatypes:
+            self._check_new_datatype(t)
+        if not datatypes:
+            return []
+        sql = """INSERT INTO datatype (name, struct, units, description)
+                      VALUES %s RETURNING *"""
+        rows = self.execute_values(sql, [ dict(t) for t in datatypes ],
+                                   template="(%(name)s, %(struct)s, %(units)s, %(description)s)",
+                                   fetch=True)
+        # RETURNING order is not guaranteed to follow the VALUES list
+        by_name = dict((row['name'], row) for row in rows)
+        inserted = [ by_name[t['name']] for t in datatypes ]
+        self.execute("".join(schema.datatype_ddl(row, partitioned=t.get('partitioned'))
+                             for row, t in zip(inserted, datatypes)))
+        return inserted
+
     @db_bind_keys('name')
+    @invalidates('datatype')
     def drop_datatype(self, **kwargs):
-        """Remove a datatype given its (name)"""
+        """Remove a datatype given its (name)
+
+        Dataset caches holding the datatype are rebuilt without it.
+        """
+        sql = """SELECT ds.name
+                   FROM dataset_cache dc
+                   JOIN dataset ds ON ds.id = dc.dataset
+                  WHERE %(name)s = ANY(dc.datatypes)"""
+        cached = []
+        if self.has_dataset_caches():
+            cached = self.fetch_column(sql, kwargs) or []
+        for dataset in cached:
+            self.drop_dataset_cache(name=dataset)
         self.execute("""DELETE FROM dataset_map WHERE type IN
                         (SELECT id FROM datatype WHERE name = %(name)s)""", kwargs)
         self.execute("""DELETE FROM property WHERE type IN
@@ -275,9 +782,13 @@ class SunStarDB(Database):
         self.execute("""DELETE FROM timeseries WHERE type IN
                         (SELECT id FROM datatype WHERE name = %(name)s)""", kwargs)
         self.execute("DELETE FROM datatype WHERE name = %(name)s", kwargs)
-        self.execute("DROP TABLE dat_%(name)s" % kwargs) # TODO: check arg
+        self.execute("DROP TABLE dat_%s" % schema.check_datatype_name(kwargs['name']))
+        self._timeseries_partitions.pop(kwargs['name'], None)
+        for dataset in cached:
+            self.create_dataset_cache(name=dataset)
 
     @db_bind_keys('name')
+    @cached_lookup('instrument', {'name' : 'name'}, index=(('id',), ('name',)))
     def fetch_instrument(self, **kwargs):
         """Fetch an instrument give its (name)"""
         sql = "SELECT * FROM instrument WHERE name=%(name)s"
@@ -285,6 +796,7 @@ class SunStarDB(Database):
         return db_instrument
 
     @db_bind_keys('name', 'long', 'url', 'description')
+    @invalidates('instrument')
     def insert_instrument(self, **kwargs):
         """Insert an instrument given (name, long, url, description)"""
         sql = """INSERT INTO instrument (name, long, url, description)
@@ -294,19 +806,42 @@ class SunStarDB(Database):
 
     def fetchall_instruments(self):
         """Fetch all existing instruments from the database"""
-        sql = """SELECT * FROM instrument"""
-        return self.fetchall_astropy(sql)
+        return self.fetchall_astropy(self._fetchall_sql('instrument'))
 
     @db_bind_keys('name')
+    @cached_lookup('star', {'name' : 'alias'}, normalize={'name' : utils.normalize_star_name})
     def fetch_star(self, **kwargs):
         """Fetch a star given (name), which may be any alias
         """
-        sql = """SELECT s.*
+        sql, binds = self._fetch_star_sql(kwargs['name'])
+        db_star = self.fetch_row(sql, binds, prepared=True)
+        return db_star
+
+    def fetch_stars(self, names):
+        """Fetch many stars given a list of names, which may be any alias
+
+        Output:
+         - <dict> : { name : star }, with star None for unknown names
+
+        All names are resolved with a single query.  Found stars are
+        added to the lookup cache, if enabled.
+        """
+        lookups = dict((name, utils.normalize_star_name(name)) for name in names)
+        if not lookups:
+            return {}
+        sql = """SELECT sa.lookup, s.*
                    FROM star s
                    JOIN star_alias sa ON sa.star = s.id
-                  WHERE replace(sa.name, ' ', '') = replace(%(name)s, ' ', '')"""
-        db_star = self.fetch_row(sql, kwargs)
-        return db_star
+                  WHERE sa.lookup = ANY(%(lookups)s)"""
+        rows = self.fetchall(sql, {'lookups' : list(set(lookups.values()))}) or []
+        stars = {}
+        for row in rows:
+            star = dict(row)
+            lookup = star.pop('lookup')
+            stars[lookup] = star
+            if self.lookup_cache is not None:
+                self.lookup_cache.put('star', [(('alias', lookup),), (('id', star['id']),)], star)
+        return dict((name, stars.get(lookup)) for name, lookup in list(lookups.items()))
 
     @db_bind_keys('name', 'type')
     def fetch_star_alias(self, **kwargs):
@@ -314,29 +849,19 @@ class SunStarDB(Database):
         """
         sql = """SELECT sa.name
                    FROM star_alias sa
+                   JOIN star_alias q ON q.star = sa.star
                   WHERE sa.type = %(type)s
-                    AND sa.star = (
-                        SELECT s.id
-                          FROM star s
-                          JOIN star_alias sa ON sa.star = s.id
-                         WHERE replace(sa.name, ' ', '') = replace(%(name)s, ' ', '')
-                        )"""
-        db_star = self.fetch_scalar(sql, kwargs)
+                    AND q.lookup = %(lookup)s"""
+        db_star = self.fetch_scalar(sql, {'type' : kwargs['type'],
+                                          'lookup' : utils.normalize_star_name(kwargs['name'])})
         return db_star
 
     @db_bind_keys('name')
     def fetchall_star_aliases(self, **kwargs):
         """Fetch all star aliases, using (name) which may be any alias
         """
-        sql = """SELECT sa.type, sa.name
-                   FROM star_alias sa
-                  WHERE sa.star = (
-                        SELECT s.id
-                          FROM star s
-                          JOIN star_alias sa ON sa.star = s.id
-                         WHERE replace(sa.name, ' ', '') = replace(%(name)s, ' ', '')
-                        )"""
-        star_aliases = self.fetchall(sql, kwargs)
+        sql, binds = self._fetchall_star_aliases_sql(kwargs['name'])
+        star_aliases = self.fetchall(sql, binds)
         return star_aliases
 
     @db_bind_keys('name')
@@ -385,8 +910,7 @@ class SunStarDB(Database):
     def insert_star(self, **kwargs):
         """Insert a star given (name), pulling additional info from SIMBAD."""
         star = kwargs['name']
-        simbad_ids = lookup_simbad_ids(star)
-        simbad_info = lookup_simbad_info(star)
+        simbad_ids, simbad_info = self.resolver.resolve(star)
         if simbad_ids is None:
             if star == 'Sun':
                 # The Sun is not in SIMBAD, make exception to allow it to be inserted into database
@@ -404,22 +928,28 @@ class SunStarDB(Database):
         db_star = self.fetch_star_by_main_id(name=simbad_info['main_id'])
         
         # Insert the rest of the names found in SIMBAD
-        sql = """INSERT INTO star_alias (star, type, name)
-                      VALUES (%(star_id)s, %(type)s, %(name)s)"""
+        sql = "INSERT INTO star_alias (star, type, name, lookup) VALUES %s"
+        aliases = []
         for idtype, namelist in list(simbad_ids.items()):
             for name in namelist:
-                self.execute(sql, {'star_id':db_star['id'],
-                                   'type':idtype,
-                                   'name':name})
+                aliases.append({'star_id':db_star['id'],
+                                'type':idtype,
+                                'name':name,
+                                'lookup':utils.normalize_star_name(name)})
+        self.execute_values(sql, aliases, template="(%(star_id)s, %(type)s, %(name)s, %(lookup)s)")
+        if self.star_index is not None and self.star_index.dataset is None and not self.star_index.stale:
+            self.star_index.add(db_star['id'], db_star['name'], db_star['ra'], db_star['dec'])
         return db_star
 
     @db_bind_keys('name')
+    @cached_lookup('reference', {'name' : 'name'}, index=(('id',), ('name',)))
     def fetch_reference(self, **kwargs):
         """Fetch a reference given (name)"""
         sql = """SELECT * FROM reference WHERE name=%(name)s"""
         return self.fetch_row(sql, kwargs)
 
     @db_bind_keys('name', 'bibline', 'bibcode')
+    @invalidates('reference')
     def insert_reference(self, **kwargs):
         """Insert a reference given (name, bibline, bibcode)"""
         sql = """INSERT INTO reference (name, bibline, bibcode)
@@ -428,12 +958,14 @@ class SunStarDB(Database):
         return self.fetch_reference(kwargs)
 
     @db_bind_keys('name')
+    @cached_lookup('origin', {'name' : 'name'}, index=(('id',), ('name',)))
     def fetch_origin(self, **kwargs):
         """Fetch an origin given (name)"""
         sql = """SELECT * FROM origin WHERE name=%(name)s"""
         return self.fetch_row(sql, kwargs)
 
     @db_bind_keys('name', 'kind', 'description', optional=['url'])
+    @invalidates('origin')
     def insert_origin(self, **kwargs):
         """Insert an origin given (name, kind, url, description)"""
         sql = """INSERT INTO origin (name, kind, url, description)
@@ -443,10 +975,10 @@ class SunStarDB(Database):
 
     def fetchall_origins(self):
         """Fetch all existing origins in the database"""
-        sql = """SELECT * FROM origin"""
-        return self.fetchall_astropy(sql)
+        return self.fetchall_astropy(self._fetchall_sql('origin'))
 
     @db_bind_keys('name')
+    @cached_lookup('source', {'name' : 'name', 'version' : 'version'}, index=(('id',), ('name', 'version')))
     def fetch_source(self, **kwargs):
         """Fetch a source given (name)"""
         sql = """SELECT * FROM source WHERE name=%(name)s"""
@@ -458,6 +990,7 @@ class SunStarDB(Database):
         return self.fetch_row(sql, kwargs)
 
     @db_bind_keys('name', 'kind', 'origin_id', 'source_time')
+    @invalidates('source')
     def insert_source(self, **kwargs):
         """Insert a source given (name, kind, origin_id, source_time)"""
         if 'version' not in kwargs:
@@ -470,7 +1003,30 @@ class SunStarDB(Database):
         self.execute(sql, kwargs)
         return self.fetch_source(kwargs)
     
+    @db_bind_keys('id')
+    def fetch_ingest_checkpoint(self, **kwargs):
+        """Fetch the ingestion checkpoint of a source given its (id), or None"""
+        sql = "SELECT * FROM ingest_checkpoint WHERE source = %(id)s"
+        return self.fetch_row(sql, kwargs)
+
+    def save_ingest_checkpoint(self, source, offset, content_hash):
+        """Record that the first 'offset' data points of source are loaded
+
+        Input:
+         - source <dict>      : source row
+         - offset <int>       : number of data points loaded
+         - content_hash <str> : hash of those data points, see ingest.Checkpoint
+        """
+        sql = """INSERT INTO ingest_checkpoint (source, data_offset, content_hash)
+                      VALUES (%(src_id)s, %(offset)s, %(content_hash)s)
+                 ON CONFLICT (source) DO UPDATE
+                         SET data_offset = EXCLUDED.data_offset,
+                             content_hash = EXCLUDED.content_hash,
+                             update_time = current_timestamp"""
+        self.execute(sql, {'src_id' : source['id'], 'offset' : offset, 'content_hash' : content_hash})
+
     @db_bind_keys('name')
+    @invalidates('source')
     def delete_source(self, **kwargs):
         self.delete_dataset(kwargs)
         self.execute("DELETE FROM source WHERE name = %(name)s", kwargs)
@@ -478,11 +1034,12 @@ class SunStarDB(Database):
 
     def fetchall_sources(self):
         """Fetch all existing sources in the database"""
-        sql = """SELECT * FROM source"""
-        return self.fetchall_astropy(sql)
+        return self.fetchall_astropy(self._fetchall_sql('source'))
 
     @db_bind_keys('name')
     def delete_dataset(self, **kwargs):
+        if self.has_dataset_caches():
+            self.drop_dataset_cache(kwargs)
         self.execute("DELETE FROM dataset WHERE name = %(name)s", kwargs)
 
     @db_bind_keys('star_id', 'type_id', 'src_id')
@@ -499,7 +1056,7 @@ class SunStarDB(Database):
                            AND dt.id = %(type_id)s
                            AND src.id = %(src_id)s"""
         # TODO: need to make compound object: star, source, reference, instrument
-        db_property = self.fetch_row(sql, kwargs)
+        db_property = self.fetch_row(sql, kwargs, prepared=True)
         return db_property
 
     def fetchall_properties(self, **binds):
@@ -531,7 +1088,7 @@ class SunStarDB(Database):
                            AND dt.id = %(type_id)s
                            AND src.id = %(src_id)s"""
         # TODO: need to make compound object: star, source, reference, instrument
-        db_property = self.fetch_row(sql, kwargs)
+        db_property = self.fetch_row(sql, kwargs, prepared=True)
         return db_property
 
     # TODO: candidate for sqlhappy?
@@ -622,6 +1179,80 @@ class SunStarDB(Database):
             # Convert observation duration to TCB time scale, and convert to DateTimeRange for insertion
             obj['obs_range'] = psycopg2.extras.DateTimeRange(t1.datetime, t2.datetime, '[)')
 
+    def prepare_time_batch(self, objs):
+        """Prepare the observation times of many data points at once
+
+        The result is identical to calling prepare_time() on each of
+        objs, but all scalar astropy.time.Time values sharing a time
+        scale are gathered into one array-valued Time and converted to
+        TCB with a single call.  Points which derive 'obs_range' from
+        'obs_dur', or whose times carry an observer location, are
+        passed to prepare_time() individually.
+        """
+        type_exc = Exception('astropy.time.Time is the standard time object for sunstardb.')
+        groups = {} # scale -> list of Time
+        slots = []  # (obj, obs_time slot, obs_range slots) with slot = (scale, index)
+        for obj in objs:
+            obs_time = obj.get('obs_time')
+            obs_range = obj.get('obs_range')
+            if obs_time is None and obs_range is None:
+                continue
+            if obs_time is not None and obs_range is None and obj.get('obs_dur') is not None:
+                self.prepare_time(obj)
+                continue
+            times = []
+            if obs_time is not None:
+                times.append(obs_time)
+            if obs_range is not None:
+                times.extend(obs_range[0:2])
+            for t in times:
+                if not isinstance(t, astropy.time.Time):
+                    raise type_exc
+            if any(not t.isscalar or t.location is not None for t in times) or \
+               (obs_range is not None and obs_range[0].scale != obs_range[1].scale):
+                self.prepare_time(obj)
+                continue
+            positions = []
+            for t in times:
+                group = groups.setdefault(t.scale, [])
+                positions.append((t.scale, len(group)))
+                group.append(t)
+            time_slot = positions.pop(0) if obs_time is not None else None
+            range_slots = positions if obs_range is not None else None
+            slots.append((obj, time_slot, range_slots))
+
+        # One TCB conversion per time scale
+        converted = {}
+        for scale, times in list(groups.items()):
+            tcb = astropy.time.Time(times).tcb
+            converted[scale] = (tcb, tcb.datetime)
+
+        # Durations of all obs_range pairs, one TimeDelta per time scale
+        durations = {}
+        pairs = {}
+        for obj, time_slot, range_slots in slots:
+            if range_slots is not None and obj.get('obs_dur') is None:
+                (scale, i1), (_, i2) = range_slots
+                pairs.setdefault(scale, []).append((i1, i2))
+        for scale, ixs in list(pairs.items()):
+            tcb = converted[scale][0]
+            i1 = [i[0] for i in ixs]
+            i2 = [i[1] for i in ixs]
+            durations.update(zip(((scale, i) for i in i1), (tcb[i2] - tcb[i1]).sec))
+
+        for obj, time_slot, range_slots in slots:
+            if time_slot is not None:
+                scale, i = time_slot
+                obj['obs_time'] = converted[scale][1][i]
+            if range_slots is not None:
+                (scale, i1), (_, i2) = range_slots
+                dts = converted[scale][1]
+                if obj.get('obs_time') is None:
+                    obj['obs_time'] = dts[i1]
+                if obj.get('obs_dur') is None:
+                    obj['obs_dur'] = durations[(scale, i1)]
+                obj['obs_range'] = psycopg2.extras.DateTimeRange(dts[i1], dts[i2], '[)')
+
     def explicit_null(self, obj, *colnames):
         for col in colnames:
             if col not in obj:
@@ -638,7 +1269,7 @@ class SunStarDB(Database):
             raise Exception("unexpected datatype struct '%s'" % datatype['struct'])
         return db_datum
 
-    def prepare_datum(self, datum, star, datatype, source, reference, instrument=None):
+    def prepare_datum(self, datum, star, datatype, source, reference, instrument=None, defer_time=False):
         """Prepare a data point for insertion into the database
         
         Input:
@@ -648,6 +1279,8 @@ class SunStarDB(Database):
          - source     : dict containing source data
          - reference  : dict containing reference data
          - instrument : (optional) dict containing instrument data
+         - defer_time : (optional) skip prepare_time(), so that the
+                        caller may use prepare_time_batch() instead
 
         If (star, datatype, source, reference, instrument) do not have
         the 'id' key set, then it will be fetched from the database
@@ -665,7 +1298,8 @@ class SunStarDB(Database):
         self.prepare_err(datum)
 
         # Set timestamps
-        self.prepare_time(datum)
+        if not defer_time:
+            self.prepare_time(datum)
 
         # Explicit None for all NULLable columns
         self.explicit_null(datum, 'inst_id', 'errlo', 'errhi', 'errbounds', 
@@ -710,7 +1344,7 @@ class SunStarDB(Database):
                       VALUES (%%(prop_id)s, %%(star_id)s, %%(src_id)s,
                               %%(val)s, %%(errlo)s, %%(errhi)s, %%(errbounds)s,
                               %%(obs_time)s, %%(obs_dur)s, %%(obs_range)s, %%(meta)s)""" % kwargs # set 'name' first
-        self.execute(sql, kwargs) # DB driver to bind the rest
+        self.execute_prepared(sql, kwargs) # DB driver to bind the rest
         return None # TODO: return measure?
 
     @db_bind_keys('name', 'prop_id', 'star_id', 'src_id',
@@ -724,7 +1358,7 @@ class SunStarDB(Database):
         sql = """INSERT INTO dat_%(name)s (property, star, source, %(name)s, meta)
                       VALUES (%%(prop_id)s, %%(star_id)s, %%(src_id)s,
                               %%(label)s, %%(meta)s)""" % kwargs # set 'name' first
-        self.execute(sql, kwargs) # DB driver to bind the rest
+        self.execute_prepared(sql, kwargs) # DB driver to bind the rest
         return None # TODO: return measure?
 
     @db_bind_keys('star_id', 'type_id', 'src_id', 'ref_id', 'inst_id', 'meta')
@@ -750,6 +1384,7 @@ class SunStarDB(Database):
         kwargs['ts_id'] = db_ts['id']
         db_type = self.fetch_datatype_by_id(kwargs)
         kwargs['name'] = db_type['name']
+        self.ensure_timeseries_partitions(kwargs['name'], kwargs['obs_time'], kwargs['obs_time'])
         self.insert_timepoint(kwargs)
         return db_ts
 
@@ -761,6 +1396,9 @@ class SunStarDB(Database):
         Requires ('name', 'ts_id', 'star_id', 'src_id', 'val',
                   'errlo', 'errhi', 'errbounds', 'obs_time',
                   'obs_dur', 'obs_range', 'meta')
+
+        The partition of obs_time must already exist, see
+        ensure_timeseries_partitions().
         """
         sql = """INSERT INTO dat_%(name)s (timeseries, star, source, obs_time, obs_dur, obs_range,
                                            %(name)s, errlo, errhi, errbounds, meta)
@@ -768,9 +1406,244 @@ class SunStarDB(Database):
                               %%(obs_time)s, %%(obs_dur)s, %%(obs_range)s,
                               %%(val)s, %%(errlo)s, %%(errhi)s, %%(errbounds)s,
                                %%(meta)s)""" % kwargs # set 'name' first
-        self.execute(sql, kwargs) # DB driver to bind the rest
+        self.execute_prepared(sql, kwargs) # DB driver to bind the rest
         return None # TODO: return timepoint?
 
+    def insert_data_bulk(self, datums, page_size=1000):
+        """Insert a batch of prepared data points using multi-row statements
+
+        Input:
+         - datums <list>    : data points as returned by prepare_datum()
+         - page_size <int>  : maximum number of rows per INSERT statement
+
+        Output:
+         - <int> : number of data points inserted
+
+        Equivalent to calling insert_property() or append_timeseries()
+        on each datum, but 'property' rows are inserted with a single
+        'INSERT ... RETURNING' per page, and 'dat_<name>' rows are
+        inserted with a single INSERT per datatype and page.
+        """
+        props = []
+        series = {}
+        for datum in datums:
+            struct = datum['ref']['type']['struct']
+            if struct in ['MEASURE', 'LABEL']:
+                props.append(datum)
+            elif struct == 'TIMESERIES':
+                key = (datum['star_id'], datum['type_id'], datum['src_id'])
+                series.setdefault(key, []).append(datum)
+            else:
+                raise Exception("unexpected datatype struct '%s'" % struct)
+
+        for data in list(series.values()):
+            refs = data[0]['ref']
+            self.append_timeseries_bulk(data, refs['star'], refs['type'], refs['src'], refs['ref'],
+                                        instrument=refs.get('inst'), page_size=page_size, prepared=True)
+
+        if not props:
+            return len(datums)
+
+        sql = """INSERT INTO property (star, type, source, reference, instrument)
+                      VALUES %s
+                      RETURNING id, star, type, source"""
+        template = "(%(star_id)s, %(type_id)s, %(src_id)s, %(ref_id)s, %(inst_id)s)"
+        rows = self.execute_values(sql, props, template=template, page_size=page_size, fetch=True)
+        # (star, type, source) is unique; use it to match returned ids to the input rows
+        prop_ids = {}
+        for row in rows:
+            prop_ids[(row['star'], row['type'], row['source'])] = row['id']
+
+        by_type = {}
+        for datum in props:
+            datum['prop_id'] = prop_ids[(datum['star_id'], datum['type_id'], datum['src_id'])]
+            by_type.setdefault(datum['type_id'], []).append(datum)
+
+        for type_id, data in list(by_type.items()):
+            db_type = data[0]['ref']['type']
+            if db_type['struct'] == 'MEASURE':
+                sql = """INSERT INTO dat_%(name)s (property, star, source,
+                                                   %(name)s, errlo, errhi, errbounds, obs_time, obs_dur, obs_range, meta)
+                              VALUES %%s""" % db_type
+                template = """(%(prop_id)s, %(star_id)s, %(src_id)s,
+                               %(val)s, %(errlo)s, %(errhi)s, %(errbounds)s,
+                               %(obs_time)s, %(obs_dur)s, %(obs_range)s, %(meta)s)"""
+            else:
+                sql = """INSERT INTO dat_%(name)s (property, star, source, %(name)s, meta)
+                              VALUES %%s""" % db_type
+                template = "(%(prop_id)s, %(star_id)s, %(src_id)s, %(label)s, %(meta)s)"
+            self.execute_values(sql, data, template=template, page_size=page_size)
+        return len(datums)
+
+    @db_bind_keys('star_id', 'type_id', 'src_id', 'ref_id', 'inst_id')
+    def fetch_or_insert_timeseries(self, **kwargs):
+        """Fetch a timeseries given (star_id, type_id, src_id), inserting it if it does not exist"""
+        db_ts = self.fetch_timeseries_by_id(kwargs)
+        if db_ts is None:
+            sql = """INSERT INTO timeseries (star, type, source, reference, instrument)
+                          VALUES (%(star_id)s, %(type_id)s, %(src_id)s, %(ref_id)s, %(inst_id)s)
+                          RETURNING *"""
+            db_ts = self.insert_returning(sql, kwargs)
+        return db_ts
+
+    def touch_timeseries(self, timeseries):
+        """Set the append_time of the given timeseries to the current time"""
+        sql = "UPDATE timeseries SET append_time = current_timestamp WHERE id = %(id)s"
+        self.execute(sql, {'id': timeseries['id']})
+
+    def insert_timepoints_bulk(self, timeseries, datatype, datums, page_size=1000):
+        """Insert prepared timeseries points into the data table of datatype
+
+        Input:
+         - timeseries <dict> : timeseries row the points belong to
+         - datatype <dict>   : datatype row of the timeseries
+         - datums <list>     : data points as returned by prepare_datum()
+         - page_size <int>   : maximum number of rows per INSERT statement
+        """
+        for datum in datums:
+            datum['ts_id'] = timeseries['id']
+        obs_times = [ datum['obs_time'] for datum in datums if datum.get('obs_time') is not None ]
+        if obs_times:
+            self.ensure_timeseries_partitions(datatype['name'], min(obs_times), max(obs_times))
+        sql = """INSERT INTO dat_%(name)s (timeseries, star, source, obs_time, obs_dur, obs_range,
+                                           %(name)s, errlo, errhi, errbounds, meta)
+                      VALUES %%s""" % datatype
+        template = """(%(ts_id)s, %(star_id)s, %(src_id)s,
+                       %(obs_time)s, %(obs_dur)s, %(obs_range)s,
+                       %(val)s, %(errlo)s, %(errhi)s, %(errbounds)s, %(meta)s)"""
+        self.execute_values(sql, datums, template=template, page_size=page_size)
+
+    def timeseries_partitions(self, name):
+        """Return the set of decades partitioning dat_<name>, or None if it is not partitioned
+
+        Partitions are looked up in the catalog once per transaction:
+        the list is forgotten by commit() and rollback().  Partitions can
+        not be dropped by other connections while the transaction holds
+        locks on dat_<name>.
+        """
+        if name not in self._timeseries_partitions:
+            table = "dat_%s" % schema.check_datatype_name(name)
+            sql = "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%(table)s)"
+            decades = None
+            if self.fetch_scalar(sql, {'table' : table}):
+                sql = """SELECT c.relname
+                           FROM pg_inherits i
+                           JOIN pg_class c ON c.oid = i.inhrelid
+                          WHERE i.inhparent = to_regclass(%(table)s)"""
+                decades = set()
+                for relname in self.fetch_column(sql, {'table' : table}) or []:
+                    match = re.search(r'_p(\d{4})$', relname)
+                    if match:
+                        decades.add(int(match.group(1)))
+            self._timeseries_partitions[name] = decades
+        return self._timeseries_partitions[name]
+
+    def ensure_timeseries_partitions(self, name, first, last):
+        """Create the missing decade partitions of dat_<name> for obs_time from first to last
+
+        Does nothing if dat_<name> is not partitioned.  Called once per
+        batch before inserting timeseries points, with the earliest and
+        latest obs_time of the batch, so that they are routed to their
+        decade partition rather than to the default partition.
+
+        Partitions missing from the cached list are looked up again
+        before creating them, in case another connection created them.
+        """
+        if getattr(first, 'year', None) is None or getattr(last, 'year', None) is None:
+            return
+        decades = self.timeseries_partitions(name)
+        if decades is None:
+            return
+        needed = set(range(first.year // 10 * 10, last.year // 10 * 10 + 1, 10))
+        if not needed <= decades:
+            self._timeseries_partitions.pop(name, None)
+            decades = self.timeseries_partitions(name)
+        for decade in sorted(needed - decades):
+            self.create_timeseries_partition(name, decade)
+            decades.add(decade)
+
+    def create_timeseries_partition(self, name, decade):
+        """Create the partition of dat_<name> for obs_time in [decade, decade + 10) years
+
+        Rows of that range already in the default partition are moved
+        to the new partition, as PostgreSQL refuses to create it otherwise.
+        """
+        table = "dat_%s" % schema.check_datatype_name(name)
+        partition = schema.partition_name(name, decade)
+        binds = { 'start' : '%04i-01-01' % decade, 'end' : '%04i-01-01' % (decade + 10) }
+        in_range = "FROM %s_default WHERE obs_time >= %%(start)s AND obs_time < %%(end)s" % table
+        moved = self.fetch_scalar("SELECT EXISTS (SELECT 1 %s)" % in_range, binds)
+        if moved:
+            self.execute("CREATE TEMPORARY TABLE partition_moved ON COMMIT DROP AS SELECT * %s" % in_range, binds)
+            self.execute("DELETE %s" % in_range, binds)
+        self.execute("""CREATE TABLE IF NOT EXISTS %s PARTITION OF %s
+                        FOR VALUES FROM (%%(start)s) TO (%%(end)s)""" % (partition, table), binds)
+        if moved:
+            self.execute("INSERT INTO %s SELECT * FROM partition_moved" % table)
+            self.execute("DROP TABLE partition_moved")
+
+    def append_timeseries_bulk(self, datums, star, datatype, source, reference, instrument=None,
+                               incrementor=None, page_size=1000, prepared=False):
+        """Append many points to the timeseries of (star, datatype, source)
+
+        Input:
+         - datums <iterable>  : dicts containing the data points
+         - star               : dict containing star data
+         - datatype           : dict containing datatype data
+         - source             : dict containing source data
+         - reference          : dict containing reference data
+         - instrument         : (optional) dict containing instrument data
+         - incrementor        : (optional) datapkg.DuplicateTimeIncrementor
+                                applied to each 'obs_time' before preparation
+         - page_size <int>    : number of points per INSERT statement
+         - prepared <bool>    : the datums were already prepared with
+                                prepare_datum() and prepare_time_batch(),
+                                as in insert_data_bulk()
+
+        Output:
+         - <dict> : the timeseries row
+
+        Unlike append_timeseries(), the referenced objects and the
+        timeseries row are looked up (or created) only once, points are
+        streamed into 'dat_<name>' page_size at a time, and
+        'append_time' is updated once at the end.
+        """
+        refs = {}
+        self.attach_result('star', star, self.fetch_star, refs)
+        self.attach_result('type', datatype, self.fetch_datatype, refs)
+        self.attach_result('src', source, self.fetch_source, refs)
+        self.attach_result('ref', reference, self.fetch_reference, refs)
+        if instrument is not None:
+            self.attach_result('inst', instrument, self.fetch_instrument, refs)
+        if refs['type']['struct'] != 'TIMESERIES':
+            raise Exception("datatype '%(name)s' is not a TIMESERIES" % refs['type'])
+        if incrementor is not None:
+            incrementor.reset()
+
+        db_ts = None
+        page = []
+        for datum in datums:
+            if incrementor is not None and datum.get('obs_time') is not None:
+                datum['obs_time'] = incrementor.process(datum['obs_time'])
+            if not prepared:
+                datum = self.prepare_datum(datum, refs['star'], refs['type'], refs['src'], refs['ref'],
+                                           instrument=refs.get('inst'), defer_time=True)
+            if db_ts is None:
+                db_ts = self.fetch_or_insert_timeseries(datum)
+            page.append(datum)
+            if len(page) >= page_size:
+                if not prepared:
+                    self.prepare_time_batch(page)
+                self.insert_timepoints_bulk(db_ts, refs['type'], page, page_size=page_size)
+                page = []
+        if page:
+            if not prepared:
+                self.prepare_time_batch(page)
+            self.insert_timepoints_bulk(db_ts, refs['type'], page, page_size=page_size)
+        if db_ts is not None:
+            self.touch_timeseries(db_ts)
+        return db_ts
+
     @db_bind_keys('name')
     def create_dataset_from_source(self, **kwargs):
         """Create a dataset given a source (name)"""
@@ -786,11 +1659,110 @@ class SunStarDB(Database):
                    JOIN property p on p.source = s.id
                   WHERE ds.name = %(name)s"""
         self.execute(sql, dataset)
+        if self.dataset_cache:
+            self.create_dataset_cache(dataset)
+
+    def has_dataset_caches(self):
+        """Whether the database has the dataset_cache registry
+
+        Caches are maintained by delete_dataset() and drop_datatype()
+        whenever the registry exists, even if 'dataset_cache' is not
+        enabled, since their views depend on the data tables.
+        """
+        if self._has_dataset_caches is None:
+            sql = "SELECT to_regclass('dataset_cache') IS NOT NULL"
+            self._has_dataset_caches = self.fetch_scalar(sql)
+        return self._has_dataset_caches
+
+    def _dataset_cache_datatypes(self, name):
+        """Return (dataset id, MEASURE and LABEL datatype rows) of the dataset (name)"""
+        dataset_id = self.fetch_scalar("SELECT id FROM dataset WHERE name = %(name)s", {'name' : name})
+        if dataset_id is None:
+            raise Exception("dataset '%s' not found" % name)
+        sql = """SELECT DISTINCT dt.name, dt.struct
+                   FROM dataset_map dm
+                   JOIN datatype dt ON dt.id = dm.type
+                  WHERE dm.dataset = %(dataset)s
+                    AND dt.struct IN ('MEASURE', 'LABEL')
+                  ORDER BY dt.name"""
+        datatypes = self.fetchall(sql, {'dataset' : dataset_id}) or []
+        return dataset_id, datatypes
+
+    @db_bind_keys('name')
+    @cached_lookup('dataset_cache', {'name' : 'name'}, index=(('name',),))
+    def fetch_dataset_cache(self, **kwargs):
+        """Fetch the materialized cache of a dataset given its (name), or None"""
+        sql = """SELECT dc.*, ds.name
+                   FROM dataset_cache dc
+                   JOIN dataset ds ON ds.id = dc.dataset
+                  WHERE ds.name = %(name)s"""
+        return self.fetch_row(sql, kwargs)
+
+    @db_bind_keys('name')
+    @invalidates('dataset_cache')
+    def create_dataset_cache(self, **kwargs):
+        """Create the materialized wide-table cache of a dataset given its (name)
+
+        The cache is a materialized view 'dsc_<dataset id>' with one row
+        per star of the dataset, holding the value, errors (MEASURE
+        only) and meta of each MEASURE and LABEL datatype of the
+        dataset, with a unique index on the star.  It is registered in
+        the dataset_cache table.  fetch_data_table() reads from it
+        instead of joining the data tables, when 'dataset_cache' is
+        enabled and the cache holds all requested datatypes.
+
+        Output:
+         - <dict> : dataset_cache row, or None if the dataset has no data
+        """
+        dataset_id, datatypes = self._dataset_cache_datatypes(kwargs['name'])
+        if not datatypes:
+            return None
+        view = "dsc_%i" % dataset_id
+        sql = "CREATE MATERIALIZED VIEW %s AS " % view + self._dataset_cache_sql(datatypes)
+        self.execute(sql, {'dataset' : dataset_id})
+        self.execute("CREATE UNIQUE INDEX uq_%s_star ON %s (star_id)" % (view, view))
+        sql = """INSERT INTO dataset_cache (dataset, view, datatypes)
+                      VALUES (%(dataset)s, %(view)s, %(datatypes)s)"""
+        self.execute(sql, {'dataset' : dataset_id, 'view' : view,
+                           'datatypes' : [ dt['name'] for dt in datatypes ]})
+        return self.fetch_dataset_cache(kwargs)
+
+    @db_bind_keys('name')
+    @invalidates('dataset_cache')
+    def refresh_dataset_cache(self, **kwargs):
+        """Bring the cache of a dataset given its (name) up to date
+
+        If the datatypes of the dataset are unchanged the view is
+        refreshed concurrently, which only writes the rows that
+        changed; otherwise it is rebuilt.  Datasets without a cache are
+        left alone.
+        """
+        db_cache = self.fetch_dataset_cache(kwargs)
+        if db_cache is None:
+            return None
+        dataset_id, datatypes = self._dataset_cache_datatypes(kwargs['name'])
+        if [ dt['name'] for dt in datatypes ] != list(db_cache['datatypes']):
+            self.drop_dataset_cache(kwargs)
+            return self.create_dataset_cache(kwargs)
+        self.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY %s" % db_cache['view'])
+        sql = """UPDATE dataset_cache SET refresh_time = current_timestamp
+                  WHERE dataset = %(dataset)s"""
+        self.execute(sql, db_cache)
+        return db_cache
+
+    @db_bind_keys('name')
+    @invalidates('dataset_cache')
+    def drop_dataset_cache(self, **kwargs):
+        """Remove the cache of a dataset given its (name), if any"""
+        db_cache = self.fetch_dataset_cache(kwargs)
+        if db_cache is None:
+            return
+        self.execute("DROP MATERIALIZED VIEW IF EXISTS %s" % db_cache['view'])
+        self.execute("DELETE FROM dataset_cache WHERE dataset = %(dataset)s", db_cache)
 
     def fetchall_datasets(self):
         """Fetch all existing datasets from the database"""
-        sql = """SELECT * FROM dataset"""
-        return self.fetchall_astropy(sql)
+        return self.fetchall_astropy(self._fetchall_sql('dataset'))
 
     def sanity_check(self, tasks, source, verbose=True):
         """Execute sanity checks for the given source"""
@@ -826,36 +1798,150 @@ class SunStarDB(Database):
         else:
             return True
 
-    def fetchall_astropy(self, sql, binds=None, dtype=None):
+    def fetchall_astropy(self, sql, binds=None, dtype=None, chunksize=None):
         """Return all results of an SQL query as an astropy.table.Table, or None
 
         Input:
-         - sql <string> : SELECT statement to execute
-         - binds <dict> : optional bind parameters
-         
+         - sql <string>    : SELECT statement to execute
+         - binds <dict>    : optional bind parameters
+         - dtype <list>    : optional column dtypes for the table
+         - chunksize <int> : if given, stream the results with a
+                             server-side cursor, see iter_astropy()
+
         Output:
          - <Table> : table of results
+
+        When streaming, each chunk of rows is converted to column arrays
+        as it arrives, so the full result is never held as a list of
+        rows.
         """
+        if chunksize is not None:
+            columns = None
+            for chunk in self.iter_astropy(sql, binds, dtype=dtype, chunksize=chunksize):
+                if columns is None:
+                    columns = [ [] for name in chunk.colnames ]
+                    names = chunk.colnames
+                for i, name in enumerate(names):
+                    columns[i].append(chunk[name].data)
+            columns = [ numpy.concatenate(c) for c in columns ]
+            return astropy.table.Table(columns, names=names, dtype=dtype, copy=False)
         result, colnames = self.fetchall(sql, binds, colnames=True)
         table = astropy.table.Table(rows=result, names=colnames, dtype=dtype)
         return table
 
-    def fetch_data(self, datatype):
-        """Fetch data and associated info for the given datatype"""
-        
-        sql = """SELECT s.name star, r.name reference, o.name origin, o.kind origin_kind, i.name instrument,
-                        d.%(datatype)s "%(datatype)s", d.errhi, d.errlo
-                   FROM dat_%(datatype)s d
-                   JOIN property p ON p.id = d.property
-                   JOIN star s ON s.id = p.star
-                   JOIN reference r ON r.id = p.reference
-                   JOIN source src ON src.id = p.source
-                   JOIN origin o ON o.id = src.origin
-                   LEFT JOIN instrument i ON i.id = p.instrument"""
-        # TODO: validate to prevent SQL injection
-        result = self.fetchall_astropy(sql % {'datatype':datatype})
+    def iter_astropy(self, sql, binds=None, dtype=None, chunksize=10000):
+        """Generate the results of an SQL query as astropy.table.Table chunks
+
+        Uses a server-side cursor so that at most 'chunksize' rows are
+        held in memory at a time, regardless of the size of the result.
+        At least one (possibly empty) table is generated.
+        """
+        for rows, colnames in self.iterate(sql, binds, itersize=chunksize):
+            if len(rows) == 0:
+                rows = None
+            yield astropy.table.Table(rows=rows, names=colnames, dtype=dtype)
+
+    def fetch_data(self, datatype, chunksize=None):
+        """Fetch data and associated info for the given datatype
+
+        If chunksize is given, the result is streamed from the server
+        'chunksize' rows at a time, see fetchall_astropy().
+        """
+        result = self.fetchall_astropy(self._fetch_data_sql(datatype), chunksize=chunksize)
         return result
 
+    def iter_data(self, datatype, chunksize=10000):
+        """Generate data and associated info for the given datatype as table chunks"""
+        return self.iter_astropy(self._fetch_data_sql(datatype), chunksize=chunksize)
+
+    def fetch_data_columns_fast(self, datatype):
+        """Fetch all data of the given datatype as columns, using COPY
+
+        Output:
+         - <astropy.table.Table> : table of data with associated info
+
+        The query is exported with 'COPY ... TO STDOUT' as CSV into a
+        memory buffer, which is split into columns of strings by the C
+        parser of numpy.loadtxt(), without building python objects for
+        each row.  Each column is then cast to the type of its column
+        in the datatype struct, so that text such as '007' or 'NaN'
+        stays text.  NULL values are masked.
+
+        For MEASURE datatypes the columns are those of fetch_data().  For
+        TIMESERIES datatypes the columns are (star, source, obs_time,
+        datatype, errlo, errhi), with 'obs_time' as numpy.datetime64.
+        """
+        schema.check_datatype_name(datatype)
+        db_type = self.fetch_datatype(name=datatype)
+        if db_type is None:
+            raise MissingDataError("datatype '%s' not found" % datatype)
+        if db_type['struct'] == 'MEASURE':
+            sql = self._fetch_data_sql(datatype)
+            columns = [('star', str), ('reference', str), ('origin', str), ('origin_kind', str),
+                       ('instrument', str), (datatype, float), ('errhi', float), ('errlo', float)]
+        elif db_type['struct'] == 'LABEL':
+            sql = """SELECT s.name star, r.name reference, o.name origin, o.kind origin_kind, i.name instrument,
+                            d.%(datatype)s "%(datatype)s"
+                       FROM dat_%(datatype)s d
+                       JOIN property p ON p.id = d.property
+                       JOIN star s ON s.id = p.star
+                       JOIN reference r ON r.id = p.reference
+                       JOIN source src ON src.id = p.source
+                       JOIN origin o ON o.id = src.origin
+                       LEFT JOIN instrument i ON i.id = p.instrument""" % {'datatype':datatype}
+            columns = [('star', str), ('reference', str), ('origin', str), ('origin_kind', str),
+                       ('instrument', str), (datatype, str)]
+        else:
+            sql = """SELECT s.name star, src.name source, d.obs_time, d.%(datatype)s "%(datatype)s", d.errlo, d.errhi
+                       FROM dat_%(datatype)s d
+                       JOIN star s ON s.id = d.star
+                       JOIN source src ON src.id = d.source""" % {'datatype':datatype}
+            columns = [('star', str), ('source', str), ('obs_time', 'datetime64[us]'),
+                       (datatype, float), ('errlo', float), ('errhi', float)]
+
+        # CSV can not tell NULL from an empty string once unquoted, so
+        # text columns are followed by their IS NULL flag, and other
+        # columns show NULL as \N
+        select = []
+        for name, kind in columns:
+            select.append('q."%s"' % name)
+            if kind is str:
+                select.append('q."%s" IS NULL' % name)
+        sql = "SELECT %s FROM (%s) q" % (", ".join(select), sql)
+
+        buf = io.StringIO()
+        self.copy_out(sql, buf, options="FORMAT csv, HEADER true, NULL '\\N'")
+        buf.seek(0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore') # about an empty result
+            fields = numpy.loadtxt(buf, dtype=str, delimiter=',', quotechar='"', skiprows=1,
+                                   comments=None, ndmin=2)
+        buf.close()
+        if len(fields) == 0:
+            fields = numpy.zeros((0, len(select)), dtype='U1')
+
+        table = astropy.table.Table()
+        i = 0
+        for name, kind in columns:
+            values = fields[:, i]
+            i += 1
+            if kind is str:
+                null = fields[:, i] == 't'
+                i += 1
+                values = numpy.where(null, '', values)
+            else:
+                null = values == '\\N'
+                if kind is float:
+                    values = numpy.where(null, 'nan', values).astype(float)
+                else:
+                    values = numpy.where(null, 'NaT', values).astype(kind)
+            if null.any():
+                table[name] = astropy.table.MaskedColumn(values, mask=null)
+            else:
+                table[name] = values
+        return table
+
+    @cached_result('_fetch_data_table_stamp_sql')
     def fetch_data_table(self, dataset, datatypes, meta=None, nulls=True, errors=False):
         """Fetch star names and data as a table for the given dataset
 
@@ -874,55 +1960,20 @@ class SunStarDB(Database):
         The DictRow results may be accessed like a dict.  Each
         row will have a 'star' key, pointing to the star
         name, and a key for each datatype given.
-        """
-        # XXX TODO: protect against using timeseries data types here,
-        #           or, provide subqueries which turn timeseries into scalars
-        ixs = list(range(len(datatypes)))
 
-        # Define source sub-tables
-        sql = "WITH "
-        for i in ixs:
-            dtype = datatypes[i]
-            dcols = 'd.*'
-            if meta and dtype in meta:
-                # listify a simple string value
-                if isinstance(meta[dtype], str):
-                    meta[dtype] = [ meta[dtype] ]
-                for metacol in meta[dtype]:
-                    dcols += ", d.meta->>'%s' \"%s\"" % (metacol, metacol)
-            sql += """d%02i AS (
-                        SELECT %s FROM dat_%s d
-                          JOIN dataset_map dm ON dm.property = d.property
-                          JOIN dataset ds ON ds.id = dm.dataset
-                         WHERE ds.name = %%(dataset)s ),
-            """ % (i, dcols, datatypes[i])
-        sql += "uq_stars AS ( "
-        sql += " UNION ".join( "SELECT star FROM d%02i" % i for i in ixs)
-
-        # Output columns
-        # TODO: "errors" assumes all columns are MEASURE types... check datatype table instead
-        sql += ") SELECT s.name star, "
-        col_pattern = "d%(index)02i.%(name)s \"%(name)s\"" # preserve case in output columns
-        if errors:
-            col_pattern += ", d%(index)02i.errlo \"errlo_%(name)s\", d%(index)02i.errhi \"errhi_%(name)s\""
-        sql += ", ".join( col_pattern % dict(index=i, name=datatypes[i]) for i in ixs )
-        if meta:
-            for dtype in meta:
-                i = datatypes.index(dtype)
-                for metacol in meta[dtype]:
-                    sql += ", d%(index)02i.\"%(name)s\" \"%(name)s\"" % dict(index=i, name=metacol)
-
-        # Source sub-tables
-        sql += " FROM uq_stars us JOIN star s ON s.id = us.star"
-        if nulls is True:
-            jointype = "LEFT JOIN"
+        With 'dataset_cache' enabled, the table is read from the
+        materialized cache of the dataset if there is one, see
+        create_dataset_cache().
+        """
+        db_cache = None
+        if self.dataset_cache:
+            db_cache = self.fetch_dataset_cache(name=dataset)
+        if db_cache is not None and set(datatypes) <= set(db_cache['datatypes']):
+            sql, binds = self._fetch_data_table_cache_sql(db_cache['view'], datatypes,
+                                                          meta=meta, nulls=nulls, errors=errors)
         else:
-            jointype = "JOIN"
-            
-        for i in ixs:
-            sql += " %s d%02i ON d%02i.star = s.id" % (jointype, i, i)
-
-        result = self.fetchall_astropy(sql, { 'dataset' : dataset})
+            sql, binds = self._fetch_data_table_sql(dataset, datatypes, meta=meta, nulls=nulls, errors=errors)
+        result = self.fetchall_astropy(sql, binds)
         return result
 
     def fetch_data_cols(self, dataset, datatypes, nulls=True, errors=False):
@@ -947,58 +1998,128 @@ class SunStarDB(Database):
         result = self.fetch_data_table(dataset, datatypes, nulls=nulls, errors=errors)
         return self.list_to_columns(result)
 
-    def fetch_timeseries(self, datatype, star, source=None):
+    @cached_result('_fetch_timeseries_stamp_sql')
+    def fetch_timeseries(self, datatype, star, source=None, start=None, end=None, points=None, mode='bin'):
         """Fetch timeseries of a given datatype, star, and (optional) source
 
         Inputs:
           - datatype <str> : datatype name
           - star <str>     : SIMBAD-recognized star name
           - source <str>   : (optional) source name
+          - start          : (optional) only points with obs_time >= start
+          - end            : (optional) only points with obs_time < end
+          - points <int>   : (optional) return at most this many points
+          - mode <str>     : downsampling mode with 'points', 'bin' or 'lttb'
 
         Output:
           - <astropy.table.Table> : table of (obs_time, datatype, errlo, errhi)
 
         The 'obs_time' column is formatted as a datetime object.
         Timeseries values are found in a column with the same name as
-        `datatype`.
+        `datatype`.  Rows are ordered by obs_time.
+
+        'start' and 'end' may be datetimes, strings, or astropy Time
+        values, which are converted to TCB as stored obs_time values.
+
+        With 'points', the series is downsampled by the database:
+         - 'bin'  : the window (or the whole series) is split into
+                    'points' intervals of equal width, and the table is
+                    (obs_time, datatype, min_<datatype>, max_<datatype>, n)
+                    of the mean time and value, minimum, maximum and
+                    number of points of each non-empty interval
+         - 'lttb' : the first, last, lowest and highest points of each
+                    interval are fetched, then reduced to 'points' points
+                    by Largest-Triangle-Three-Buckets (utils.lttb()).
+                    Rows are actual points, with their errors.
         """
-        sql = """SELECT obs_time, %(name)s \"%(name)s\", errlo, errhi
-                 FROM dat_%(name)s d
-                 JOIN star_alias sa ON sa.star = d.star\n""" % dict(name=datatype)
-        if source is not None:
-            sql += "JOIN source src ON src.id = d.source"
-        where = "replace(sa.name, ' ', '') = replace(%(star)s, ' ', '')"
-        binds = {'star':star}
-        if source is not None:
-            where += " AND src.name = %(source)s"
-            binds['source'] = source
-        sql += " WHERE " + where
-
-        result = self.fetchall_astropy(sql, binds, dtype=('object', 'f', 'f', 'f'))
-        return result
+        sql, binds, dtype = self._fetch_timeseries_sql(datatype, star, source, start=start, end=end,
+                                                       points=points, mode=mode)
+        result = self.fetchall_astropy(sql, binds, dtype=dtype)
+        return self._downsample_timeseries(result, datatype, points, mode)
 
     def fetch_boxmatch(self, dataset, skycoord, ra_side, dec_side=None, orient='center'):
         """Search dataset for stars falling in a box near to skycoord"""
-        if dec_side is None:
-            dec_side = ra_side
-
-        if orient == 'center':
-            box = { 'ra_min' : skycoord.ra.degree - ra_side/2.0,
-                    'ra_max' : skycoord.ra.degree + ra_side/2.0,
-                    'dec_min' : skycoord.dec.degree - dec_side/2.0,
-                    'dec_max' : skycoord.dec.degree + dec_side/2.0 }
-        else:
-            raise Exception("invalid orientation '%s'" % orient)
-        
-        sql = """SELECT DISTINCT s.name, s.ra, s.dec
-                   FROM dataset ds
-                   JOIN dataset_map dm ON dm.dataset = ds.id
-                   JOIN star s ON s.id = dm.star
-                  WHERE ds.name = %(dataset)s
-                    AND q3c_poly_query(s.ra, s.dec,
-                                      '{%(ra_max)s, %(dec_max)s,
-                                       %(ra_max)s, %(dec_min)s,
-                                       %(ra_min)s, %(dec_min)s,
-                                       %(ra_min)s, %(dec_max)s}')"""
-        result = self.fetchall(sql, dict(list({'dataset':dataset}.items()) + list(box.items())))
+        index = self._searchable_star_index(dataset)
+        if index is not None:
+            if orient != 'center':
+                raise Exception("invalid orientation '%s'" % orient)
+            matches = self._star_index_matches(index, dataset, index.box(skycoord, ra_side, dec_side))
+            if len(matches) == 0:
+                return None
+            return [ {'name':row['name'], 'ra':float(row['ra']), 'dec':float(row['dec'])} for row in matches ]
+        sql, binds = self._fetch_boxmatch_sql(dataset, skycoord, ra_side, dec_side, orient)
+        result = self.fetchall(sql, binds)
         return result
+
+    def upload_targets(self, skycoords):
+        """Load target coordinates into the temporary 'crossmatch_target' table
+
+        Input:
+         - skycoords <SkyCoord> : target coordinates (scalar or array)
+
+        Output:
+         - <int> : number of targets
+
+        The targets are sent with a single COPY and numbered by their
+        index in skycoords ('idx' column).  The table replaces the
+        targets of any previous upload, and lasts until the end of the
+        session.
+        """
+        ra = numpy.atleast_1d(skycoords.icrs.ra.degree)
+        dec = numpy.atleast_1d(skycoords.icrs.dec.degree)
+        self.execute("DROP TABLE IF EXISTS crossmatch_target")
+        self.execute("""CREATE TEMPORARY TABLE crossmatch_target
+                          (idx integer not null, ra double precision not null, dec double precision not null)""")
+        buf = io.StringIO()
+        for i in range(len(ra)):
+            buf.write("%i,%r,%r\n" % (i, float(ra[i]), float(dec[i])))
+        buf.seek(0)
+        self.copy_in('crossmatch_target', buf, columns=('idx', 'ra', 'dec'))
+        self.execute("ANALYZE crossmatch_target")
+        return len(ra)
+
+    def iter_conematch(self, dataset, skycoords, radius, chunksize=10000):
+        """Generate matches of many targets to stars of dataset within radius
+
+        Input:
+         - dataset <str>        : dataset name
+         - skycoords <SkyCoord> : target coordinates (scalar or array)
+         - radius <float>       : match radius in degrees
+         - chunksize <int>      : number of matches per generated chunk
+
+        Output:
+         - <generator> : astropy.table.Table chunks of (idx, name, ra,
+                         dec, sep), ordered by target index 'idx' and
+                         separation 'sep' in degrees
+
+        The targets are uploaded once (see upload_targets()) and matched
+        with a single q3c_join() query.
+        """
+        self.upload_targets(skycoords)
+        sql, binds = self._conematch_sql(dataset, radius)
+        return self.iter_astropy(sql, binds, chunksize=chunksize)
+
+    def fetch_conematch(self, dataset, skycoords, radius):
+        """Match many targets to stars of dataset within radius, see iter_conematch()"""
+        index = self._searchable_star_index(dataset)
+        if index is not None:
+            return self._star_index_matches(index, dataset, index.cone(skycoords, radius))
+        self.upload_targets(skycoords)
+        sql, binds = self._conematch_sql(dataset, radius)
+        return self.fetchall_astropy(sql, binds)
+
+    def iter_boxmatch_bulk(self, dataset, skycoords, ra_side, dec_side=None, orient='center', chunksize=10000):
+        """Generate matches of many targets to stars of dataset in boxes
+
+        Same as calling fetch_boxmatch() for each target, but with a
+        single query.  Output as iter_conematch().
+        """
+        self.upload_targets(skycoords)
+        sql, binds = self._boxmatch_bulk_sql(dataset, ra_side, dec_side, orient)
+        return self.iter_astropy(sql, binds, chunksize=chunksize)
+
+    def fetch_boxmatch_bulk(self, dataset, skycoords, ra_side, dec_side=None, orient='center'):
+        """Match many targets to stars of dataset in boxes, see iter_boxmatch_bulk()"""
+        self.upload_targets(skycoords)
+        sql, binds = self._boxmatch_bulk_sql(dataset, ra_side, dec_side, orient)
+        return self.fetchall_astropy(sql, binds)
@@ -1,18 +1,30 @@
 import os
 import os.path
 import json
+import locale
 import importlib
 import datetime
-import astropy.time
+import itertools
 import re
+import warnings
 
 from . import utils
 
-def load_class(name):
-    """Returns a DataReader class for the given datapkg name"""
+astropy = utils.LazyModule('astropy')
+numpy = utils.LazyModule('numpy')
+
+def load_class(name, columnar=False):
+    """Returns a DataReader class for the given datapkg name
+
+    With 'columnar', text files are parsed by column blocks with numpy,
+    see TextDataReader.columnar.
+    """
     modname = 'datapkg.' + name
     mod = importlib.import_module(modname)
-    return mod.DataReader()
+    reader = mod.DataReader()
+    if columnar:
+        reader.columnar = True
+    return reader
 
 def data_iter(name):
     """Returns a generator function to iterate through the data of the given name"""
@@ -40,6 +52,7 @@ class BaseDataReader(object):
         self.reference = None
         self.instrument = None
         self.sanity_check = None
+        self.encoding = None
         self.extras = None
 
         # Set the directory to find files.  Child class must set childfile first!
@@ -103,10 +116,11 @@ class BaseDataReader(object):
         # Optional keys
         self.instrument = js.get('instrument')
         self.sanity_check = js.get('sanity_check')
+        self.encoding = js.get('encoding') # of the data files, default that of the locale
         
         # Extra info
         for k, v in list(js.items()):
-            if k in ('reference', 'origin', 'instrument', 'sanity_check'):
+            if k in ('reference', 'origin', 'instrument', 'sanity_check', 'encoding'):
                 continue
             if self.extras is None:
                 self.extras = {}
@@ -147,7 +161,14 @@ class BaseDataReader(object):
         """Returns dict of extra information found in the info.json file"""
         return self.extras
 
+# Regular expression delimiters that numpy.loadtxt() splits the same way, see _split_chunk()
+LOADTXT_DELIMITERS = { r'\s+' : None, r'\t' : '\t', '\t' : '\t' }
+
 class TextDataReader(BaseDataReader):
+    # If True, parse_deliminated() and byteparse_file() parse chunks of
+    # lines by column with numpy instead of line by line
+    columnar = False
+
     def typecast(self, obj, typemap, debug=False, time_scale=None, offset=None):
         if debug:
             print("DEBUG obj:", obj)
@@ -193,7 +214,12 @@ class TextDataReader(BaseDataReader):
                 raise Exception('unknown typecode %s' % typecode)
 
     def parse_deliminated(self, file, colnames, typemap, delim=r'\s+', skip=0, debug=False, **typecast_kwargs):
-        fh = open(file)
+        if self.columnar and not debug:
+            for row in self.parse_deliminated_columns(file, colnames, typemap, delim=delim, skip=skip,
+                                                      rows=True, **typecast_kwargs):
+                yield row
+            return
+        fh = open(file, encoding=self.encoding)
         linenum = 0
         for line in fh:
             linenum += 1
@@ -211,19 +237,224 @@ class TextDataReader(BaseDataReader):
             yield result
         fh.close()
 
+    def _cast_numeric(self, k, o, empty, dtype, errors):
+        """Cast stripped string column o to dtype, recording bad fields in errors if given"""
+        try:
+            return numpy.where(empty, '0', o).astype(dtype), empty
+        except ValueError:
+            if errors is None:
+                raise
+        values = numpy.zeros(len(o), dtype=dtype)
+        mask = empty.copy()
+        for i in numpy.flatnonzero(~empty):
+            value = str(o[i])
+            try:
+                values[i] = dtype(value)
+            except ValueError as e:
+                errors.append((int(i), k, value, str(e)))
+                mask[i] = True
+        return values, mask
+
+    def typecast_columns(self, cols, typemap, time_scale=None, offset=None, errors=None):
+        """Typecast a dict of string columns, like typecast() does for a row
+
+        Each column in cols is a numpy string array and is replaced
+        according to its typecode in typemap:
+         - 's'      : left as a string array
+         - 'i', 'f' : numpy.ma.MaskedArray of int or float, masked where
+                      the field is empty
+         - 'T<fmt>' : a single astropy.time.Time array, masked where the
+                      field is empty or, for strptime formats, unparseable
+
+        If 'errors' is a list, fields which can not be typecast are
+        masked and appended to it as (row index, column, value, message)
+        instead of raising ValueError.
+        """
+        for k, typecode in list(typemap.items()):
+            col = cols[k]
+            if typecode == 's':
+                continue
+            o = numpy.char.strip(col)
+            empty = (o == '')
+            if typecode in ('i', 'f'):
+                dtype = int if typecode == 'i' else float
+                values, mask = self._cast_numeric(k, o, empty, dtype, errors)
+                cols[k] = numpy.ma.MaskedArray(values, mask=mask)
+            elif typecode.startswith('T'): # 'T' for time
+                if time_scale is None:
+                    raise Exception('astropy.time.Time scale must be specified for date parsing')
+                time_format = typecode[1:]
+                # Option 1: format is one recognized by astropy.time.Time
+                if time_format in list(astropy.time.Time.FORMATS.keys()):
+                    if time_format in ('byear', 'cxcsec', 'gps', 'jd', 'jyear', 'mjd', 'plot_date', 'unix'):
+                        values, bad = self._cast_numeric(k, o, empty, float, errors)
+                        if offset is not None:
+                            values += offset
+                    else:
+                        values = col
+                        bad = empty.copy()
+                        if errors is not None:
+                            for i in numpy.flatnonzero(~empty):
+                                try:
+                                    astropy.time.Time(values[i], format=time_format, scale=time_scale)
+                                except ValueError as e:
+                                    errors.append((int(i), k, str(values[i]), str(e)))
+                                    bad[i] = True
+                # Option 2: format is one recognized by datetime.strptime()
+                else:
+                    values = []
+                    bad = numpy.zeros(len(col), dtype=bool)
+                    for i, datestr in enumerate(col):
+                        try:
+                            values.append(datetime.datetime.strptime(datestr.replace(' ','0'), time_format))
+                        except ValueError as e:
+                            values.append(None)
+                            bad[i] = True
+                            if errors is not None and datestr.strip() != '':
+                                errors.append((i, k, str(datestr), str(e)))
+                    time_format = 'datetime'
+                if bad.all():
+                    cols[k] = numpy.array([None] * len(col), dtype=object)
+                    continue
+                # Fill bad fields with a valid value, then mask them
+                fill = values[numpy.flatnonzero(~bad)[0]]
+                values = numpy.array([fill if b else v for v, b in zip(values, bad)]) if bad.any() else values
+                t = astropy.time.Time(values, format=time_format, scale=time_scale)
+                if bad.any():
+                    t[bad] = numpy.ma.masked
+                cols[k] = t
+            else:
+                raise Exception('unknown typecode %s' % typecode)
+        return cols
+
+    def column_rows(self, cols):
+        """Generate row dicts from a dict of columns made by typecast_columns()
+
+        Masked values become None and numeric values become python
+        scalars, as in the rows produced by typecast().
+        """
+        names = list(cols.keys())
+        nrows = len(cols[names[0]]) if names else 0
+        for i in range(nrows):
+            row = {}
+            for k in names:
+                col = cols[k]
+                if isinstance(col, numpy.ma.MaskedArray):
+                    row[k] = None if col.mask[i] else col.data[i].item()
+                elif isinstance(col, astropy.time.Time):
+                    row[k] = None if (col.masked and col.mask[i]) else col[i]
+                elif col.dtype.kind == 'U':
+                    row[k] = str(col[i])
+                else:
+                    row[k] = col[i]
+            yield row
+
+    def _split_chunk(self, lines, delim, splitter, ncols):
+        """Split lines into a (lines, ncols) string array, as re.split(delim) would
+
+        Delimiters which are a single character, or whitespace, are
+        split by the C parser of numpy.loadtxt().  The lines are split
+        one by one with 'splitter' for other delimiters, and for chunks
+        that loadtxt() would read differently: blank lines, rows of
+        different lengths, or leading whitespace on some lines only.
+        """
+        if delim in LOADTXT_DELIMITERS:
+            delimiter = LOADTXT_DELIMITERS[delim]
+        elif len(delim) == 1 and delim == re.escape(delim):
+            delimiter = delim
+        else:
+            delimiter = False
+        if delimiter is not False:
+            # re.split(r'\s+') gives an empty first field for indented lines
+            indented = 0
+            if delimiter is None:
+                indented = sum(1 for line in lines if line[:1].isspace())
+            if indented in (0, len(lines)):
+                try:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore') # about blank lines, checked below
+                        table = numpy.loadtxt(lines, dtype=str, delimiter=delimiter,
+                                              comments=None, ndmin=2)
+                except ValueError:
+                    table = None
+                if table is not None and len(table) == len(lines):
+                    if indented:
+                        table = numpy.hstack([numpy.full((len(lines), 1), '', dtype=table.dtype), table])
+                    if table.shape[1] < ncols:
+                        pad = numpy.full((len(lines), ncols - table.shape[1]), '', dtype=table.dtype)
+                        table = numpy.hstack([table, pad])
+                    return table[:, :ncols]
+        fields = []
+        for line in lines:
+            row = splitter.split(line.rstrip('\n'))[:ncols]
+            if len(row) < ncols:
+                row += [''] * (ncols - len(row))
+            fields.append(row)
+        return numpy.array(fields, dtype=str).reshape(len(fields), ncols)
+
+    def parse_deliminated_columns(self, file, colnames, typemap, delim=r'\s+', skip=0, chunksize=10000,
+                                  rows=False, **typecast_kwargs):
+        """Parse a deliminated file into typed column blocks
+
+        Same input as parse_deliminated(), but lines are read
+        'chunksize' at a time, split by _split_chunk() and typecast by
+        column with typecast_columns().  Yields a dict of columns per
+        chunk, or if 'rows' is True, row dicts built lazily from those
+        columns.  Lines with fewer fields than colnames are padded with
+        empty fields.
+        """
+        splitter = re.compile(delim)
+        ncols = len(colnames)
+        fh = open(file, encoding=self.encoding)
+        for i in range(skip):
+            fh.readline()
+        while True:
+            lines = list(itertools.islice(fh, chunksize))
+            if not lines:
+                break
+            table = self._split_chunk(lines, delim, splitter, ncols)
+            cols = dict((name, table[:, i]) for i, name in enumerate(colnames))
+            cols = self.typecast_columns(cols, typemap, **typecast_kwargs)
+            if rows:
+                for row in self.column_rows(cols):
+                    yield row
+            else:
+                yield cols
+        fh.close()
+
+    def compile_bytespec(self, spec):
+        """Return a ByteSpecParser for spec, compiling it on first use"""
+        if getattr(self, '_bytespecs', None) is None:
+            self._bytespecs = {}
+        # spec entries may be lists, e.g. from JSON
+        key = tuple((k, tuple(v)) for k, v in spec.items())
+        if key not in self._bytespecs:
+            self._bytespecs[key] = ByteSpecParser(self, spec)
+        return self._bytespecs[key]
+
     def byteparse(self, line, spec, debug=False, **typecast_kwargs):
-        line = line.rstrip('\n')
-        result = {}
-        typemap = {}
-        if debug:
-            print("DEBUG line:", line)
-            print("DEBUG spec:", spec)
-        for k in spec:
-            (initial, final, typecode) = spec[k]
-            result[k] = line[initial:final]
-            typemap[k] = typecode
-        self.typecast(result, typemap, debug=debug, **typecast_kwargs)
-        return result
+        parser = self.compile_bytespec(spec)
+        return parser.parse_line(line, debug=debug, **typecast_kwargs)
+
+    def byteparse_file(self, file, spec, skip=0, debug=False, **typecast_kwargs):
+        """Generate the row dicts of a fixed-width file, see byteparse()
+
+        In columnar mode the file is parsed by chunks with
+        ByteSpecParser.parse_file(), which raises a ParseError listing
+        the fields of a chunk which can not be typecast.
+        """
+        parser = self.compile_bytespec(spec)
+        if self.columnar and not debug:
+            for row in parser.parse_file(file, skip=skip, rows=True, encoding=self.encoding,
+                                         **typecast_kwargs):
+                yield row
+            return
+        fh = open(file, encoding=self.encoding)
+        for i in range(skip):
+            fh.readline()
+        for line in fh:
+            yield parser.parse_line(line, debug=debug, **typecast_kwargs)
+        fh.close()
 
     def stripstr(self, datadict, strlist=None):
         for k,v in list(datadict.items()):
@@ -264,14 +495,165 @@ class JsonDataReader(BaseDataReader):
                 yield p
         fh.close()
 
-class DuplicateTimeIncrementor(astropy.time.TimeDelta):
-    last_time = None
+class ParseError(Exception):
+    """Error raised when fields of a data file can not be typecast
+
+    The 'errors' attribute holds a list of (line number, column,
+    value, message) tuples, one for each bad field.
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        message = "%i fields could not be parsed:\n" % len(errors)
+        message += "\n".join("line %i: column '%s' value '%s': %s" % e for e in errors)
+        Exception.__init__(self, message)
+
+class ByteSpecParser(object):
+    """Fixed-width record parser compiled from a byteparse() spec
+
+    The spec is a dict of { column : (initial, final, typecode) }
+    giving the character slice and typecode of each column, e.g. as
+    listed in a Vizier ReadMe.  An initial index of None means the
+    start of the line, and a final index of None its end.  Single lines
+    are parsed by slicing; for chunks of lines the column slices are
+    compiled into a numpy structured dtype of unicode fields, so that a
+    whole chunk is split with a single numpy.frombuffer() over its
+    UTF-32 encoding and typecast by column with
+    TextDataReader.typecast_columns().  Chunks can only be parsed if
+    every column is a non-empty slice of non-negative indices.
+    """
+    def __init__(self, reader, spec):
+        self.reader = reader
+        self.names = list(spec.keys())
+        self.bounds = [ (k, spec[k][0] or 0, spec[k][1]) for k in self.names ]
+        self.slices = [ (k, slice(initial, final)) for k, initial, final in self.bounds ]
+        self.typemap = dict((k, spec[k][2]) for k in self.names)
+        self.open_ended = any(final is None for k, initial, final in self.bounds)
+        self.width = max([ final for k, initial, final in self.bounds if final is not None ] +
+                         [ initial for k, initial, final in self.bounds ])
+        self.unsupported = [ k for k, initial, final in self.bounds
+                             if initial < 0 or (final is not None and final <= initial) ]
+        self._dtypes = {}
+        self.errors = []
+
+    def dtype(self, width):
+        """Structured dtype of records 'width' characters long, ending open-ended columns there"""
+        if self.unsupported:
+            raise Exception("Byte spec columns %s are negative or empty slices, "
+                            "which can only be parsed line by line" % ", ".join(self.unsupported))
+        if width not in self._dtypes:
+            finals = [ width if final is None else final for k, initial, final in self.bounds ]
+            sizes = [ max(final - initial, 1) for (k, initial, _), final in zip(self.bounds, finals) ]
+            offsets = [ initial for k, initial, final in self.bounds ]
+            itemsize = max([width] + [ o + n for o, n in zip(offsets, sizes) ])
+            # numpy unicode characters are 4 bytes, as in UTF-32
+            self._dtypes[width] = numpy.dtype({'names'    : self.names,
+                                               'formats'  : [ '<U%i' % size for size in sizes ],
+                                               'offsets'  : [ 4 * o for o in offsets ],
+                                               'itemsize' : 4 * itemsize})
+        return self._dtypes[width]
+
+    def parse_line(self, line, debug=False, **typecast_kwargs):
+        """Parse a single line into a row dict, like TextDataReader.byteparse()"""
+        line = line.rstrip('\n')
+        if debug:
+            print("DEBUG line:", line)
+            print("DEBUG spec:", self.slices)
+        result = dict((k, line[s]) for k, s in self.slices)
+        self.reader.typecast(result, self.typemap, debug=debug, **typecast_kwargs)
+        return result
+
+    def parse_chunk(self, lines, first_linenum=1, **typecast_kwargs):
+        """Parse a list of lines into a dict of typed columns
+
+        Fields which can not be typecast are masked, and recorded in
+        self.errors as (line number, column, value, message).
+        """
+        lines = [ line.rstrip('\r\n') for line in lines ]
+        width = self.width
+        if self.open_ended:
+            width = max([width] + [ len(line) for line in lines ])
+        dtype = self.dtype(width)
+        width = dtype.itemsize // 4
+        # NUL padding is dropped from numpy strings, so short lines give the same fields as slicing
+        raw = ''.join(line.ljust(width, '\0')[:width] for line in lines).encode('utf-32-le')
+        records = numpy.frombuffer(raw, dtype=dtype, count=len(lines))
+        cols = dict((k, records[k].copy()) for k in self.names)
+        errors = []
+        self.reader.typecast_columns(cols, self.typemap, errors=errors, **typecast_kwargs)
+        for (i, k, value, message) in sorted(errors):
+            self.errors.append((first_linenum + i, k, value, message))
+        return cols
+
+    def decode(self, lines, first_linenum=1, encoding=None):
+        """Decode lines of bytes, raising a ParseError listing the lines that can not be decoded"""
+        encoding = encoding or locale.getpreferredencoding(False)
+        decoded = []
+        errors = []
+        for i, line in enumerate(lines):
+            try:
+                decoded.append(line.decode(encoding))
+            except UnicodeDecodeError as e:
+                errors.append((first_linenum + i, '*', line[e.start:e.end], "not %s: %s" % (encoding, e.reason)))
+        if errors:
+            raise ParseError(errors)
+        return decoded
+
+    def parse_file(self, file, skip=0, chunksize=10000, rows=False, strict=True, encoding=None,
+                   **typecast_kwargs):
+        """Parse a fixed-width file into typed column blocks
+
+        Yields a dict of columns per chunk of 'chunksize' lines, or if
+        'rows' is True, row dicts built lazily from those columns.  If
+        'strict' is True a ParseError listing every bad field of the
+        chunk is raised; otherwise bad fields are masked and collected
+        in self.errors.  Lines are decoded with 'encoding', default
+        that of the locale as for open(); a line which can not be
+        decoded raises a ParseError.
+        """
+        fh = open(file, 'rb')
+        for i in range(skip):
+            fh.readline()
+        linenum = skip + 1
+        try:
+            while True:
+                lines = list(itertools.islice(fh, chunksize))
+                if not lines:
+                    break
+                lines = self.decode(lines, first_linenum=linenum, encoding=encoding)
+                n_errors = len(self.errors)
+                cols = self.parse_chunk(lines, first_linenum=linenum, **typecast_kwargs)
+                if strict and len(self.errors) > n_errors:
+                    raise ParseError(self.errors[n_errors:])
+                linenum += len(lines)
+                if rows:
+                    for row in self.reader.column_rows(cols):
+                        yield row
+                else:
+                    yield cols
+        finally:
+            fh.close()
+
+def _duplicate_time_incrementor():
+    """Define DuplicateTimeIncrementor, a subclass of astropy.time.TimeDelta"""
+    class DuplicateTimeIncrementor(astropy.time.TimeDelta):
+        last_time = None
+
+        def process(self, time):
+            if self.last_time is not None and self.last_time == time:
+                time = time + self
+            self.last_time = time
+            return time
+
+        def reset(self):
+            self.last_time = None
 
-    def process(self, time):
-        if self.last_time is not None and self.last_time == time:
-            time = time + self
-        self.last_time = time
-        return time
+    DuplicateTimeIncrementor.__module__ = __name__
+    return DuplicateTimeIncrementor
 
-    def reset(self):
-        self.last_time = None
+def __getattr__(name):
+    # DuplicateTimeIncrementor subclasses astropy.time.TimeDelta, so it
+    # is defined at its first use rather than importing astropy here
+    if name == 'DuplicateTimeIncrementor':
+        globals()[name] = _duplicate_time_incrementor()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
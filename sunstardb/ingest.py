@@ -0,0 +1,431 @@
+"""Ingestion of many data packages in parallel
+
+Data packages are parsed in a pool of processes, and loaded by a small
+number of writer threads, each with its own database connection.  The
+rows a package depends on are inserted first, in dependency order, by a
+single connection: references, origins, then stars; instruments and
+datatypes must already exist.  Each package is then loaded in its own
+transaction, so that a failing package is rolled back without affecting
+the others.
+
+The entry point is ingest_packages(), see bin/sunstardb_ingest.py.
+
+Within one package, run_pipeline() overlaps parsing with database
+writes, see bin/sunstardb_datapkg.py --pipeline.
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import queue
+import threading
+import time
+
+from . import datapkg
+from . import utils
+
+class Package(object):
+    """Parsed contents of a data package
+
+    Holds the package information (reference, origin, source,
+    instrument, sanity_check) and the list of all its data points, so
+    that it can be passed from a parser process to a writer.
+    """
+
+    def __init__(self, name, dataobj, data, parse_time=None):
+        self.name = name
+        self.reference = dataobj.reference
+        self.origin = dataobj.origin
+        self.source = dataobj.source
+        self.instrument = dataobj.instrument
+        self.sanity_check = dataobj.sanity_check
+        self.data = data
+        self.parse_time = parse_time
+
+def parse_package(name, columnar=False):
+    """Load the DataReader of a data package and parse all its data
+
+    Runs in a worker process of ingest_packages().  See
+    datapkg.load_class() for 'columnar'.
+    """
+    start = time.time()
+    dataobj = datapkg.load_class(name, columnar=columnar)
+    data = list(dataobj.data())
+    return Package(name, dataobj, data, time.time() - start)
+
+def instrument_names(instrument):
+    """List of instrument names given the instrument specification of a package"""
+    if instrument is None:
+        return []
+    elif isinstance(instrument, str):
+        return [ instrument ]
+    elif isinstance(instrument, list):
+        return instrument
+    else:
+        raise Exception("unexpected instrument specification")
+
+def load_dimensions(db, package):
+    """Insert the reference, origin and stars of a package, and check its instruments
+
+    Stars are inserted in the order they appear, each one in a
+    savepoint, so that a star which can not be resolved does not lose
+    the others.  Commits the inserted rows.
+
+    Output:
+     - <list> : error messages; the package can be loaded if empty
+    """
+    errors = []
+    if db.fetch_reference(package.reference) is None:
+        db.insert_reference(package.reference)
+    if db.fetch_origin(package.origin) is None:
+        db.insert_origin(package.origin)
+    for instrument in instrument_names(package.instrument):
+        if db.fetch_instrument({'name': instrument}) is None:
+            errors.append("Instrument '%s' is not in the database" % instrument)
+
+    names = []
+    for datum in package.data:
+        if datum['star'] not in names:
+            names.append(datum['star'])
+    stars = db.fetch_stars(names)
+    missing = [ name for name in names if stars[name] is None ]
+    if missing and hasattr(db.resolver, 'prefetch'):
+        db.resolver.prefetch(missing)
+    for name in missing:
+        if db.fetch_star(name=name) is not None:
+            continue # alias of a star inserted for an earlier name
+        db.execute("SAVEPOINT insert_star")
+        try:
+            db.insert_star(name=name)
+        except Exception as e:
+            db.execute("ROLLBACK TO SAVEPOINT insert_star")
+            if db.lookup_cache is not None:
+                db.lookup_cache.invalidate('star')
+            errors.append("Star '%s' could not be inserted: %s" % (name, e))
+    db.commit()
+    return errors
+
+def load_package(db, package, batch_size=5000, commit=True):
+    """Insert the source and data of a parsed package in one transaction
+
+    The dimensions of the package must have been loaded, see
+    load_dimensions().  Data are inserted with insert_data_bulk() in
+    batches of 'batch_size'.  On failure the transaction is rolled back
+    and the exception raised again.
+
+    Output:
+     - <int> : number of data points inserted
+    """
+    try:
+        db_ref = db.fetch_reference(package.reference)
+        db_origin = db.fetch_origin(package.origin)
+        db_source = db.insert_source(origin_id=db_origin['id'], **package.source)
+
+        instruments = {}
+        for instrument in instrument_names(package.instrument):
+            instruments[instrument] = db.fetch_instrument({'name': instrument})
+        global_instr = None
+        if isinstance(package.instrument, str):
+            global_instr = instruments[package.instrument]
+
+        n_data = 0
+        batch = []
+        for datum in package.data:
+            db_type = db.fetch_datatype(name=datum['type'])
+            if db_type is None:
+                raise Exception("datatype '%s' not found in the database." % datum['type'])
+            db_star = db.fetch_star(name=datum['star'])
+            if db_star is None:
+                raise Exception("star '%s' not found in the database." % datum['star'])
+            if 'instrument' in datum:
+                if datum['instrument'] not in instruments:
+                    raise Exception("'%s' not in instrument list" % datum['instrument'])
+                db_instr = instruments[datum['instrument']]
+            else:
+                db_instr = global_instr
+            batch.append(db.prepare_datum(datum, db_star, db_type, db_source, db_ref, db_instr, defer_time=True))
+            if len(batch) >= batch_size:
+                db.prepare_time_batch(batch)
+                n_data += db.insert_data_bulk(batch)
+                batch = []
+        if batch:
+            db.prepare_time_batch(batch)
+            n_data += db.insert_data_bulk(batch)
+
+        db.create_dataset_from_source(db_source)
+        if package.sanity_check is not None:
+            db.sanity_check(package.sanity_check, db_source, verbose=False)
+    except:
+        db.rollback()
+        raise
+    if commit:
+        db.commit()
+    else:
+        db.rollback()
+    return n_data
+
+def ingest_packages(names, connect, processes=None, writers=2, batch_size=5000, commit=True,
+                    columnar=False, log=print):
+    """Parse and load many data packages in parallel
+
+    Input:
+     - names <list>      : data package names
+     - connect <func>    : function returning a new SunStarDB connection
+     - processes <int>   : number of parser processes, default the
+                           number of CPUs
+     - writers <int>     : number of writer connections
+     - batch_size <int>  : data points per insert_data_bulk() call
+     - commit <bool>     : if False, roll back each package when done
+     - columnar <bool>   : parse text data files by column blocks, see
+                           datapkg.load_class()
+     - log <func>        : function called with progress messages
+
+    Output:
+     - <dict> : { name : None if loaded, or error message }
+
+    Packages are handed to the writers as soon as they are parsed and
+    their dimensions are loaded, by the connection of the calling
+    thread, so that references, origins, and stars shared by packages
+    are inserted only once.  At most processes + writers packages are
+    parsed or loaded at a time: further packages are submitted to the
+    parsers as others are loaded, so that parsed packages do not pile
+    up in memory when the writers are slower than the parsers.
+    """
+    results = {}
+    in_flight = (processes or os.cpu_count() or 1) + writers
+    db = connect()
+    db.enable_cache()
+    local = threading.local()
+    writer_dbs = []
+    writer_lock = threading.Lock()
+
+    def write(package):
+        if getattr(local, 'db', None) is None:
+            local.db = connect()
+            local.db.enable_cache()
+            with writer_lock:
+                writer_dbs.append(local.db)
+        start = time.time()
+        n_data = load_package(local.db, package, batch_size=batch_size, commit=commit)
+        return n_data, time.time() - start
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(processes) as parsers, \
+             concurrent.futures.ThreadPoolExecutor(writers) as writer_pool:
+            pending = iter(names)
+            parsing = {}
+            writing = {}
+
+            def submit_parsers():
+                while len(parsing) + len(writing) < in_flight:
+                    name = next(pending, None)
+                    if name is None:
+                        return
+                    parsing[parsers.submit(parse_package, name, columnar)] = name
+
+            submit_parsers()
+            while parsing or writing:
+                done, not_done = concurrent.futures.wait(list(parsing) + list(writing),
+                                                         return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in writing:
+                        name = writing.pop(future)
+                        try:
+                            n_data, elapsed = future.result()
+                        except Exception as e:
+                            results[name] = "load failed: %s" % e
+                            log("Package '%s' rolled back: %s" % (name, e))
+                            continue
+                        results[name] = None
+                        log("Loaded package '%s': %i data points in %0.3f seconds" % (name, n_data, elapsed))
+                        continue
+
+                    name = parsing.pop(future)
+                    try:
+                        package = future.result()
+                    except Exception as e:
+                        results[name] = "parse failed: %s" % e
+                        log("Package '%s' failed to parse: %s" % (name, e))
+                        continue
+                    log("Parsed package '%s': %i data points in %0.3f seconds" % \
+                        (name, len(package.data), package.parse_time))
+                    try:
+                        errors = load_dimensions(db, package)
+                    except Exception as e:
+                        db.rollback()
+                        errors = [ str(e) ]
+                    if errors:
+                        results[name] = "; ".join(errors)
+                        log("Package '%s' skipped: %s" % (name, results[name]))
+                        continue
+                    writing[writer_pool.submit(write, package)] = name
+                submit_parsers()
+    finally:
+        for writer_db in writer_dbs:
+            writer_db.close()
+        db.close()
+    return results
+
+def parse_batches(data, db, batch_size=5000):
+    """Generate data points in batches with prepared times
+
+    The astropy time conversions of prepare_datum() are done here with
+    prepare_time_batch(), which does not use the database, so that they
+    run on the parser stage of run_pipeline().  The datums must then be
+    prepared with prepare_datum(..., defer_time=True).
+    """
+    batch = []
+    for datum in data:
+        batch.append(datum)
+        if len(batch) >= batch_size:
+            db.prepare_time_batch(batch)
+            yield batch
+            batch = []
+    if batch:
+        db.prepare_time_batch(batch)
+        yield batch
+
+STAGES = ('parse', 'parse_wait', 'write', 'write_wait')
+
+def run_pipeline(batches, write, queue_size=4, timers=None):
+    """Produce batches on a parser thread while writing them on the calling thread
+
+    Input:
+     - batches <iterable> : batches of data, iterated on the parser thread
+     - write <func>       : called with each batch, on the calling thread
+                            which owns the database connection
+     - queue_size <int>   : maximum number of batches waiting to be
+                            written; the parser blocks when the queue is
+                            full (back-pressure)
+     - timers <dict>      : optional dict which is filled with a
+                            utils.Timer for each stage of STAGES
+
+    Output:
+     - <int> : number of batches written
+
+    The 'parse' and 'write' timers hold the time spent working, and
+    the '_wait' timers the time spent waiting for the other stage: a
+    writer which waits a lot means parsing is the bottleneck, and vice
+    versa.  An exception in either stage stops both and is raised.
+    """
+    if timers is None:
+        timers = {}
+    for stage in STAGES:
+        timers.setdefault(stage, utils.Timer(stage))
+    batch_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        error = None
+        try:
+            iterator = iter(batches)
+            while not stop.is_set():
+                timers['parse'].start()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    timers['parse'].stop()
+                timers['parse_wait'].start()
+                put((batch, None))
+                timers['parse_wait'].stop()
+        except BaseException as e:
+            error = e
+        put((done, error))
+
+    parser = threading.Thread(target=produce, name='sunstardb-parser')
+    parser.daemon = True
+    parser.start()
+    n_batches = 0
+    try:
+        while True:
+            timers['write_wait'].start()
+            batch, error = batch_queue.get()
+            timers['write_wait'].stop()
+            if batch is done:
+                if error is not None:
+                    raise error
+                break
+            timers['write'].start()
+            write(batch)
+            timers['write'].stop()
+            n_batches += 1
+    finally:
+        stop.set()
+        parser.join()
+    return n_batches
+
+class Checkpoint(object):
+    """Progress of the ingestion of the data of a package
+
+    A checkpoint is the number of data points of a package already
+    loaded ('offset'), and a hash chained over those data points in
+    order ('content_hash'), as stored in the ingest_checkpoint table.
+    On a rerun, data() skips the loaded data points after checking
+    that their hash is unchanged, so that only new data points are
+    loaded.
+
+    The hash of each data point is taken as data() yields it, before
+    it is modified by the database preparation.  Once data points are
+    committed, advance() returns the new checkpoint to save.
+    """
+
+    def __init__(self, offset=0, content_hash=''):
+        self.offset = offset
+        self.content_hash = content_hash
+        self.pending = collections.deque() # (offset, hash) of data yielded but not committed
+
+    @classmethod
+    def from_db(cls, db_checkpoint):
+        """Checkpoint from an ingest_checkpoint row, or a new one if None"""
+        if db_checkpoint is None:
+            return cls()
+        return cls(db_checkpoint['data_offset'], db_checkpoint['content_hash'])
+
+    def chain(self, content_hash, datum):
+        """Hash of datum chained to the hash of the data before it"""
+        text = content_hash + repr(sorted(datum.items()))
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def data(self, data):
+        """Generate the data points after the checkpoint
+
+        Raises an exception if the data points before the checkpoint
+        changed since they were loaded.
+        """
+        content_hash = ''
+        offset = 0
+        for datum in data:
+            content_hash = self.chain(content_hash, datum)
+            offset += 1
+            if offset < self.offset:
+                continue
+            if offset == self.offset:
+                if content_hash != self.content_hash:
+                    raise Exception("the first %i data points changed since they were loaded" % offset)
+                continue
+            self.pending.append((offset, content_hash))
+            yield datum
+        if offset < self.offset:
+            raise Exception("only %i data points, %i were loaded before" % (offset, self.offset))
+
+    def advance(self, n):
+        """Mark the next n yielded data points as committed
+
+        Output:
+         - (offset, content_hash) : the checkpoint to save
+        """
+        for i in range(n):
+            self.offset, self.content_hash = self.pending.popleft()
+        return self.offset, self.content_hash
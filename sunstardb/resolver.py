@@ -0,0 +1,383 @@
+"""Resolution of star names using SIMBAD
+
+Inserting a star requires its list of SIMBAD identifiers and its basic
+information (main identifier and coordinates).  A resolver provides
+both through resolve(name), which returns an (ids, info) pair as
+returned by lookup_simbad_ids() and lookup_simbad_info(), or
+(None, None) if the name is unknown.
+
+Resolvers implement query(name), returning the raw SIMBAD results as an
+(idlist, record) pair of plain python values, and optionally
+query_many(names).  The raw results are what CachedResolver keeps on
+disk, so that resolution works again later without network access.
+"""
+
+import json
+import math
+import os
+import os.path
+import re
+import sqlite3
+import threading
+import time
+
+from . import utils
+
+# Imported at first use, astroquery alone takes about a second to import
+numpy = utils.LazyModule('numpy')
+astroquery = utils.LazyModule('astroquery')
+astropy = utils.LazyModule('astropy')
+
+def split_simbad_id(simbad_id):
+    """Split a SIMBAD id (e.g. 'HD 1234', 'BD-01 68') into (idtype, id) pair"""
+    idtype, id = re.split(r'[ +-]', simbad_id, 1)
+    idtype = idtype.strip()
+    id = id.strip()
+    return idtype, id
+
+def strip_simbad_id(simbad_id):
+    """Remove superflous prefix from certain SIMBAD ids (NAME, *, **)"""
+    idtype, id = split_simbad_id(simbad_id)
+    if idtype in ['NAME', '*', '**']:
+        return id
+    else:
+        return simbad_id
+
+def format_simbad_coord(ra, dec):
+    """Usually SIMBAD formats ra 'hh mm ss.ss' dec '+dd mm ss.ss'.  This fixes exceptions to that rule..."""
+    result = dict(ra=ra, dec=dec)
+    for k, v in list(result.items()):
+        a = v.split(' ')
+        if len(a) == 3:
+            # this is expected
+            continue
+        elif len(a) == 2: # format was 'dd mm.mm' instead of 'dd mm ss.ss'
+            deg = float(a[0])
+            min = float(a[1])
+            rem = min % 1
+            min = math.floor(min)
+            sec = rem * 60 # * 60 sec / 1 min
+            fix = "%+02i %02i %02.6f" % (deg, min, sec) # TODO: carry over precision?
+            if k == 'ra':
+                fix = fix[1:] # chop off leading sign for ra
+            result[k] = fix
+        else:
+            raise Exception("unexpected format from SIMBAD: ra='%(ra)s' dec='%(dec)s'" % result)
+    return result['ra'] + ' ' + result['dec']
+
+def parse_simbad_ids(idlist):
+    """Turn a list of SIMBAD identifiers into a dict of { idtype : [ ids ] }
+
+    Identifiers have their spaces compressed.  For example, 'HD   1845'
+    will be returned as 'HD 1845'.  This is in order to ensure uniform
+    name-matching.
+    """
+    names = {}
+    for o in idlist:
+        simbad_id = utils.compress_space(o)
+        idtype, id = split_simbad_id(simbad_id)
+        if idtype not in names:
+            names[idtype] = []
+        names[idtype].append(simbad_id)
+    return names
+
+def parse_simbad_info(record):
+    """Turn a raw SIMBAD record (dict with lowercase keys) into an info dict
+
+    See lookup_simbad_info() for the keys of the output.
+    """
+    info_dict = dict(record)
+
+    # Get rid of multiple spaces in Simbad identifier
+    info_dict['main_id'] = utils.compress_space(info_dict['main_id'])
+
+    # Change astroquery numpy string representation of coordinates to something more useful
+    if isinstance(info_dict['ra'], str):
+        coord = format_simbad_coord(info_dict['ra'], info_dict['dec'])
+        skycoord = astropy.coordinates.SkyCoord(coord, frame='icrs',
+                                                unit=(astropy.units.hourangle,
+                                                      astropy.units.degree))
+    else:
+        # Recent astroquery versions give decimal degrees
+        skycoord = astropy.coordinates.SkyCoord(info_dict['ra'], info_dict['dec'], frame='icrs',
+                                                unit=(astropy.units.degree, astropy.units.degree))
+        coord = skycoord.to_string('hmsdms', sep=' ', precision=4)
+    info_dict['coord'] = coord
+    info_dict['skycoord'] = skycoord
+    info_dict['ra'] = skycoord.ra.value
+    info_dict['dec'] = skycoord.dec.value
+
+    return info_dict
+
+def _plain(value):
+    """Convert a value from an astropy table to a JSON-friendly python value"""
+    if value is None or value is numpy.ma.masked:
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    return value
+
+def _record(table, row):
+    """Raw record dict with lowercase keys from a row of an astropy table"""
+    return dict((k.lower(), _plain(table[row][k])) for k in table.colnames)
+
+def lookup_simbad_ids(object_name):
+    """Lookup the given object in Simbad and return a dict of arrays
+
+    Identifiers returned from SIMBAD have their spaces compressed.
+    For example, 'HD   1845' will be returned as 'HD 1845'.  This is in
+    order to ensure uniform name-matching.
+    """
+
+    table = astroquery.simbad.Simbad.query_objectids(object_name)
+    if table is None:
+        return None
+    return parse_simbad_ids(_plain(o[0]) for o in table)
+
+def lookup_simbad_info(object_name):
+    """Information from Simbad.query_object as a dictionary
+
+    Input:
+     - object_name <str> : name to lookup in SIMBAD database
+
+     Output:
+      - info <dict> : information dictionary
+
+    The info dict contains the following keys:
+     - (everything included by default in astroquery.simbad.Simbad.query_object())
+     - coord : the string ICRS coordinates of the object
+     - skycoord : astropy.coordinates.SkyCoord object
+     - ra : right ascention in decimal degrees
+     - dec : declination in decimal degrees
+
+    The 'main_id' identifier returned from SIMBAD have its spaces
+    compressed.  For example, 'HD 1845' will be returned as 'HD 1845'.
+    This is in order to ensure uniform name-matching.
+    """
+    simbad_info = astroquery.simbad.Simbad.query_object(object_name)
+    if simbad_info is None or len(simbad_info) == 0:
+        return None
+    # Result is in first (only) row
+    return parse_simbad_info(_record(simbad_info, 0))
+
+class Resolver(object):
+    """Base class for star name resolvers"""
+
+    def query(self, name):
+        """Return raw (idlist, record) for name, or (None, None) if unknown"""
+        raise NotImplementedError()
+
+    def query_many(self, names):
+        """Return a dict of { name : (idlist, record) } for a list of names
+
+        This base implementation calls query() for each name.
+        """
+        return dict((name, self.query(name)) for name in names)
+
+    def resolve(self, name):
+        """Return (ids, info) for name, or (None, None) if unknown"""
+        return self._parse(self.query(name))
+
+    def resolve_many(self, names):
+        """Return a dict of { name : (ids, info) } for a list of names"""
+        results = self.query_many(names)
+        return dict((name, self._parse(results[name])) for name in results)
+
+    def _parse(self, result):
+        idlist, record = result
+        if idlist is None or record is None:
+            return None, None
+        return parse_simbad_ids(idlist), parse_simbad_info(record)
+
+class SimbadResolver(Resolver):
+    """Resolver querying the SIMBAD service through astroquery"""
+
+    def query(self, name):
+        table = astroquery.simbad.Simbad.query_objectids(name)
+        if table is None or len(table) == 0:
+            return None, None
+        idlist = [ _plain(o[0]) for o in table ]
+        info = astroquery.simbad.Simbad.query_object(name)
+        if info is None or len(info) == 0:
+            return None, None
+        return idlist, _record(info, 0)
+
+    def query_many(self, names):
+        """Resolve a list of names with a single Simbad.query_objects() call
+
+        The identifiers are requested with the 'ids' VOTable field.  If
+        the rows of the result can not be matched to the input names,
+        the names are queried one by one.
+        """
+        names = list(names)
+        if not names:
+            return {}
+        simbad = astroquery.simbad.Simbad()
+        simbad.add_votable_fields('ids')
+        table = simbad.query_objects(names)
+        results = dict((name, (None, None)) for name in names)
+        if table is None:
+            return results
+        colnames = dict((c.lower(), c) for c in table.colnames)
+        if 'user_specified_id' in colnames:
+            rownames = [ _plain(n) for n in table[colnames['user_specified_id']] ]
+        elif len(table) == len(names):
+            rownames = names
+        else:
+            return Resolver.query_many(self, names)
+        for i, name in enumerate(rownames):
+            record = _record(table, i)
+            ids = record.pop('ids', None)
+            if ids:
+                results[name] = ([ s for s in ids.split('|') if s ], record)
+        return results
+
+class LocalResolver(Resolver):
+    """Resolver using local data instead of the SIMBAD service
+
+    For tests and air-gapped loads.  The data is a dict, or a JSON file
+    containing a dict, of { name : { 'ids' : [ ... ], 'main_id' : ...,
+    'ra' : 'hh mm ss.ss', 'dec' : '+dd mm ss.ss', ... } }.  Names are
+    matched with their spaces compressed.
+    """
+
+    def __init__(self, data):
+        if isinstance(data, str):
+            fp = open(data)
+            data = json.load(fp)
+            fp.close()
+        self.data = dict((utils.compress_space(k), v) for k, v in list(data.items()))
+
+    def query(self, name):
+        entry = self.data.get(utils.compress_space(name))
+        if entry is None:
+            return None, None
+        record = dict(entry)
+        idlist = record.pop('ids')
+        return idlist, record
+
+class CachedResolver(Resolver):
+    """Persistent on-disk cache in front of another resolver
+
+    Raw query results are kept in an SQLite file keyed by the
+    compressed name, including names that were not found.  Entries
+    older than 'ttl' seconds, or 'negative_ttl' seconds for names that
+    were not found, are queried again; if that query fails (e.g.
+    without network) the stale entry is used instead.  A resolver may
+    be shared by threads: they use the SQLite connection in turn.
+
+    Input:
+     - resolver <Resolver> : resolver to use for names not in the cache
+     - path <str>          : SQLite file, default from the
+                             SUNSTARDB_SIMBAD_CACHE environment variable
+                             or ~/.cache/sunstardb/simbad.sqlite
+     - ttl <float>         : time to live of entries in seconds, or None
+                             for no expiry.  Default 30 days.
+     - negative_ttl <float> : time to live of names that were not found,
+                              in seconds, or None for no expiry.  Default
+                              one hour, so that a name fixed in SIMBAD
+                              or missed during an outage is retried soon.
+    """
+
+    def __init__(self, resolver=None, path=None, ttl=30*86400, negative_ttl=3600):
+        if resolver is None:
+            resolver = SimbadResolver()
+        if path is None:
+            path = os.environ.get('SUNSTARDB_SIMBAD_CACHE',
+                                  os.path.expanduser('~/.cache/sunstardb/simbad.sqlite'))
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.resolver = resolver
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS simbad_cache
+                               (name TEXT PRIMARY KEY, idlist TEXT, record TEXT, fetch_time REAL)""")
+        self.conn.commit()
+
+    def _key(self, name):
+        return utils.compress_space(name.strip())
+
+    def _get(self, name):
+        """Return (result, fresh) from the cache, or (None, False)"""
+        with self.lock:
+            row = self.conn.execute("SELECT idlist, record, fetch_time FROM simbad_cache WHERE name = ?",
+                                    (self._key(name),)).fetchone()
+        if row is None:
+            return None, False
+        result = (json.loads(row[0]), json.loads(row[1]))
+        ttl = self.ttl if result[0] is not None and result[1] is not None else self.negative_ttl
+        fresh = ttl is None or time.time() - row[2] < ttl
+        return result, fresh
+
+    def _put(self, results):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO simbad_cache (name, idlist, record, fetch_time) VALUES (?, ?, ?, ?)",
+                                  [ (self._key(name), json.dumps(idlist), json.dumps(record), now)
+                                    for name, (idlist, record) in list(results.items()) ])
+            self.conn.commit()
+
+    def query(self, name):
+        return self.query_many([name])[name]
+
+    def query_many(self, names):
+        results = {}
+        missing = []
+        stale = {}
+        for name in names:
+            result, fresh = self._get(name)
+            if fresh:
+                results[name] = result
+            else:
+                missing.append(name)
+                if result is not None:
+                    stale[name] = result
+        with self.lock:
+            self.hits += len(results)
+            self.misses += len(missing)
+        if missing:
+            try:
+                found = self.resolver.query_many(missing)
+            except Exception:
+                if len(stale) < len(missing):
+                    raise
+                found = None
+            if found is None:
+                results.update(stale)
+            else:
+                self._put(found)
+                results.update(found)
+        return results
+
+    def prefetch(self, names):
+        """Resolve and cache a list of names with one query to the resolver
+
+        Returns the number of names which were not already cached.
+        """
+        misses = self.misses
+        self.query_many(names)
+        return self.misses - misses
+
+    def expire(self):
+        """Remove entries older than their time to live"""
+        now = time.time()
+        with self.lock:
+            if self.ttl is not None:
+                self.conn.execute("""DELETE FROM simbad_cache WHERE fetch_time < ?
+                                        AND idlist != 'null' AND record != 'null'""", (now - self.ttl,))
+            if self.negative_ttl is not None:
+                self.conn.execute("""DELETE FROM simbad_cache WHERE fetch_time < ?
+                                        AND (idlist = 'null' OR record = 'null')""", (now - self.negative_ttl,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
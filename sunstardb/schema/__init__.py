@@ -1,5 +1,124 @@
+"""Database schema files, and the datatype table templates of create.sql
+
+create.sql ends with the DDL templates of the dat_<name> tables created
+for each datatype, one per datatype struct, between <STRUCT> and
+</STRUCT> tags.  templates() parses them once per process, and keeps
+the result in a JSON file so that later processes do not parse
+create.sql again until it changes.  datatype_ddl() validates the
+datatype name before interpolating it into a template.
+"""
+
+import json
+import os
 import os.path
+import re
 
 DIR = os.path.dirname(__file__)
 def file(filename):
     return os.path.join(DIR, filename)
+
+# Parsed templates, default file from the SUNSTARDB_TEMPLATE_CACHE environment variable
+TEMPLATE_CACHE = os.environ.get('SUNSTARDB_TEMPLATE_CACHE',
+                                os.path.expanduser('~/.cache/sunstardb/templates.json'))
+
+# Datatype names are used unquoted in table, column and constraint names
+DATATYPE_NAME = re.compile(r'[A-Za-z][A-Za-z0-9_]*')
+DATATYPE_NAME_MAX = 32 # datatype.name is varchar(32)
+
+_templates = None
+
+def parse_templates(lines):
+    """Extract the table templates from the lines of a schema file
+
+    Output:
+     - <dict> : { struct : template DDL }
+    """
+    templates = {}
+    template = None
+    for line in lines:
+        line = line.rstrip()
+        if len(line) > 3 and line[0] == '<' and line[-1] == '>' and line[1] != '/': # tag like <NAME>
+            template = line[1:-1] # gets NAME
+            templates[template] = "" # initialize string
+            continue
+        elif template is not None:
+            if len(line) > 3 and line[0:2] == '</' and line[-1] == '>': # end tag </NAME>
+                template = None
+                continue
+            else:
+                # Add line to saved templates
+                templates[template] += line + "\n"
+    if template is not None:
+        raise Exception("Template parsing finished without closing tag '%s'" % template)
+    return templates
+
+def _schema_version(schemafile):
+    """Version of a schema file for the template cache, from its size and modification time"""
+    stat = os.stat(schemafile)
+    return "%i:%i" % (stat.st_size, stat.st_mtime_ns)
+
+def templates(cache=TEMPLATE_CACHE):
+    """Return the table templates of create.sql, { struct : template DDL }
+
+    The templates are parsed once per process.  If 'cache' is a path,
+    parsed templates are read from and saved to it, along with the
+    size and modification time of create.sql; the file is ignored when
+    create.sql changed, or if it can not be read or written.
+    """
+    global _templates
+    if _templates is not None:
+        return _templates
+    schemafile = file('create.sql')
+    version = _schema_version(schemafile)
+    if cache is not None:
+        try:
+            with open(cache) as fp:
+                cached = json.load(fp)
+            if cached['schema'] == schemafile and cached['version'] == version:
+                _templates = cached['templates']
+                return _templates
+        except (OSError, ValueError, KeyError):
+            pass
+    with open(schemafile) as fp:
+        parsed = parse_templates(fp)
+    if cache is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            # write then rename, so concurrent processes never read a partial file
+            tmpfile = "%s.%i" % (cache, os.getpid())
+            with open(tmpfile, 'w') as fp:
+                json.dump({'schema' : schemafile, 'version' : version, 'templates' : parsed}, fp)
+            os.replace(tmpfile, cache)
+        except OSError:
+            pass
+    _templates = parsed
+    return _templates
+
+def check_datatype_name(name):
+    """Raise an Exception unless name can be used in the dat_<name> table DDL"""
+    if not isinstance(name, str) or not DATATYPE_NAME.fullmatch(name):
+        raise Exception("Invalid datatype name %r: letters, digits and '_' only, starting with a letter" % (name,))
+    if len(name) > DATATYPE_NAME_MAX:
+        raise Exception("Invalid datatype name %r: longer than %i characters" % (name, DATATYPE_NAME_MAX))
+    return name
+
+def datatype_ddl(datatype, partitioned=False):
+    """Return the DDL creating the dat_<name> table of a datatype row (name, struct, id)
+
+    With 'partitioned', the <STRUCT_PARTITIONED> template is used, which
+    only exists for TIMESERIES.
+    """
+    check_datatype_name(datatype['name'])
+    table_templates = templates()
+    template = datatype['struct']
+    if partitioned:
+        template += '_PARTITIONED'
+    if template not in table_templates:
+        raise Exception("No table template for datatype struct '%s'%s" % \
+                        (datatype['struct'], " with partitions" if partitioned else ""))
+    return table_templates[template] % {'name' : datatype['name'], 'id' : int(datatype['id'])}
+
+def partition_name(name, decade):
+    """Name of the partition of dat_<name> holding the obs_time decade starting at year 'decade'"""
+    return "dat_%s_p%04i" % (check_datatype_name(name), decade)
@@ -19,6 +19,7 @@ create table star_alias
   (star			integer		not null,
    type			varchar(32)	not null, -- SIMBAD acronym
    name			varchar(64)	not null, -- SIMBAD name
+   lookup		varchar(64)	not null, -- name without spaces, see utils.normalize_star_name()
    --
    constraint uq_star_alias_name
      unique (name),
@@ -29,7 +30,7 @@ create table star_alias
 
 create index ix_star_alias_star on star_alias (star);
 create index ix_star_alias_type on star_alias (type);
-create unique index uq_star_alias_lookup on star_alias (replace(name, ' ', ''));
+create unique index uq_star_alias_lookup on star_alias (lookup);
 
 -- Reference to published work using data and/or describing accumulation of it
 create table reference
@@ -85,6 +86,21 @@ create table source
 
 create index ix_source_origin on source (origin);
 
+-- Progress of resumable data package ingestion, see sunstardb.ingest.Checkpoint
+create table ingest_checkpoint
+  (source		integer		not null,
+   data_offset		bigint		not null, -- number of data points of the package committed
+   content_hash		varchar(40)	not null, -- chained hash of those data points
+   update_time		timestamp	not null default current_timestamp,
+   --
+   constraint pk_ingest_checkpoint
+     primary key (source),
+   --
+   constraint fk_ingest_checkpoint_source
+     foreign key (source) references source (id)
+     on delete cascade
+  );
+
 -- Observational instrument a property is derived from
 create table instrument
   (id			serial		not null,
@@ -201,6 +217,21 @@ create index ix_dataset_map_star on dataset_map (star);
 create index ix_dataset_map_type on dataset_map (type);
 create index ix_dataset_map_property on dataset_map (property);
 
+-- Registry of materialized wide-table caches of datasets, see SunStarDB.create_dataset_cache()
+create table dataset_cache
+  (dataset		integer		not null,
+   view			varchar(64)	not null, -- materialized view holding the wide table
+   datatypes		varchar(32)[]	not null, -- names of the datatypes in the view
+   refresh_time		timestamp	not null default current_timestamp,
+   --
+   constraint pk_dataset_cache
+     primary key (dataset),
+   --
+   constraint fk_dataset_cache_dataset
+     foreign key (dataset) references dataset (id)
+     on delete cascade
+  );
+
 create table timeseries
   (id			serial		not null,
    star			integer		not null,
@@ -362,4 +393,53 @@ create table dat_%(name)s
   );
 </TIMESERIES>
 
+-- Opt-in layout of TIMESERIES data, see SunStarDB.insert_datatype(partitioned=True).
+-- Partitions of one decade of obs_time, dat_<name>_p<decade>, are created
+-- as data arrive; the default partition only holds what is outside them.
+<TIMESERIES_PARTITIONED>
+create table dat_%(name)s
+  (timeseries		integer			not null,
+   star			integer			not null,
+   type			integer			not null default %(id)s check (type = %(id)s),
+   source		integer			not null,
+   obs_time		timestamp		not null, -- BJD at the START of observations
+   obs_dur		integer			,         -- duration of observation in seconds
+   obs_range		tsrange			,
+   %(name)s		double precision	not null,
+   errlo		double precision	,
+   errhi		double precision	,
+   errbounds		numrange		,
+   insert_time		timestamp		not null default current_timestamp,
+   meta			json			,
+   meta_time		timestamp		not null default current_timestamp,
+   --
+   constraint pk_dat_%(name)s
+     primary key (timeseries, obs_time),
+   --
+   constraint uq_dat_%(name)s_timeseries_integ
+     unique (star, type, source, obs_time),
+   --
+   constraint fk_dat_%(name)s_timeseries
+     foreign key (timeseries) references timeseries (id)
+     on delete cascade,
+   --
+   constraint fk_dat_%(name)s_timeseries_integ
+     foreign key (star, type, source) references timeseries (star, type, source),
+   --
+   constraint fk_dat_%(name)s_star
+     foreign key (star) references star (id),
+   --
+   constraint fk_dat_%(name)s_type
+     foreign key (type) references datatype (id),
+   --
+   constraint fk_dat_%(name)s_source
+     foreign key (source) references source (id)
+     on delete cascade
+  ) partition by range (obs_time);
+
+create table dat_%(name)s_default partition of dat_%(name)s default;
+
+create index ix_dat_%(name)s_obs_time on dat_%(name)s using brin (obs_time);
+</TIMESERIES_PARTITIONED>
+
 */
@@ -1,9 +1,11 @@
 drop table timeseries;
+drop table dataset_cache;
 drop table dataset_map;
 drop table dataset;
 drop table property;
 drop table datatype;
 drop table instrument;
+drop table ingest_checkpoint;
 drop table source;
 drop table origin;
 drop table reference;
@@ -0,0 +1,15 @@
+-- Upgrade an existing database with the dataset_cache registry
+-- (materialized wide-table caches of datasets, see SunStarDB.create_dataset_cache())
+create table dataset_cache
+  (dataset		integer		not null,
+   view			varchar(64)	not null, -- materialized view holding the wide table
+   datatypes		varchar(32)[]	not null, -- names of the datatypes in the view
+   refresh_time		timestamp	not null default current_timestamp,
+   --
+   constraint pk_dataset_cache
+     primary key (dataset),
+   --
+   constraint fk_dataset_cache_dataset
+     foreign key (dataset) references dataset (id)
+     on delete cascade
+  );
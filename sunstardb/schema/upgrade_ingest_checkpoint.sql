@@ -0,0 +1,15 @@
+-- Upgrade an existing database with the ingest_checkpoint table
+-- (progress of resumable data package ingestion, see sunstardb.ingest.Checkpoint)
+create table ingest_checkpoint
+  (source		integer		not null,
+   data_offset		bigint		not null, -- number of data points of the package committed
+   content_hash		varchar(40)	not null, -- chained hash of those data points
+   update_time		timestamp	not null default current_timestamp,
+   --
+   constraint pk_ingest_checkpoint
+     primary key (source),
+   --
+   constraint fk_ingest_checkpoint_source
+     foreign key (source) references source (id)
+     on delete cascade
+  );
@@ -0,0 +1,7 @@
+-- Upgrade an existing database to the star_alias.lookup column
+-- (precomputed normalized alias name, see utils.normalize_star_name())
+alter table star_alias add column lookup varchar(64);
+update star_alias set lookup = replace(name, ' ', '');
+alter table star_alias alter column lookup set not null;
+drop index uq_star_alias_lookup;
+create unique index uq_star_alias_lookup on star_alias (lookup);
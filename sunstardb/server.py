@@ -0,0 +1,244 @@
+"""Local server running the bin/ scripts with a persistent connection
+
+Each bin/ script connects with SunStarDB.cli_connect(), which costs a
+new process worth of imports and a new database connection per call.
+A Server listens on a Unix socket and holds a warm SunStarDB, with its
+connection and caches.  When the SUNSTARDB_SOCKET environment variable
+names the socket of a running server, cli_connect() forwards the script
+path, its arguments and working directory to the server and exits with
+the status of the script, whose output is streamed back as it is
+printed.  If no server listens on the socket, scripts connect directly.
+
+The server runs the script with runpy, one request at a time, and
+cli_connect() returns the server's SunStarDB instead of connecting.
+The database options of the command line are ignored: the script uses
+the connection the server was started with.  After each request the
+transaction is rolled back, and settings changed by the script (star
+resolver, prepared statements, caches) are restored.
+
+The protocol is JSON, one message per line.  The client sends
+{"script", "argv", "cwd"}; the server answers with any number of
+{"out": text} and {"err": text} messages, then {"exit": status}.
+"""
+
+import io
+import json
+import os
+import os.path
+import runpy
+import socket
+import sys
+import traceback
+
+import psycopg2
+
+from sqlhappy import Database
+
+SOCKET_ENV = 'SUNSTARDB_SOCKET'
+
+# SunStarDB attributes that a script may change and that are restored after it
+SETTINGS = ('resolver', 'debug', 'lookup_cache', 'result_cache', 'star_index', 'dataset_cache')
+
+# The SunStarDB of the server while it runs a script, see serving_db()
+_serving = None
+
+def serving_db():
+    """Return the SunStarDB of the server running the current script, or None"""
+    return _serving
+
+def send(fp, **message):
+    """Send a protocol message to a socket file"""
+    fp.write(json.dumps(message) + '\n')
+    fp.flush()
+
+class SocketStream(io.TextIOBase):
+    """Text stream sending what is written as protocol messages of the given key
+
+    Writes are buffered up to 'bufsize' characters or until flush().
+    """
+
+    def __init__(self, fp, key, bufsize=8192):
+        self.fp = fp
+        self.key = key
+        self.bufsize = bufsize
+        self.buffer = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.bufsize:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            text = ''.join(self.buffer)
+            self.buffer = []
+            self.size = 0
+            send(self.fp, **{self.key : text})
+
+def exit_status(code):
+    """Exit status of a SystemExit code, as the python interpreter does"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+class Server(object):
+    """Server running scripts with a persistent SunStarDB
+
+    Input:
+     - db <SunStarDB> : connected database, kept open between requests
+     - path <str>     : path of the Unix socket
+    """
+
+    def __init__(self, db, path):
+        self.db = db
+        self.db.persistent = True
+        self.path = path
+        self.socket = None
+        self.requests = 0
+
+    def open(self):
+        """Create and listen on the socket, only accessible to the current user"""
+        if os.path.exists(self.path):
+            try:
+                connect(self.path).close()
+            except OSError:
+                # left by a server that did not exit cleanly
+                os.remove(self.path)
+            else:
+                raise Exception("A server is already listening on '%s'" % self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.socket.listen(16)
+
+    def close(self):
+        """Stop listening and close the database connection"""
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            os.remove(self.path)
+        self.db.persistent = False
+        self.db.close()
+
+    def serve_forever(self):
+        """Handle requests one at a time until interrupted"""
+        if self.socket is None:
+            self.open()
+        try:
+            while True:
+                conn, address = self.socket.accept()
+                with conn:
+                    self.handle(conn)
+        finally:
+            self.close()
+
+    def handle(self, conn):
+        """Read a request from a client connection and run its script"""
+        rfile = conn.makefile('r', encoding='utf-8')
+        wfile = conn.makefile('w', encoding='utf-8')
+        try:
+            request = json.loads(rfile.readline())
+            status = self.run_script(request['script'], request['argv'], request['cwd'], wfile)
+            send(wfile, exit=status)
+        except (OSError, ValueError):
+            # the client went away, or did not speak the protocol
+            pass
+        finally:
+            rfile.close()
+            try:
+                wfile.close()
+            except OSError:
+                pass
+
+    def run_script(self, script, argv, cwd, wfile):
+        """Run a script as __main__ with the given arguments, return its exit status"""
+        global _serving
+        saved = dict((name, getattr(self.db, name)) for name in SETTINGS)
+        saved_prepared = self.db.prepared_size
+        saved_argv = sys.argv
+        saved_cwd = os.getcwd()
+        saved_streams = sys.stdout, sys.stderr
+        sys.stdout = SocketStream(wfile, 'out')
+        sys.stderr = SocketStream(wfile, 'err')
+        status = 0
+        try:
+            sys.argv = [script] + list(argv)
+            os.chdir(cwd)
+            _serving = self.db
+            runpy.run_path(script, run_name='__main__')
+        except SystemExit as e:
+            status = exit_status(e.code)
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            _serving = None
+            self.requests += 1
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                sys.stdout, sys.stderr = saved_streams
+                sys.argv = saved_argv
+                os.chdir(saved_cwd)
+                self.reset(saved, saved_prepared)
+        return status
+
+    def reset(self, saved, saved_prepared):
+        """End the transaction of a script and restore the settings of the server"""
+        db = self.db
+        if db.prepared_size != saved_prepared:
+            db.disable_prepared()
+            db.prepared_size = saved_prepared
+        for name, value in saved.items():
+            setattr(db, name, value)
+        try:
+            written = db.fetch_scalar("SELECT txid_current_if_assigned()") is not None
+        except psycopg2.Error:
+            written = True
+        if written:
+            # uncommitted writes may be in the caches, SunStarDB.rollback() clears them
+            db.rollback()
+        else:
+            Database.rollback(db)
+
+def connect(path):
+    """Connect to the server socket at path, raising OSError if no server listens"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def run_remote(sock, script, argv, cwd=None):
+    """Run a script on the server connected to sock, printing its output, return its exit status"""
+    with sock:
+        rfile = sock.makefile('r', encoding='utf-8')
+        wfile = sock.makefile('w', encoding='utf-8')
+        send(wfile, script=os.path.abspath(script), argv=list(argv), cwd=cwd or os.getcwd())
+        for line in rfile:
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    raise Exception("Connection to the server closed before the end of the script")
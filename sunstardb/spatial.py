@@ -0,0 +1,197 @@
+"""In-process spatial index of star positions
+
+StarIndex keeps the (ra, dec) of the stars of the database as unit
+vectors, so that cone, box, and nearest-neighbour searches of many
+targets run in-process, without q3c and without the RA wrap-around and
+pole problems of searching in (ra, dec) directly.  The database remains
+the source of truth: the index is loaded from the star table, and
+SunStarDB keeps it up to date and uses it for fetch_boxmatch() and
+fetch_conematch(), see SunStarDB.enable_star_index().
+
+A k-d tree (scipy.spatial.cKDTree) is used if scipy is installed,
+otherwise searches are done by brute force with numpy, in chunks of
+targets.
+
+The search methods take targets as a SkyCoord (scalar or array), or as
+arrays of ra and dec in degrees, and return an astropy.table.Table of
+(idx, id, name, ra, dec, sep), where 'idx' is the index of the target
+and 'sep' the separation in degrees, ordered by target and separation.
+"""
+
+import numpy
+import astropy.table
+
+try:
+    import scipy.spatial
+except ImportError:
+    scipy = None
+
+def unit_vectors(ra, dec):
+    """Unit vectors (N, 3) of the given ra and dec arrays in degrees"""
+    ra = numpy.radians(numpy.atleast_1d(numpy.asarray(ra, dtype='f8')))
+    dec = numpy.radians(numpy.atleast_1d(numpy.asarray(dec, dtype='f8')))
+    cos_dec = numpy.cos(dec)
+    return numpy.column_stack((cos_dec * numpy.cos(ra), cos_dec * numpy.sin(ra), numpy.sin(dec)))
+
+def chord(angle):
+    """Chord length on the unit sphere of an angle in degrees"""
+    return 2.0 * numpy.sin(numpy.radians(angle) / 2.0)
+
+def angle(chord):
+    """Angle in degrees of a chord length on the unit sphere"""
+    return numpy.degrees(2.0 * numpy.arcsin(numpy.clip(chord / 2.0, 0.0, 1.0)))
+
+def target_coords(targets, dec=None):
+    """Return ra, dec arrays in degrees of targets given as a SkyCoord or arrays"""
+    if dec is None:
+        icrs = targets.icrs
+        return numpy.atleast_1d(icrs.ra.degree), numpy.atleast_1d(icrs.dec.degree)
+    return numpy.atleast_1d(numpy.asarray(targets, dtype='f8')), numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+
+class StarIndex(object):
+    """Spatial index of star positions
+
+    Input:
+     - ids <array>   : star ids
+     - names <array> : star names
+     - ra <array>    : right ascension in degrees
+     - dec <array>   : declination in degrees
+    """
+
+    # Maximum number of (target, star) pairs compared at once by brute force
+    CHUNK_PAIRS = 2**22
+
+    def __init__(self, ids=(), names=(), ra=(), dec=()):
+        self.dataset = None
+        # Set when the stars may have changed, see SunStarDB.rollback()
+        self.stale = False
+        self._set(ids, names, ra, dec)
+
+    @classmethod
+    def from_db(cls, db, dataset=None):
+        """Load the index from the star table, or only the stars of a dataset"""
+        index = cls()
+        index.dataset = dataset
+        index.refresh(db)
+        return index
+
+    def refresh(self, db):
+        """Reload all stars from the database"""
+        sql = "SELECT s.id, s.name, s.ra, s.dec FROM star s"
+        binds = None
+        if self.dataset is not None:
+            sql += """ WHERE s.id IN (SELECT dm.star
+                                        FROM dataset_map dm
+                                        JOIN dataset ds ON ds.id = dm.dataset
+                                       WHERE ds.name = %(dataset)s)"""
+            binds = { 'dataset' : self.dataset }
+        table = db.fetchall_astropy(sql, binds, dtype=('i8', 'object', 'f8', 'f8'))
+        self._set(table['id'], table['name'], table['ra'], table['dec'])
+        self.stale = False
+
+    def _set(self, ids, names, ra, dec):
+        self.ids = numpy.asarray(ids, dtype='i8')
+        self.names = numpy.asarray(names, dtype='object')
+        self.ra = numpy.asarray(ra, dtype='f8')
+        self.dec = numpy.asarray(dec, dtype='f8')
+        self.xyz = unit_vectors(self.ra, self.dec)
+        self._tree = None
+
+    def add(self, ids, names, ra, dec):
+        """Add stars to the index; the k-d tree is rebuilt on the next search"""
+        self._set(numpy.concatenate((self.ids, numpy.atleast_1d(ids))),
+                  numpy.concatenate((self.names, numpy.atleast_1d(numpy.asarray(names, dtype='object')))),
+                  numpy.concatenate((self.ra, numpy.atleast_1d(ra))),
+                  numpy.concatenate((self.dec, numpy.atleast_1d(dec))))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def tree(self):
+        """k-d tree of the unit vectors, or None without scipy"""
+        if self._tree is None and scipy is not None and len(self) > 0:
+            self._tree = scipy.spatial.cKDTree(self.xyz)
+        return self._tree
+
+    def _chunks(self, n_targets):
+        """Slices of targets for brute force searches"""
+        size = max(1, self.CHUNK_PAIRS // max(1, len(self)))
+        for start in range(0, n_targets, size):
+            yield slice(start, min(start + size, n_targets))
+
+    def _pairs(self, xyz, radius):
+        """Return (target index, star index) arrays of pairs within radius degrees"""
+        if len(self) == 0:
+            return numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8')
+        if self.tree is not None:
+            found = self.tree.query_ball_point(xyz, chord(radius))
+            counts = numpy.array([ len(f) for f in found ], dtype='i8')
+            targets = numpy.repeat(numpy.arange(len(xyz)), counts)
+            stars = numpy.array([ i for f in found for i in f ], dtype='i8')
+            return targets, stars
+        min_cos = numpy.cos(numpy.radians(radius))
+        targets = []
+        stars = []
+        for chunk in self._chunks(len(xyz)):
+            t, s = numpy.nonzero(numpy.dot(xyz[chunk], self.xyz.T) >= min_cos)
+            targets.append(t + chunk.start)
+            stars.append(s)
+        return numpy.concatenate(targets), numpy.concatenate(stars)
+
+    def _result(self, xyz, targets, stars):
+        """Table of matches ordered by target and separation"""
+        sep = angle(numpy.linalg.norm(xyz[targets] - self.xyz[stars], axis=1))
+        order = numpy.lexsort((sep, targets))
+        targets, stars, sep = targets[order], stars[order], sep[order]
+        return astropy.table.Table([targets, self.ids[stars], self.names[stars],
+                                    self.ra[stars], self.dec[stars], sep],
+                                   names=('idx', 'id', 'name', 'ra', 'dec', 'sep'))
+
+    def cone(self, targets, radius, dec=None):
+        """Find stars within radius degrees of each target"""
+        ra, dec = target_coords(targets, dec)
+        xyz = unit_vectors(ra, dec)
+        t, s = self._pairs(xyz, radius)
+        return self._result(xyz, t, s)
+
+    def box(self, targets, ra_side, dec_side=None, dec=None):
+        """Find stars in a box centered on each target
+
+        The box has the same definition as SunStarDB.fetch_boxmatch():
+        sides in degrees of ra and dec.  Differences in ra are taken
+        across the ra=0 wrap-around, and candidates are found on the
+        sphere, within the circle enclosing the box.
+        """
+        if dec_side is None:
+            dec_side = ra_side
+        ra, dec = target_coords(targets, dec)
+        xyz = unit_vectors(ra, dec)
+        t, s = self._pairs(xyz, numpy.hypot(ra_side / 2.0, dec_side / 2.0))
+        dra = (self.ra[s] - ra[t] + 180.0) % 360.0 - 180.0
+        ddec = self.dec[s] - dec[t]
+        inside = (numpy.abs(dra) <= ra_side / 2.0) & (numpy.abs(ddec) <= dec_side / 2.0)
+        return self._result(xyz, t[inside], s[inside])
+
+    def nearest(self, targets, k=1, dec=None):
+        """Find the k nearest stars of each target"""
+        ra, dec = target_coords(targets, dec)
+        xyz = unit_vectors(ra, dec)
+        k = min(k, len(self))
+        if k == 0:
+            return self._result(xyz, numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8'))
+        if self.tree is not None:
+            dist, stars = self.tree.query(xyz, k=k)
+            stars = numpy.asarray(stars).reshape(len(xyz), k)
+        else:
+            stars = []
+            for chunk in self._chunks(len(xyz)):
+                cos = numpy.dot(xyz[chunk], self.xyz.T)
+                if k < len(self):
+                    cos_part = numpy.argpartition(-cos, k - 1, axis=1)[:, :k]
+                else:
+                    cos_part = numpy.tile(numpy.arange(len(self)), (len(cos), 1))
+                stars.append(cos_part)
+            stars = numpy.concatenate(stars)
+        targets = numpy.repeat(numpy.arange(len(xyz)), k)
+        return self._result(xyz, targets, stars.ravel())
@@ -1,8 +1,53 @@
+import importlib
 import os
 import re
 from datetime import datetime, timedelta
-import astropy.coordinates
-import astropy.time
+
+class LazyModule(object):
+    """Module imported at its first attribute access
+
+    Heavy dependencies (astropy, astroquery, ...) take seconds to
+    import, which every command line tool would pay before connecting.
+    A LazyModule stands in for the module until it is used:
+
+        astropy = LazyModule('astropy')
+        astropy.time.Time(...)   # imports astropy.time here
+
+    Attributes that are not found in the module are imported as
+    submodules, so that 'astropy.time' works as after 'import
+    astropy.time', and 'astropy.io.ascii' as after 'import
+    astropy.io.ascii'.  Found attributes are kept on the LazyModule, so
+    later accesses cost as much as a normal module attribute.
+    """
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        module = importlib.import_module(self.__name)
+        try:
+            value = getattr(module, attr)
+        except AttributeError:
+            name = self.__name + '.' + attr
+            try:
+                value = importlib.import_module(name)
+            except ModuleNotFoundError as e:
+                if e.name != name:
+                    raise
+                raise AttributeError("module '%s' has no attribute '%s'" % (self.__name, attr))
+        if hasattr(value, '__path__') and isinstance(value, type(importlib)):
+            # Subpackages stay lazy for their own submodules, e.g. astropy.io.ascii
+            value = LazyModule(value.__name__)
+        setattr(self, attr, value)
+        return value
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self.__name
+
+astropy = LazyModule('astropy')
+numpy = LazyModule('numpy')
 
 def modification_date(filename):
     t = os.path.getmtime(filename)
@@ -14,6 +59,14 @@ def jyear_utc(jyear):
 def compress_space(s):
     return re.sub(r' +', ' ', s)
 
+def normalize_star_name(name):
+    """Key used to match star aliases, stored in star_alias.lookup
+
+    All spaces are removed, so that e.g. 'HD 1835', 'HD1835' and
+    'HD  1835' are the same star.
+    """
+    return name.replace(' ', '')
+
 def wikiword(s):
     """Turn a string into a word suitable for using in a wiki URL"""
     return re.sub(r'[^\w-]', ' ', s).title().replace(' ', '')
@@ -39,6 +92,63 @@ def time_total():
     elapsed = (t - FIRST_TIME).total_seconds()
     return elapsed
 
+class Timer(object):
+    """Stopwatch accumulating the time spent in one stage of work
+
+    Like time_lap(), but with its own state, so that stages running on
+    different threads can each be timed.  Time between start() and
+    stop() is added to 'total', and each stop() counts one lap.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.total = 0.0
+        self.laps = 0
+        self.last = datetime.now()
+
+    def start(self):
+        self.last = datetime.now()
+
+    def stop(self):
+        t = datetime.now()
+        elapsed = (t - self.last).total_seconds()
+        self.last = t
+        self.total += elapsed
+        self.laps += 1
+        return elapsed
+
+    def __str__(self):
+        return "%s: %0.3f seconds in %i laps" % (self.name, self.total, self.laps)
+
+def lttb(x, y, n):
+    """Indices of at most n points of (x, y) kept by Largest-Triangle-Three-Buckets
+
+    Visual decimation of a series sorted by x: the first and last points
+    are kept, the points in between are split into n - 2 buckets, and
+    from each bucket the point forming the largest triangle with the
+    point kept from the previous bucket and the average of the next
+    bucket is kept.
+    """
+    x = numpy.asarray(x, dtype='f8')
+    y = numpy.asarray(y, dtype='f8')
+    size = len(x)
+    if n >= size:
+        return numpy.arange(size)
+    if n < 3:
+        return numpy.array([0, size - 1][:max(n, 0)], dtype='i8')
+    edges = numpy.linspace(1, size - 1, n - 1).astype('i8')
+    kept = numpy.zeros(n, dtype='i8')
+    kept[-1] = size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = (edges[i + 1], edges[i + 2]) if i < n - 3 else (size - 1, size)
+        cx = x[next_lo:next_hi].mean()
+        cy = y[next_lo:next_hi].mean()
+        area = numpy.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(numpy.argmax(area))
+        kept[i + 1] = a
+    return kept
+
 def parse_skycoord(ra, dec=None, frame='icrs'):
     # possible input formats:
     # 'hh:mm:ss', '+dd:mm:ss'